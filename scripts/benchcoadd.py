@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+from pathlib import Path
+import zuds
+
+zuds.init_db()
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Benchmark the I/O of preparing the inputs of a reference build.'
+
+infile = sys.argv[1]  # file listing the input images of one reference
+tmpdir = sys.argv[2]  # scratch directory for the swarp working directories
+
+
+def written_bytes():
+    """Bytes this process has caused to be written to storage so far."""
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('write_bytes'):
+                return int(line.split()[1])
+
+
+def load(path):
+    image = zuds.ScienceImage.get_by_basename(os.path.basename(path))
+    image.map_to_local_file(path)
+    image.mask_image.map_to_local_file(path.replace('sciimg', 'mskimg'))
+    weightpath = path.replace('.fits', '.weight.fits')
+    if os.path.exists(weightpath):
+        image._weightimg = zuds.FITSImage()
+        image.weight_image.map_to_local_file(weightpath)
+    return image
+
+
+paths = [line.strip() for line in open(infile) if line.strip()]
+images = [load(path) for path in paths]
+outname = str(Path(tmpdir) / f'{uuid.uuid4().hex}.fits')
+
+# what the inputs cost before the flux scales moved to external headers:
+# one rewritten copy of every input with MAGZP
+rewritten = sum(os.path.getsize(image.local_path) for image in images
+                if 'MAGZP' in image.header)
+
+for copy_inputs in [False, True]:
+    directory = Path(tmpdir) / uuid.uuid4().hex
+    os.sync()
+    before = written_bytes()
+    start = time.time()
+    zuds.prepare_swarp_sci(images, outname, directory,
+                           copy_inputs=copy_inputs)
+    os.sync()
+    stop = time.time()
+    written = written_bytes() - before
+
+    print(f'copy_inputs={copy_inputs}: prepared {len(images)} inputs in '
+          f'{stop - start:.2f} sec, wrote {written / 2**20:.1f} MB (flux '
+          f'scaling by rewriting the inputs: {rewritten / 2**20:.1f} MB more)',
+          flush=True)
+    shutil.rmtree(directory)
+
+zuds.DBSession().rollback()
@@ -0,0 +1,76 @@
+import sys
+import time
+import tracemalloc
+import numpy as np
+import zuds
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Benchmark the memory and time of deriving weight and rms maps.'
+
+# shape of a ZTF quadrant
+SHAPE = (3080, 3072)
+ntrials = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+
+def weight_indexing(rms, ind, data, saturval):
+    # CalibratableImageBase.weight_image before zuds.weight_from_rms
+    wgt = np.empty_like(ind, dtype='<f4')
+    wgt[~ind] = 1 / rms[~ind] ** 2
+    wgt[ind] = 0.
+    saturind = data >= 0.9 * saturval
+    wgt[saturind] = 0.
+    return wgt
+
+
+def rms_indexing(weight, ind, data, saturval):
+    # CalibratableImageBase.rms_image before zuds.rms_from_weight
+    rms = np.empty_like(ind, dtype='<f4')
+    rms[~ind] = 1 / np.sqrt(weight[~ind])
+    rms[ind] = zuds.BIG_RMS
+    saturind = data >= 0.9 * saturval
+    rms[saturind] = zuds.BIG_RMS
+    return rms
+
+
+def weight_kernel(rms, ind, data, saturval):
+    return zuds.weight_from_rms(rms, ind,
+                                zuds.saturated_pixels(data,
+                                                      {'SATURATE': saturval}))
+
+
+def rms_kernel(weight, ind, data, saturval):
+    return zuds.rms_from_weight(weight, ind,
+                                zuds.saturated_pixels(data,
+                                                      {'SATURATE': saturval}))
+
+
+def measure(func, *args):
+    """Median wall time and peak memory allocated above the inputs."""
+    times, peaks = [], []
+    for _ in range(ntrials):
+        tracemalloc.start()
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return np.median(times), np.median(peaks)
+
+
+rng = np.random.default_rng(0)
+data = rng.normal(150., 10., SHAPE).astype('<f4')
+rms = rng.uniform(5., 15., SHAPE).astype('<f4')
+ind = rng.random(SHAPE) < 0.05
+weight = 1 / rms ** 2
+saturval = 190.
+
+output = SHAPE[0] * SHAPE[1] * 4
+print(f'quadrant {SHAPE}, float32 output map {output / 2**20:.1f} MB',
+      flush=True)
+for name, func, inp in [('weight, fancy indexing', weight_indexing, rms),
+                        ('weight, zuds.weight_from_rms', weight_kernel, rms),
+                        ('rms, fancy indexing', rms_indexing, weight),
+                        ('rms, zuds.rms_from_weight', rms_kernel, weight)]:
+    t, peak = measure(func, inp, ind, data, saturval)
+    print(f'{name}: {t:.3f} sec, peak {peak / 2**20:.1f} MB '
+          f'({peak / output:.2f}x the output)', flush=True)
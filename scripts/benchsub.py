@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import zuds
+
+zuds.init_db()
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Benchmark the FFT subtraction engine against HOTPANTS.'
+
+infile = sys.argv[1]  # file listing "science_image reference_image" pairs
+outdir = sys.argv[2]  # scratch directory for the benchmark outputs
+
+BACKENDS = ['hotpants', 'fft']
+
+
+def residual_stats(sub):
+    """Robust statistics of the normalized residuals of a subtraction."""
+    good = ~sub.mask_image.boolean.data
+    z = sub.data[good] / sub.rms_image.data[good]
+    med = np.median(z)
+    std = 1.4826 * np.median(np.abs(z - med))
+    return med, std, np.mean(np.abs(z - med) > 5 * std)
+
+
+def load(fn, refn, workdir):
+    # stage the science image so the outputs land in the scratch directory
+    os.makedirs(workdir, exist_ok=True)
+    sci = zuds.ScienceImage.get_by_basename(os.path.basename(fn))
+    for f in [fn, fn.replace('.fits', '.weight.fits'),
+              os.path.join(os.path.dirname(fn), sci.mask_image.basename)]:
+        shutil.copy(f, workdir)
+    scipath = os.path.join(workdir, os.path.basename(fn))
+    sci.map_to_local_file(scipath)
+    sci.mask_image.map_to_local_file(
+        os.path.join(workdir, sci.mask_image.basename)
+    )
+    sci._weightimg = zuds.FITSImage.from_file(
+        scipath.replace('.fits', '.weight.fits')
+    )
+
+    ref = zuds.ReferenceImage.get_by_basename(os.path.basename(refn))
+    ref.map_to_local_file(refn)
+    ref.mask_image.map_to_local_file(refn.replace('.fits', '.mask.fits'))
+    return sci, ref
+
+
+my_work = zuds.get_my_share_of_work(infile)
+
+results = {b: [] for b in BACKENDS}
+for fn, refn in my_work:
+    for backend in BACKENDS:
+        workdir = os.path.join(outdir, backend)
+        sci, ref = load(fn, refn, workdir)
+        start = time.time()
+        try:
+            sub = zuds.SingleEpochSubtraction.from_images(
+                sci, ref, tmpdir=outdir, backend=backend
+            )
+        except Exception as e:
+            print(f'{backend}: {os.path.basename(fn)} failed: {e}',
+                  flush=True)
+            zuds.DBSession().rollback()
+            continue
+        stop = time.time()
+        med, std, frac = residual_stats(sub)
+        results[backend].append((stop - start, med, std, frac))
+        print(f'{backend}: {os.path.basename(fn)} {stop - start:.2f} sec, '
+              f'residual median {med:.3f}, std {std:.3f}, '
+              f'>5 sigma {frac:.4f}', flush=True)
+        zuds.DBSession().rollback()
+
+for backend in BACKENDS:
+    if len(results[backend]) == 0:
+        continue
+    t, med, std, frac = np.asarray(results[backend]).T
+    print(f'{backend}: {len(t)} subtractions, median time {np.median(t):.2f} '
+          f'sec, median residual std {np.median(std):.3f}, median >5 sigma '
+          f'fraction {np.median(frac):.4f}', flush=True)
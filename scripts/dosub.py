@@ -140,14 +140,9 @@ def do_one(fn, sciclass, subclass, refvers, tmpdir='/tmp'):
         new_target = sub.target_image.aligned_to(sub.reference_image)
     else:
         new_target = sub.target_image
-    stamps = []
-    for detection in detections:
-        for i in [sub_target, new_target, sub.reference_image]:
-            # make a stamp for the first detection
-            stamp = zuds.Thumbnail.from_detection(
-                detection, i
-            )
-            stamps.append(stamp)
+    stamps = zuds.Thumbnail.from_detections(
+        detections, [sub_target, new_target, sub.reference_image]
+    )
 
     archstart = time.time()
     #subcopy = db.HTTPArchiveCopy.from_product(sub)
@@ -156,6 +151,11 @@ def do_one(fn, sciclass, subclass, refvers, tmpdir='/tmp'):
     zuds.DBSession().add(sub)
     #db.DBSession().add(cat)
     zuds.DBSession().add_all(detections)
+
+    if zuds.get_stamp_store() is not None:
+        # before the rows are added, so that the stamps are never written
+        # to the database
+        zuds.Thumbnail.pack(stamps)
     zuds.DBSession().add_all(stamps)
 
     #db.DBSession().add(mskcopy)
@@ -12,7 +12,7 @@ __whatami__ = 'Make the subtractions for ZUDS.'
 
 infile = sys.argv[1]  # file listing all the subs to do photometry on
 
-BATCH_SIZE = 50
+BATCH_SIZE = 500
 my_work = zuds.get_my_share_of_work(infile)
 
 def batch(iterable, n=1):
@@ -22,9 +22,9 @@ def batch(iterable, n=1):
 
 for thumbids in batch(my_work, n=BATCH_SIZE):
     start = time.time()
-    thumbs = zuds.DBSession().query(zuds.Thumbnail).filter(zuds.Thumbnail.id.in_(thumbids.tolist()))
-    for t in thumbs:
-        t.persist()
+    thumbs = zuds.DBSession().query(zuds.Thumbnail).filter(zuds.Thumbnail.id.in_(thumbids.tolist())).all()
+    zuds.Thumbnail.persist_many(thumbs)
+    t = thumbs[-1]
     stop = time.time()
     zuds.print_time(start, stop, t, 'get and persist')
 
@@ -1,8 +1,9 @@
 import os
 import sys
 import time
+import multiprocessing
 import pandas as pd
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 import zuds
 zuds.init_db()
@@ -16,81 +17,41 @@ min_date = pd.to_datetime(sys.argv[2])  # minimum allowable date for refimgs
 max_date = pd.to_datetime(sys.argv[3])  # maximum allowable date for refimgs
 version = sys.argv[4]
 
-# get the work
-my_dirs = zuds.get_my_share_of_work(infile)
+nprocs = int(sys.argv[5]) if len(sys.argv) > 5 else 1  # quadrants at once
 
-# make a reference for each directory
-for d in my_dirs:
+
+def make_reference(d):
 
     t_start = time.time()
 
-    # get all the science images
-    image_objects = []
-    sci_fns = Path(d).glob('ztf*sciimg.fits')
-
-    # load the objects partway into memory
-    ok = []
-    for fn in sci_fns:
-        sci = zuds.ScienceImage.get_by_basename(fn.name)
-        sci.map_to_local_file(f'{fn}')
-        maskname = f'{fn.parent / sci.mask_image.basename}'
-        sci.mask_image.map_to_local_file(maskname)
-
-        try:
-            sci.load()
-        except Exception as e:
-            print(f'bad: File {sci.basename} is corrupted, skipping...',
-                  flush=True)
-            continue
-        sci.clear()
-        sci.map_to_local_file(f'{fn}')
-
-        try:
-            sci.mask_image.load()
-        except Exception as e:
-            print(f'bad: File {sci.mask_image.basename} is corrupted, '
-                  f'skipping...',
-                  flush=True)
-            continue
-        sci.mask_image.clear()
-        sci.mask_image.map_to_local_file(maskname)
-
-        c1 = min_date <= sci.obsdate <= max_date
-        c2 = 1.7 < sci.seeing < 2.5
-        c3 = 19.2 < sci.maglimit < 22.
-        c4 = sci.infobits == 0
-        if c1 and c2 and c3 and c4:
-            ok.append(sci)
-
-    # get the very best images
-    top = sorted(ok, key=lambda i: i.maglimit, reverse=True)[:50]
+    # choose the inputs from the database, and only check those files
+    top = zuds.select_reference_inputs(d, min_date, max_date)
     if len(top) == 0:
         print(f'Not enough images ({len(top)} < 14) to make reference '
               f'for {d}. Skipping...')
         zuds.DBSession().rollback()
-        continue
-
+        return
 
-    coaddname = os.path.join(d, f'ref.{ok[0].field:06d}_c{ok[0].ccdid:02d}'
-                                f'_q{ok[0].qid}_{zuds.fid_map[ok[0].fid]}.{version}.fits')
+    coaddname = os.path.join(d, f'ref.{top[0].field:06d}_c{top[0].ccdid:02d}'
+                                f'_q{top[0].qid}_{zuds.fid_map[top[0].fid]}.{version}.fits')
 
     if len(top) < 14:
         print(f'Not enough images ({len(top)} < 14) to make reference '
               f'{coaddname}. Skipping...')
         zuds.DBSession().rollback()
-        continue
+        return
 
 
     try:
-        coadd = zuds.ReferenceImage.from_images(top, coaddname,
-                                                data_product=True,
-                                                nthreads=zuds.get_nthreads(),
-                                                tmpdir='./tmp')
+        coadd = zuds.ReferenceImage.from_images(
+            top, coaddname, data_product=True,
+            nthreads=max(zuds.get_nthreads() // nprocs, 1), tmpdir='./tmp'
+        )
         coadd.version = version
     except TypeError as e:
         print(e, [t.basename for t in top], coaddname)
         zuds.DBSession().rollback()
-        continue
+        return
     else:
         zuds.DBSession().add(coadd)
         catalog = zuds.PipelineFITSCatalog.from_image(coadd)
@@ -102,3 +63,19 @@ for d in my_dirs:
     t_stop = time.time()
     print(f'it took {t_stop - t_start} sec to make {coaddname}.', flush=True)
 
+
+if __name__ == '__main__':
+
+    # get the work
+    my_dirs = zuds.get_my_share_of_work(infile)
+
+    # make a reference for each directory, `nprocs` quadrants at a time.
+    # the workers are spawned, not forked, so that each opens its own
+    # database connection
+    if nprocs == 1:
+        for d in my_dirs:
+            make_reference(d)
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=nprocs, mp_context=ctx) as pool:
+            list(pool.map(make_reference, my_dirs))
@@ -0,0 +1,16 @@
+import sys
+import time
+import zuds
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Build the memory-mapped PS1 sgscore index for ZUDS.'
+
+infile = sys.argv[1]  # file listing the hlsp_ps1-psc_*.fits strips to index
+
+my_work = zuds.get_my_share_of_work(infile)
+
+start = time.time()
+written = zuds.build_sgscore_index(my_work)
+stop = time.time()
+print(f'took {stop - start:.2f} sec to index {len(written)} strips',
+      flush=True)
@@ -0,0 +1,47 @@
+import sys
+import time
+import zuds
+
+zuds.init_db()
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Snapshot the external catalogs used by ZUDS to local disk.'
+
+# radius around each active quadrant center to snapshot (deg). a
+# quadrant is ~0.86 x 0.86 deg, and estimate_seeing searches gaia out to
+# 1.2 deg from the image center.
+QUAD_RADIUS = 0.7
+SEEING_RADIUS = 1.2
+
+# catalog: (projection, ra column, dec column, filter, radius)
+CATALOGS = {
+    'PS1_DR1': (['gMeanPSFMag', 'rMeanPSFMag', 'iMeanPSFMag',
+                 'zMeanPSFMag'], 'raMean', 'decMean', {}, QUAD_RADIUS),
+    'Gaia_DR2': (['parallax', 'phot_g_mean_mag'], 'ra', 'dec',
+                 {'parallax': {'$gt': 0.}}, SEEING_RADIUS),
+    'milliquas_v6': (['Name'], 'ra', 'dec', {}, QUAD_RADIUS),
+    'TNS': (['name'], 'ra', 'dec', {}, QUAD_RADIUS),
+    'ZTF_alerts': (['objectId'], 'candidate.ra', 'candidate.dec', {},
+                   QUAD_RADIUS),
+}
+
+catalogs = sys.argv[1:] or list(CATALOGS)
+
+store = zuds.get_catalog_store()
+if store is None:
+    raise ValueError('Set local_catalog_dir in the configuration file '
+                     'before making catalog snapshots.')
+
+ra, dec = zuds.active_quadrant_centers()
+kowalski = zuds.crossmatch.logon()
+
+for name in catalogs:
+    start = time.time()
+    projection, ra_key, dec_key, catalog_filter, radius = CATALOGS[name]
+    n = zuds.snapshot_kowalski_catalog(store, name, projection, ra, dec,
+                                       radius, catalog_filter=catalog_filter,
+                                       ra_key=ra_key, dec_key=dec_key,
+                                       kowalski=kowalski)
+    stop = time.time()
+    print(f'took {stop - start:.2f} sec to snapshot {n} rows of {name}',
+          flush=True)
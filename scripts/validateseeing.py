@@ -0,0 +1,45 @@
+import sys
+import os
+import time
+import numpy as np
+import zuds
+
+zuds.init_db()
+
+__author__ = 'Danny Goldstein <danny@caltech.edu>'
+__whatami__ = 'Compare catalog-only and Gaia-matched seeing estimates.'
+
+infile = sys.argv[1]  # file listing the science images to compare on
+
+my_work = zuds.get_my_share_of_work(infile)
+
+rows = []
+for fn in my_work:
+    start = time.time()
+    sci = zuds.ScienceImage.get_by_basename(os.path.basename(fn))
+    sci.map_to_local_file(fn)
+    maskname = os.path.join(os.path.dirname(fn), sci.mask_image.basename)
+    sci.mask_image.map_to_local_file(maskname)
+
+    catalog = zuds.PipelineFITSCatalog.from_image(sci)
+
+    try:
+        zuds.estimate_seeing(sci, timeout=np.inf)
+        gaia = sci.header['SEEING']
+        fast = zuds.catalog_seeing(catalog)
+    except Exception as e:
+        print(f'{sci.basename}: {e}', flush=True)
+        continue
+
+    rows.append((gaia, fast))
+    stop = time.time()
+    print(f'{sci.basename}: gaia {gaia:.3f} catalog {fast:.3f} '
+          f'({stop - start:.2f} sec)', flush=True)
+
+if len(rows) > 0:
+    gaia, fast = np.asarray(rows).T
+    ratio = fast / gaia
+    print(f'{len(rows)} images: catalog / gaia seeing median '
+          f'{np.median(ratio):.3f}, 16-84% '
+          f'{np.percentile(ratio, 16):.3f}-{np.percentile(ratio, 84):.3f}',
+          flush=True)
@@ -170,7 +170,9 @@ setup(name=PACKAGENAME,
                         "simplejson",
                         "pytest==4.3.1",
                         'sncosmo>=2.1.0',
-                        'astroquery>=0.3'],
+                        'astroquery>=0.3',
+                        'astropy-healpix>=0.5',
+                        'fastavro>=1.0'],
       author=AUTHOR,
       author_email=AUTHOR_EMAIL,
       license=LICENSE,
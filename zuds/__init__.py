@@ -3,36 +3,52 @@ from .env import check_dependencies
 from .constants import SYSTEM_DEPENDENCIES
 check_dependencies(SYSTEM_DEPENDENCIES)
 
+from .accumulator import *
 from .alert import *
+from .alertstage import *
 from .archive import *
+from .arraykernels import *
+from .background import *
+from .bitmask import *
 from .bookkeeping import *
 from .catalog import *
+from .catalogstore import *
 from .coadd import *
 from .constants import *
 from .core import *
 from .crossmatch import *
 from .detections import *
 from .external import *
+from .fftsub import *
 from .file import *
 from .filterobjects import *
 from .fitsfile import *
 from .hotpants import *
 from .image import *
+from .kernelcache import *
 from .mask import *
 from .model_util import *
 from .mpi import *
 from .photometry import *
 from .plotting import *
+from .refselect import *
+from .scratch import *
 from .secrets import *
 from .seeing import *
 from .send import *
 from .sextractor import *
+from .sgscore import *
 from .thumbnails import *
 from .source import *
 from .spatial import *
+from .stampstore import *
+from .stacking import *
+from .staging import *
 from .subtraction import *
 from .swarp import *
+from .tuning import *
 from .utils import *
+from .virtual import *
 
 from .download import *
 
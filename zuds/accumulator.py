@@ -0,0 +1,342 @@
+import os
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import BKG_VAL
+from .arraykernels import as_data_array, mask_dtype
+from .stacking import (CLIP_SIGMA, CLIP_AMPFRAC, DEFAULT_MEMORY_MB, _Input,
+                       _config, _chunk_rows, _resample_chunk, _input_mesh,
+                       coadd_grid, _coadd_header, _write_coadd)
+
+__all__ = ['CoaddAccumulator', 'accumulator_path', 'accumulate_coadd',
+           'update_coadd_inputs']
+
+
+# mask bits tracked by the accumulator (see zuds.mask)
+MASK_BITS = 17
+
+# a new input is only checked for outliers at pixels that at least this
+# many accepted inputs already cover
+MIN_CLIP_INPUTS = 2
+
+
+def accumulator_path(path):
+    """Path of the accumulator file of the coadd at `path`."""
+    return str(path).replace('.fits', '.accum.npz')
+
+
+class CoaddAccumulator(object):
+    """Running sums of a coadd on a fixed output grid, from which inputs
+    can be added or removed one at a time.
+
+    Every input is resampled onto the grid as in `run_native_coadd`
+    (zeropoint scaling, background subtraction, lanczos3). The
+    accumulator keeps the sums of the weights, of the weighted values and
+    of the weighted squared values (the weighted mean and scatter of each
+    pixel), the number of accepted inputs and of inputs covering each
+    pixel, and, for each mask bit, the number of inputs that set it. This
+    gives the coadd, its weight map and its mask (AND or OR of the inputs)
+    at any time, and lets an input be taken out again exactly.
+
+    When an input is added, its pixels that deviate from the current mean
+    by more than CLIP_SIGMA times the larger of their own sigma and the
+    scatter of the accepted inputs (plus CLIP_AMPFRAC of the mean) are
+    rejected, as in the clipped combine of `combine_stack`. Which pixels
+    of each input were accepted is stored, so that removing the input
+    takes back exactly what it added."""
+
+    def __init__(self, wcs, shape, subtract_back=True, mask_combine='and',
+                 addbkg=True):
+        if mask_combine not in ('and', 'or'):
+            raise ValueError(f'Unknown mask combine type "{mask_combine}", '
+                             f'must be "and" or "or".')
+        self.wcs = wcs
+        self.shape = tuple(shape)
+        self.subtract_back = subtract_back
+        self.mask_combine = mask_combine
+        self.addbkg = addbkg
+
+        self.wsum = np.zeros(self.shape)
+        self.wvsum = np.zeros(self.shape)
+        self.wv2sum = np.zeros(self.shape)
+        self.naccept = np.zeros(self.shape, dtype=np.uint16)
+        self.ncover = np.zeros(self.shape, dtype=np.uint16)
+        self.bitcount = {}
+        self.accepted = {}
+
+    @property
+    def image_ids(self):
+        return sorted(self.accepted)
+
+    def resample(self, image, nthreads=1, memory_mb=None):
+        """Resample `image` onto the grid. Returns its values, weights and
+        mask bits on the grid, and the pixels it covers."""
+
+        if memory_mb is None:
+            memory_mb = float(_config('coadd_memory_mb', DEFAULT_MEMORY_MB))
+
+        ny, nx = self.shape
+        values = np.zeros(self.shape)
+        weights = np.zeros(self.shape)
+        bits = np.zeros(self.shape, dtype=np.int64)
+        covered = np.zeros(self.shape, dtype=bool)
+
+        inp = _Input(image)
+        try:
+            mesh = None
+            if self.subtract_back:
+                mesh = _input_mesh(inp)
+            chunk = _chunk_rows(ny, nx, 1, nthreads, memory_mb)
+
+            def work(r0):
+                rows = slice(r0, min(r0 + chunk, ny))
+                v, w, m, c = _resample_chunk(inp, mesh, self.wcs, rows, nx,
+                                             self.subtract_back)
+                values[rows] = v
+                weights[rows] = w
+                bits[rows] = m
+                covered[rows] = c
+
+            with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                list(pool.map(work, range(0, ny, chunk)))
+        finally:
+            inp.close()
+
+        return values, weights, bits, covered
+
+    def add(self, image, nthreads=1, memory_mb=None):
+        """Add `image` to the coadd."""
+        if image.id in self.accepted:
+            raise ValueError(f'Image "{image.basename}" is already an input '
+                             f'of this coadd.')
+
+        values, weights, bits, covered = self.resample(
+            image, nthreads=nthreads, memory_mb=memory_mb
+        )
+
+        keep = weights > 0
+        mean, scatter = self.mean(), self.scatter()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma = np.maximum(1 / np.sqrt(weights), scatter)
+            outlier = np.abs(values - mean) > \
+                CLIP_SIGMA * sigma + CLIP_AMPFRAC * np.abs(mean)
+        keep &= ~(outlier & (self.naccept >= MIN_CLIP_INPUTS))
+
+        self._apply(values, weights, bits, covered, keep, 1)
+        self.accepted[image.id] = np.packbits(keep)
+
+    def remove(self, image, nthreads=1, memory_mb=None):
+        """Take `image` out of the coadd."""
+        if image.id not in self.accepted:
+            raise ValueError(f'Image "{image.basename}" is not an input of '
+                             f'this coadd.')
+
+        values, weights, bits, covered = self.resample(
+            image, nthreads=nthreads, memory_mb=memory_mb
+        )
+        keep = np.unpackbits(self.accepted.pop(image.id),
+                             count=np.prod(self.shape))
+        keep = keep.reshape(self.shape).astype(bool)
+        self._apply(values, weights, bits, covered, keep, -1)
+
+    def _apply(self, values, weights, bits, covered, keep, sign):
+        w = np.where(keep, weights, 0.)
+        self.wsum += sign * w
+        self.wvsum += sign * w * values
+        self.wv2sum += sign * w * values ** 2
+
+        # uint16 wraps around, but the counts never go below 0
+        self.naccept += (sign * keep).astype(np.uint16)
+        self.ncover += (sign * covered).astype(np.uint16)
+
+        for bit in range(MASK_BITS):
+            hit = covered & ((bits & 2 ** bit) > 0)
+            if bit not in self.bitcount:
+                if not hit.any():
+                    continue
+                self.bitcount[bit] = np.zeros(self.shape, dtype=np.uint16)
+            self.bitcount[bit] += (sign * hit).astype(np.uint16)
+            if not self.bitcount[bit].any():
+                del self.bitcount[bit]
+
+        # remove the rounding residue of pixels no input is left on
+        empty = self.naccept == 0
+        for arr in (self.wsum, self.wvsum, self.wv2sum):
+            arr[empty] = 0.
+
+    def mean(self):
+        """Weighted mean of the accepted inputs, 0 where there are none."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.wsum > 0, self.wvsum / self.wsum, 0.)
+
+    def scatter(self):
+        """Weighted standard deviation of the accepted inputs."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where(self.wsum > 0, self.wv2sum / self.wsum, 0.) - \
+                self.mean() ** 2
+        return np.sqrt(np.clip(var, 0, None))
+
+    def image(self):
+        """The coadd: the mean, plus BKG_VAL if `addbkg`."""
+        image = self.mean()
+        if self.addbkg:
+            image += BKG_VAL
+        return as_data_array(image)
+
+    def weight(self):
+        return as_data_array(self.wsum)
+
+    def mask(self):
+        """The mask of the coadd: the AND (or OR) of the mask bits of the
+        inputs covering each pixel, and bit 16 where no input does."""
+        mask = np.zeros(self.shape, dtype=mask_dtype(2 ** MASK_BITS - 1))
+        for bit, count in self.bitcount.items():
+            if self.mask_combine == 'and':
+                on = (count == self.ncover) & (self.ncover > 0)
+            else:
+                on = count > 0
+            mask[on] += 2 ** bit
+        mask[self.ncover == 0] = 2 ** 16
+        return mask
+
+    def save(self, path):
+        path = Path(path)
+        arrays = {f'bits_{bit}': count for bit, count in
+                  self.bitcount.items()}
+        arrays.update({f'accepted_{i}': keep for i, keep in
+                       self.accepted.items()})
+        tmppath = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmppath, 'wb') as f:
+            np.savez(f, wcs=self.wcs.to_header_string(relax=True),
+                     shape=self.shape, subtract_back=self.subtract_back,
+                     mask_combine=self.mask_combine, addbkg=self.addbkg,
+                     wsum=self.wsum, wvsum=self.wvsum, wv2sum=self.wv2sum,
+                     naccept=self.naccept, ncover=self.ncover, **arrays)
+        os.replace(tmppath, path)
+
+    @classmethod
+    def load(cls, path):
+        from astropy.io import fits
+        from astropy.wcs import WCS
+
+        with np.load(path) as f:
+            wcs = WCS(fits.Header.fromstring(str(f['wcs'])))
+            acc = cls(wcs, tuple(f['shape']),
+                      subtract_back=bool(f['subtract_back']),
+                      mask_combine=str(f['mask_combine']),
+                      addbkg=bool(f['addbkg']))
+            for key in ['wsum', 'wvsum', 'wv2sum', 'naccept', 'ncover']:
+                setattr(acc, key, f[key])
+            for key in f.files:
+                if key.startswith('bits_'):
+                    acc.bitcount[int(key[5:])] = f[key]
+                elif key.startswith('accepted_'):
+                    acc.accepted[int(key[9:])] = f[key]
+        return acc
+
+
+def accumulate_coadd(cls, images, outname, mskoutname, addbkg=True,
+                     nthreads=1, mask_combine='and', subtract_back=True,
+                     memory_mb=None):
+    """Coadd `images` with a `CoaddAccumulator`, as a drop-in replacement
+    for `run_coadd`, and store the accumulator next to the coadd (see
+    `accumulator_path`) so that inputs can later be added or removed with
+    `update_coadd_inputs`."""
+
+    shapes = [(image.header['NAXIS2'], image.header['NAXIS1'])
+              for image in images]
+    wcs, shape = coadd_grid([image.wcs for image in images], shapes)
+    acc = CoaddAccumulator(wcs, shape, subtract_back=subtract_back,
+                           mask_combine=mask_combine, addbkg=addbkg)
+    for image in images:
+        acc.add(image, nthreads=nthreads, memory_mb=memory_mb)
+
+    header = _coadd_header(images, wcs, 'running')
+    result = _write_coadd(cls, images, outname, mskoutname, header,
+                          acc.mean(), acc.weight(), acc.mask(), addbkg)
+    acc.save(accumulator_path(outname))
+    return result
+
+
+def update_coadd_inputs(coadd, add=(), remove=(), nthreads=1,
+                        memory_mb=None, addbkg=True):
+    """Add the images `add` to and remove the images `remove` from the
+    inputs of `coadd`, at the cost of resampling just those images, and
+    update the coadd, its weight map and mask, and `input_images`.
+
+    The accumulator of the coadd is loaded from `accumulator_path`. A coadd
+    without one (e.g., made by swarp) is first rebuilt from its current
+    inputs on its own grid, with `addbkg`, which costs as much as making
+    it again. Returns the accumulator."""
+
+    from .image import FITSImage
+
+    path = accumulator_path(coadd.local_path)
+    inputs = list(coadd.input_images)
+
+    if os.path.exists(path):
+        acc = CoaddAccumulator.load(path)
+    else:
+        acc = CoaddAccumulator(coadd.wcs, coadd.data.shape, addbkg=addbkg)
+        for image in inputs:
+            acc.add(image, nthreads=nthreads, memory_mb=memory_mb)
+
+    for image in remove:
+        if image not in inputs:
+            raise ValueError(f'Image "{image.basename}" is not an input of '
+                             f'"{coadd.basename}".')
+    for image in add:
+        if image in inputs:
+            raise ValueError(f'Image "{image.basename}" is already an input '
+                             f'of "{coadd.basename}".')
+
+    remaining = [i for i in inputs if i not in remove] + list(add)
+    if len(remaining) == 0:
+        raise ValueError(f'Cannot remove every input of "{coadd.basename}".')
+
+    for image in remove:
+        acc.remove(image, nthreads=nthreads, memory_mb=memory_mb)
+    for image in add:
+        acc.add(image, nthreads=nthreads, memory_mb=memory_mb)
+
+    # keep the coadd_images join table in step with the accumulator
+    for image in remove:
+        coadd.input_images.remove(image)
+    for image in add:
+        coadd.input_images.append(image)
+
+    header = _coadd_header(remaining, acc.wcs, 'running')
+    for key, value in header.items():
+        coadd.header[key] = value
+
+    coadd.data = acc.image()
+    coadd.save()
+
+    # as `weight_image` makes it
+    weight = FITSImage()
+    weight.basename = coadd.basename.replace('.fits', '.weight.fits')
+    weight.map_to_local_file(
+        coadd.local_path.replace('.fits', '.weight.fits'), quiet=True
+    )
+    weight.data = acc.weight()
+    weight.header = coadd.header
+    weight.header_comments = coadd.header_comments
+    weight.save()
+    coadd._weightimg = weight
+
+    # the mask and its header describe the new inputs too, on disk as in
+    # memory (as `_write_coadd` writes them)
+    mask = coadd.mask_image
+    if not mask.ismapped:
+        mask.map_to_local_file(
+            coadd.local_path.replace('.fits', '.mask.fits'), quiet=True
+        )
+    mask.data = acc.mask()
+    for key, value in header.items():
+        mask.header[key] = value
+    # saves the mask
+    mask.refresh_bit_mask_entries_in_header()
+
+    acc.save(path)
+    return acc
@@ -51,9 +51,9 @@ class Alert(Base):
 
     def to_dict(self):
         base = deepcopy(self.alert)
-        base['cutoutScience'] = self.cutoutscience.bytes
-        base['cutoutTemplate'] = self.cutouttemplate.bytes
-        base['cutoutDifference'] = self.cutoutdifference.bytes
+        base['cutoutScience'] = self.cutoutscience.payload
+        base['cutoutTemplate'] = self.cutouttemplate.payload
+        base['cutoutDifference'] = self.cutoutdifference.payload
         return base
 
     @classmethod
@@ -65,13 +65,235 @@ class Alert(Base):
         from .joins import CoaddImage
         from .detections import Detection
 
-        obj = cls()
-
-
         if detection.source is None:
             raise ValueError('Cannot issue an alert for a detection that is '
                              f'not associated with a source ({detection.id})')
 
+        # information about the reference images
+
+        start = time.time()
+
+        refstats = DBSession().query(
+            sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
+            sa.func.max(ScienceImage.obsjd) - MJD_TO_JD,
+            sa.func.count(ScienceImage.id)
+        ).select_from(ScienceImage.__table__).join(
+            CoaddImage, ScienceImage.id == CoaddImage.calibratableimage_id
+        ).filter(
+            CoaddImage.coadd_id == detection.image.reference_image_id
+        ).first()
+        stop = time.time()
+        print_time(start, stop, detection, 'get refimgs')
+
+        start = time.time()
+
+        # get dates of single epoch detections
+        singledates = DBSession().query(ScienceImage.obsjd - MJD_TO_JD).select_from(
+            ScienceImage.__table__
+        ).join(
+            SingleEpochSubtraction.__table__, SingleEpochSubtraction.target_image_id == ScienceImage.id
+        ).join(
+            Detection.__table__, Detection.image_id == SingleEpochSubtraction.id
+        ).filter(
+            Detection.source_id == detection.source.id
+        ).all()
+        singledates = [date[0] for date in singledates]
+
+        multidates = DBSession().query(sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
+                                       sa.func.max(ScienceImage.obsjd) - MJD_TO_JD
+        ).select_from(
+            ScienceImage.__table__
+        ).join(
+            CoaddImage, CoaddImage.calibratableimage_id == ScienceImage.id
+        ).join(
+            ScienceCoadd.__table__, ScienceCoadd.id == CoaddImage.coadd_id
+        ).join(
+            MultiEpochSubtraction.__table__, MultiEpochSubtraction.target_image_id == ScienceCoadd.id
+        ).join(
+            Detection.__table__, Detection.image_id == MultiEpochSubtraction.id
+        ).filter(
+            Detection.source_id == detection.source.id
+        ).group_by(ScienceCoadd.id)
+        multidates = [tuple(date) for date in multidates]
+
+        stop = time.time()
+        print_time(start, stop, detection, 'prevdets')
+
+        start = time.time()
+        # make the light curve
+        lc = detection.source.light_curve
+        stop = time.time()
+        print_time(start, stop, detection, 'light_curve')
+
+        return cls._from_detection_and_history(detection, tuple(refstats),
+                                               singledates, multidates, lc)
+
+    @classmethod
+    def from_detections(cls, detection_ids, candidates=None):
+        """Make the alerts for many detections at once.
+
+        Produces the same alerts as calling `from_detection` on each
+        detection, but loads the detections, their images, the reference
+        image statistics, the detection histories and the light curves with
+        a fixed number of set-based queries (grouped by source and by
+        reference), instead of about six queries per detection. Returns the
+        alerts in the order of `detection_ids`.
+
+        `candidates` optionally maps detection ids to the output of
+        `xmatch` for that detection, if the cross-matches were already
+        done (e.g., concurrently, see `AlertStage`)."""
+
+        from sqlalchemy.orm import joinedload, selectinload
+        from .subtraction import SingleEpochSubtraction, MultiEpochSubtraction
+        from .image import ScienceImage
+        from .coadd import ScienceCoadd
+        from .joins import CoaddImage
+        from .detections import Detection
+        from .source import Source
+
+        detection_ids = [int(i) for i in detection_ids]
+
+        start = time.time()
+        detections = DBSession().query(Detection).options(
+            joinedload(Detection.source),
+            selectinload(Detection.rb),
+            selectinload(Detection.thumbnails)
+        ).filter(
+            Detection.id.in_(detection_ids)
+        ).all()
+
+        bydetid = {d.id: d for d in detections}
+        missing = [i for i in detection_ids if i not in bydetid]
+        if len(missing) > 0:
+            raise ValueError(f'Detections {missing} do not exist.')
+        detections = [bydetid[i] for i in detection_ids]
+
+        for detection in detections:
+            if detection.source is None:
+                raise ValueError('Cannot issue an alert for a detection that '
+                                 'is not associated with a source '
+                                 f'({detection.id})')
+
+        # load the subtractions, their targets and the stack inputs into the
+        # session, so that the relationships traversed while assembling the
+        # alerts are resolved from the identity map without further queries
+        image_ids = list({d.image_id for d in detections})
+        sesubs = DBSession().query(SingleEpochSubtraction).options(
+            joinedload(SingleEpochSubtraction.target_image)
+        ).filter(
+            SingleEpochSubtraction.id.in_(image_ids)
+        ).all()
+        mesubs = DBSession().query(MultiEpochSubtraction).filter(
+            MultiEpochSubtraction.id.in_(image_ids)
+        ).all()
+
+        coadd_ids = list({s.target_image_id for s in mesubs})
+        stackinputs = DBSession().query(ScienceImage).join(
+            CoaddImage, CoaddImage.calibratableimage_id == ScienceImage.id
+        ).filter(
+            CoaddImage.coadd_id.in_(coadd_ids)
+        ).all()
+        coadds = DBSession().query(ScienceCoadd).options(
+            selectinload(ScienceCoadd.input_images)
+        ).filter(
+            ScienceCoadd.id.in_(coadd_ids)
+        ).all()
+        stop = time.time()
+        print(f'took {stop - start:.2f} sec to load {len(detections)} '
+              f'detections, {len(sesubs) + len(mesubs)} subtractions and '
+              f'{len(coadds)} stacks of {len(stackinputs)} images',
+              flush=True)
+
+        start = time.time()
+
+        # information about the reference images
+        ref_ids = list({d.image.reference_image_id for d in detections})
+        refstats = DBSession().query(
+            CoaddImage.coadd_id,
+            sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
+            sa.func.max(ScienceImage.obsjd) - MJD_TO_JD,
+            sa.func.count(ScienceImage.id)
+        ).select_from(ScienceImage.__table__).join(
+            CoaddImage, ScienceImage.id == CoaddImage.calibratableimage_id
+        ).filter(
+            CoaddImage.coadd_id.in_(ref_ids)
+        ).group_by(CoaddImage.coadd_id)
+        refstats = {row[0]: tuple(row[1:]) for row in refstats}
+
+        # get dates of single epoch and stack detections of all the sources
+        source_ids = list({d.source_id for d in detections})
+        singledates = {source_id: [] for source_id in source_ids}
+        rows = DBSession().query(
+            Detection.source_id, ScienceImage.obsjd - MJD_TO_JD
+        ).select_from(
+            ScienceImage.__table__
+        ).join(
+            SingleEpochSubtraction.__table__, SingleEpochSubtraction.target_image_id == ScienceImage.id
+        ).join(
+            Detection.__table__, Detection.image_id == SingleEpochSubtraction.id
+        ).filter(
+            Detection.source_id.in_(source_ids)
+        )
+        for source_id, date in rows:
+            singledates[source_id].append(date)
+
+        multidates = {source_id: [] for source_id in source_ids}
+        rows = DBSession().query(Detection.source_id,
+                                 sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
+                                 sa.func.max(ScienceImage.obsjd) - MJD_TO_JD
+        ).select_from(
+            ScienceImage.__table__
+        ).join(
+            CoaddImage, CoaddImage.calibratableimage_id == ScienceImage.id
+        ).join(
+            ScienceCoadd.__table__, ScienceCoadd.id == CoaddImage.coadd_id
+        ).join(
+            MultiEpochSubtraction.__table__, MultiEpochSubtraction.target_image_id == ScienceCoadd.id
+        ).join(
+            Detection.__table__, Detection.image_id == MultiEpochSubtraction.id
+        ).filter(
+            Detection.source_id.in_(source_ids)
+        ).group_by(Detection.source_id, ScienceCoadd.id)
+        for source_id, mindate, maxdate in rows:
+            multidates[source_id].append((mindate, maxdate))
+
+        lcs = Source.light_curves(source_ids)
+
+        stop = time.time()
+        print(f'took {stop - start:.2f} sec to get the histories of '
+              f'{len(source_ids)} sources', flush=True)
+
+        alerts = []
+        for detection in detections:
+            alert = cls._from_detection_and_history(
+                detection,
+                refstats.get(detection.image.reference_image_id,
+                             (None, None, 0)),
+                singledates[detection.source_id],
+                multidates[detection.source_id],
+                lcs[detection.source_id],
+                candidate=candidates.get(detection.id)
+                if candidates is not None else None
+            )
+            alerts.append(alert)
+
+        return alerts
+
+    @classmethod
+    def _from_detection_and_history(cls, detection, refstats, singledates,
+                                    multidates, lc, candidate=None):
+        """Assemble the alert packet of a detection. `refstats` are the
+        (first mjd, last mjd, count) of the reference image inputs,
+        `singledates` the mjds of all single-epoch detections of the
+        source, `multidates` the (first mjd, last mjd) of the inputs of all
+        stacks the source was detected on, and `lc` the source's light
+        curve. If `candidate` is given, it is used as the cross-match
+        output instead of calling `xmatch`."""
+
+        from .subtraction import SingleEpochSubtraction
+
+        obj = cls()
+
         # prepare the JSONB
         alert = dict()
         alert['objectId'] = detection.source.id
@@ -82,7 +304,10 @@ class Alert(Base):
         # do a bunch of cross matches to initially populate the candidate
         # subschema
         start = time.time()
-        candidate = xmatch(detection.ra, detection.dec, detection.source.id)
+        if candidate is None:
+            candidate = xmatch(detection.ra, detection.dec, detection.source.id)
+        else:
+            candidate = deepcopy(candidate)
         alert['candidate'] = candidate
         stop = time.time()
         print_time(start, stop, detection, 'xmatch')
@@ -140,21 +365,7 @@ class Alert(Base):
         stop = time.time()
         print_time(start, stop, detection, 'basic')
 
-        # information about the reference images
-
-        start = time.time()
-
-        refmin, refmax, refcount = DBSession().query(
-            sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
-            sa.func.max(ScienceImage.obsjd) - MJD_TO_JD,
-            sa.func.count(ScienceImage.id)
-        ).select_from(ScienceImage.__table__).join(
-            CoaddImage, ScienceImage.id == CoaddImage.calibratableimage_id
-        ).filter(
-            CoaddImage.coadd_id == detection.image.reference_image_id
-        ).first()
-        stop = time.time()
-        print_time(start, stop, detection, 'get refimgs')
+        refmin, refmax, refcount = refstats
 
         start = time.time()
 
@@ -192,45 +403,16 @@ class Alert(Base):
         else:
             mymjd = detection.image.target_image.max_mjd
 
-        # get dates of single epoch detections
-        singledates = DBSession().query(ScienceImage.obsjd - MJD_TO_JD).select_from(
-            ScienceImage.__table__
-        ).join(
-            SingleEpochSubtraction.__table__, SingleEpochSubtraction.target_image_id == ScienceImage.id
-        ).join(
-            Detection.__table__, Detection.image_id == SingleEpochSubtraction.id
-        ).filter(
-            Detection.source_id == detection.source.id
-        ).all()
-        singledates = list(sorted([date[0] for date in singledates if date[0] < mymjd]))
-
-        multidates = DBSession().query(sa.func.min(ScienceImage.obsjd) - MJD_TO_JD,
-                                       sa.func.max(ScienceImage.obsjd) - MJD_TO_JD
-        ).select_from(
-            ScienceImage.__table__
-        ).join(
-            CoaddImage, CoaddImage.calibratableimage_id == ScienceImage.id
-        ).join(
-            ScienceCoadd.__table__, ScienceCoadd.id == CoaddImage.coadd_id
-        ).join(
-            MultiEpochSubtraction.__table__, MultiEpochSubtraction.target_image_id == ScienceCoadd.id
-        ).join(
-            Detection.__table__, Detection.image_id == MultiEpochSubtraction.id
-        ).filter(
-            Detection.source_id == detection.source.id
-        ).group_by(ScienceCoadd.id)
+        singledates = list(sorted([date for date in singledates if date < mymjd]))
 
+        # sort on both ends of the stack window so the order does not depend
+        # on the order the database returned the stacks in
         multidates = list(sorted([date for date in multidates if date[0] < mymjd],
-                                 key=lambda d: d[1]))
+                                 key=lambda d: (d[1], d[0])))
 
         candidate['ndethist_single'] = len(singledates)
         candidate['ndethist_stack'] = len(multidates)
 
-        stop = time.time()
-        print_time(start, stop, detection, 'prevdets')
-
-        start = time.time()
-
         if len(singledates) > 0:
             starthist = singledates[0] + MJD_TO_JD
             endhist = singledates[-1] + MJD_TO_JD
@@ -252,12 +434,6 @@ class Alert(Base):
         stop = time.time()
         print_time(start, stop, detection, 'jdstarthist')
 
-        start = time.time()
-        # make the light curve
-        lc = detection.source.light_curve()
-        stop = time.time()
-        print_time(start, stop, detection, 'light_curve')
-
         if len(lc) == 0:
             raise RuntimeError('Cannot issue an alert for an object with no '
                                'light curve, please rerun forced photometry '
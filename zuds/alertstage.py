@@ -0,0 +1,174 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .core import DBSession
+from .secrets import get_secret
+from .send import AlertSender, load_alert_schema, encode_alert
+
+__all__ = ['AlertStage']
+
+
+def _config(key, default):
+    try:
+        value = get_secret(key)
+    except KeyError:
+        return default
+    return default if value is None else int(value)
+
+
+# schemas of the encoder processes, set by the pool initializer
+_WORKER_SCHEMAS = {}
+
+
+def _init_encoder(schemas):
+    _WORKER_SCHEMAS.update(schemas)
+
+
+def _encode(alert_type, record):
+    try:
+        schema = _WORKER_SCHEMAS[alert_type]
+    except KeyError:
+        schema = _WORKER_SCHEMAS[alert_type] = load_alert_schema(alert_type)
+    return encode_alert(record, schema)
+
+
+class AlertStage(object):
+    """Makes and sends the alerts of a list of detections, overlapping the
+    three parts of the work:
+
+    1. the cross-matches (network-bound) of all detections are started
+       up front on a pool of `nthreads` threads,
+    2. alerts are assembled in chunks of `chunk_size` detections with
+       `Alert.from_detections` as soon as the cross-matches of a chunk
+       are done, and committed,
+    3. packets are avro-encoded on a pool of `nprocs` processes (inline if
+       `nprocs` is 0) and handed to the `sender` as they complete.
+
+    At most `max_inflight` packets are waiting to be encoded or handed to
+    the sender at any time. When that limit is reached, assembly blocks
+    until the oldest packet has been queued on the sender, whose sink in
+    turn blocks while its delivery queue is full, so a slow broker
+    throttles the whole stage instead of letting encoded alerts pile up
+    in memory.
+
+    The defaults of the pool sizes and limits are read from the
+    `alert_xmatch_threads`, `alert_encode_processes`, `alert_max_inflight`
+    and `alert_chunk_size` keys of the configuration file, so that they
+    can be tuned per node."""
+
+    def __init__(self, sender=None, nthreads=None, nprocs=None,
+                 max_inflight=None, chunk_size=None):
+        self.sender = AlertSender() if sender is None else sender
+        self.nthreads = nthreads if nthreads is not None else \
+            _config('alert_xmatch_threads', 8)
+        self.nprocs = nprocs if nprocs is not None else \
+            _config('alert_encode_processes', 4)
+        self.max_inflight = max_inflight if max_inflight is not None else \
+            _config('alert_max_inflight', 512)
+        self.chunk_size = chunk_size if chunk_size is not None else \
+            _config('alert_chunk_size', 64)
+
+    def _queue(self, alert, encoder, inflight):
+        record = alert.to_dict()
+        alert_type = record['candidate']['alert_type']
+        if encoder is None:
+            value = _encode(alert_type, record)
+            self.sender.produce(alert, value=value)
+            return
+
+        inflight.append((alert, encoder.submit(_encode, alert_type, record)))
+        while len(inflight) > self.max_inflight:
+            self._drain_one(inflight)
+
+    def _drain_one(self, inflight):
+        alert, future = inflight.popleft()
+        self.sender.produce(alert, value=future.result())
+
+    @staticmethod
+    def _make_alerts(detection_ids, candidates):
+        # assemble and commit the alerts of a chunk of detections
+        from .alert import Alert
+
+        alerts = Alert.from_detections(detection_ids, candidates=candidates)
+        DBSession().add_all(alerts)
+        DBSession().commit()
+        return alerts
+
+    def _queue_alerts(self, todo, unsent, make_alerts):
+        # cross-match the (detection id, ra, dec, source id) rows `todo`,
+        # make their alerts a chunk at a time with `make_alerts(ids,
+        # candidates)`, and queue them and the alerts `unsent` on the
+        # sender, in that order
+        from .crossmatch import xmatch
+
+        encoder = None
+        if self.nprocs > 0:
+            encoder = ProcessPoolExecutor(
+                max_workers=self.nprocs, initializer=_init_encoder,
+                initargs=(self.sender.schemas,)
+            )
+
+        inflight = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+                xmatches = {
+                    detid: pool.submit(xmatch, ra, dec, source_id)
+                    for detid, ra, dec, source_id in todo
+                }
+
+                for alert in unsent:
+                    self._queue(alert, encoder, inflight)
+
+                for i in range(0, len(todo), self.chunk_size):
+                    chunk = [row[0] for row in todo[i:i + self.chunk_size]]
+                    candidates = {detid: xmatches.pop(detid).result()
+                                  for detid in chunk}
+                    for alert in make_alerts(chunk, candidates):
+                        self._queue(alert, encoder, inflight)
+
+            while len(inflight) > 0:
+                self._drain_one(inflight)
+        finally:
+            if encoder is not None:
+                encoder.shutdown()
+
+    def run(self, detection_ids):
+        """Make the missing alerts of `detection_ids`, send all of their
+        unsent alerts, and mark the delivered ones as sent. Returns the
+        list of delivered alerts."""
+
+        from .alert import Alert
+        from .detections import Detection
+
+        detection_ids = [int(i) for i in detection_ids]
+        start = time.time()
+
+        # detections that need an alert
+        todo = DBSession().query(
+            Detection.id, Detection.ra, Detection.dec, Detection.source_id
+        ).outerjoin(
+            Alert, Alert.detection_id == Detection.id
+        ).filter(
+            Detection.id.in_(detection_ids),
+            Alert.id == None
+        ).order_by(Detection.id).all()
+
+        # alerts that were made earlier but not sent
+        unsent = DBSession().query(Alert).filter(
+            Alert.detection_id.in_(detection_ids),
+            Alert.sent == False
+        ).all()
+
+        self._queue_alerts(todo, unsent, self._make_alerts)
+
+        delivered = self.sender.flush()
+        for alert in delivered:
+            alert.sent = True
+        DBSession().add_all(delivered)
+        DBSession().commit()
+
+        stop = time.time()
+        print(f'made {len(todo)} and sent {len(delivered)} alerts in '
+              f'{stop - start:.2f} sec', flush=True)
+        return delivered
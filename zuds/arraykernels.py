@@ -0,0 +1,88 @@
+import numpy as np
+
+from .constants import BIG_RMS
+
+__all__ = ['DATA_DTYPE', 'as_data_array', 'mask_dtype', 'saturated_pixels',
+           'weight_from_rms', 'rms_from_weight', 'add_constant']
+
+
+# dtype policy: quadrant-sized pixel arrays (images, weights, rms maps) are
+# native float32, like the ZTF images themselves. float64 is only used for
+# accumulations (e.g., zuds.CoaddAccumulator). bit masks use the narrowest
+# integer type FITS can store that holds their bits (see `mask_dtype`)
+DATA_DTYPE = np.dtype('float32')
+
+# integer types FITS images can hold (BITPIX 8, 16, 32, 64)
+MASK_DTYPES = [np.dtype('uint8'), np.dtype('int16'), np.dtype('int32'),
+               np.dtype('int64')]
+
+
+def as_data_array(data):
+    """`data` as a native float32 array, without a copy if it already is
+    one."""
+    return np.asarray(data, dtype=DATA_DTYPE)
+
+
+def mask_dtype(maxvalue):
+    """Narrowest FITS integer type that holds bit masks up to
+    `maxvalue`."""
+    for dtype in MASK_DTYPES:
+        if maxvalue <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f'No FITS integer type holds {maxvalue}.')
+
+
+def saturated_pixels(data, header, out=None):
+    """Boolean map of the pixels at or above 90% of the SATURATE level in
+    `header`, or None if the header has no SATURATE."""
+    try:
+        saturval = header['SATURATE']
+    except KeyError:
+        return None
+    return np.greater_equal(data, 0.9 * saturval, out=out)
+
+
+def _good(bad, saturated):
+    # pixels that are neither bad nor saturated, in one boolean buffer
+    if saturated is None:
+        return np.logical_not(bad)
+    good = np.logical_or(bad, saturated)
+    return np.logical_not(good, out=good)
+
+
+def weight_from_rms(rms, bad, saturated=None, out=None):
+    """Inverse variance map from the rms map `rms`: 1 / rms**2, and 0 on
+    `bad` and `saturated` pixels. Computed in place in the float32 buffer
+    `out` (allocated if None)."""
+    if out is None:
+        out = np.empty(rms.shape, dtype=DATA_DTYPE)
+    good = _good(bad, saturated)
+    out[...] = 0.
+    np.square(rms, out=out, where=good)
+    with np.errstate(divide='ignore'):
+        np.reciprocal(out, out=out, where=good)
+    return out
+
+
+def rms_from_weight(weight, bad, saturated=None, out=None, big=BIG_RMS):
+    """Rms map from the inverse variance map `weight`: 1 / sqrt(weight),
+    and `big` on `bad` and `saturated` pixels. Computed in place in the
+    float32 buffer `out` (allocated if None)."""
+    if out is None:
+        out = np.empty(weight.shape, dtype=DATA_DTYPE)
+    good = _good(bad, saturated)
+    out[...] = big
+    np.sqrt(weight, out=out, where=good)
+    with np.errstate(divide='ignore'):
+        np.reciprocal(out, out=out, where=good)
+    return out
+
+
+def add_constant(data, value):
+    """`data` + `value` as a float32 array, in place if `data` already is
+    one (e.g., adding BKG_VAL to a coadd)."""
+    data = as_data_array(data)
+    if not data.flags.writeable:
+        data = data.copy()
+    np.add(data, value, out=data, casting='unsafe')
+    return data
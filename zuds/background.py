@@ -0,0 +1,210 @@
+import numpy as np
+
+from .constants import BKG_BOX_SIZE, MASK_BORDER
+from .arraykernels import DATA_DTYPE
+from .secrets import get_secret
+
+__all__ = ['sample_grid', 'robust_statistics', 'estimate_background',
+           'background_meshes', 'evaluate_mesh', 'background_images',
+           'subtract_background']
+
+
+# image-wide background statistics are estimated from a regular grid of
+# about this many pixels. the median of n pixels is known to ~1.25 sigma /
+# sqrt(n), i.e., 0.5% of the rms for 2**16 pixels
+BACKGROUND_NSAMP = 2 ** 16
+
+# normalized median absolute deviation
+MAD_TO_SIGMA = 1.4826
+
+# two-sided 95% interval of the median
+CONFIDENCE_Z = 1.96
+
+# SExtractor BACK_FILTERSIZE
+FILTER_SIZE = 3
+
+# rows per block when evaluating full resolution maps
+BLOCK_ROWS = 256
+
+
+def _background_engine():
+    # the configured engine of background and background rms maps
+    try:
+        engine = get_secret('background_engine')
+    except KeyError:
+        engine = None
+    engine = engine or 'sextractor'
+
+    if engine not in ('sextractor', 'native'):
+        raise ValueError(f'Unknown background engine "{engine}", must be '
+                         f'"sextractor" or "native".')
+    return engine
+
+
+def sample_grid(shape, nsamp=BACKGROUND_NSAMP):
+    """Slices selecting a deterministic, regular grid of about `nsamp`
+    pixels of an image of `shape`: every step-th pixel of every step-th
+    row, starting half a step in. All pixels if `nsamp` is None or not
+    smaller than the image."""
+    ny, nx = shape
+    if nsamp is None or nsamp >= ny * nx:
+        return slice(None), slice(None)
+    step = max(1, int(np.sqrt(ny * nx / nsamp)))
+    start = step // 2
+    return slice(start, None, step), slice(start, None, step)
+
+
+def robust_statistics(values):
+    """Median, normalized median absolute deviation, and half width of the
+    distribution-free 95% confidence interval of the median (from its
+    order statistics) of the 1d array `values`, selected with
+    `np.partition` in linear time. `values` is reordered in place. All nan
+    if it is empty."""
+    n = len(values)
+    if n == 0:
+        return np.nan, np.nan, np.nan
+
+    mid = [(n - 1) // 2, n // 2]
+    half = CONFIDENCE_Z * np.sqrt(n) / 2
+    lo = max(0, int(np.floor((n - 1) / 2 - half)))
+    hi = min(n - 1, int(np.ceil((n - 1) / 2 + half)))
+
+    values.partition(sorted(set(mid + [lo, hi])))
+    median = 0.5 * (float(values[mid[0]]) + float(values[mid[1]]))
+    err = 0.5 * (float(values[hi]) - float(values[lo]))
+
+    dev = np.abs(values - median)
+    dev.partition(mid)
+    mad = 0.5 * (float(dev[mid[0]]) + float(dev[mid[1]]))
+    return median, MAD_TO_SIGMA * mad, err
+
+
+def estimate_background(data, good=None, nsamp=BACKGROUND_NSAMP, mask=None):
+    """Background level and rms of `data`: the median and normalized
+    median absolute deviation of its finite `good` pixels (all if None),
+    or of its pixels where the bit mask `mask` is 0, on the `sample_grid`
+    of about `nsamp` pixels. Returns them with the half width of the 95%
+    confidence interval of the level, which bounds the error made by
+    sampling."""
+    slices = sample_grid(data.shape, nsamp)
+    values = np.asarray(data[slices])
+    if good is not None:
+        values = values[np.asarray(good[slices])]
+    elif mask is not None:
+        values = values[np.asarray(mask[slices]) == 0]
+    # a copy, that can be partitioned in place
+    values = values[np.isfinite(values)]
+    return robust_statistics(values)
+
+
+def _fill_and_filter(mesh, filtersize):
+    from scipy.ndimage import median_filter
+
+    if np.isnan(mesh).all():
+        return np.zeros_like(mesh)
+    mesh[np.isnan(mesh)] = np.nanmedian(mesh)
+    return median_filter(mesh, size=filtersize, mode='nearest')
+
+
+def background_meshes(data, good=None, box=BKG_BOX_SIZE,
+                      filtersize=FILTER_SIZE, nsamp=None):
+    """Background and rms of `data` on a mesh of `box` x `box` pixel cells
+    (SExtractor BACK_SIZE): `estimate_background` of the good pixels of
+    each cell (all of them, or about `nsamp` per cell), median filtered
+    over `filtersize` cells (BACK_FILTERSIZE). Cells without good pixels
+    take the median of the others. Returns the two meshes."""
+    bkg, rms = _cell_statistics(data, good, box=box, nsamp=nsamp)
+    return _fill_and_filter(bkg, filtersize), _fill_and_filter(rms, filtersize)
+
+
+def _cell_statistics(data, good=None, box=BKG_BOX_SIZE, nsamp=None):
+    # unfiltered background and rms meshes (nan in cells without good
+    # pixels). works on any band of whole cells, so that the meshes of an
+    # image can be computed a band of `box` rows at a time
+    ny, nx = data.shape
+    my, mx = -(-ny // box), -(-nx // box)
+    bkg = np.full((my, mx), np.nan)
+    rms = np.full((my, mx), np.nan)
+    for j in range(my):
+        rows = slice(j * box, (j + 1) * box)
+        for i in range(mx):
+            cols = slice(i * box, (i + 1) * box)
+            cellgood = None if good is None else good[rows, cols]
+            bkg[j, i], rms[j, i], _ = estimate_background(
+                data[rows, cols], cellgood, nsamp=nsamp
+            )
+    return bkg, rms
+
+
+def _interpolation(n, m, box):
+    # neighboring cells and weights of the bilinear interpolation of n
+    # pixels between the centers of m cells, constant beyond the outer ones
+    t = np.clip((np.arange(n) + 0.5) / box - 0.5, 0, m - 1)
+    i0 = np.minimum(np.floor(t).astype(int), max(m - 2, 0))
+    i1 = np.minimum(i0 + 1, m - 1)
+    return i0, i1, t - i0
+
+
+def evaluate_mesh(mesh, shape, box=BKG_BOX_SIZE, out=None):
+    """Full resolution map of `shape` from the mesh of `box` x `box` pixel
+    cells `mesh`, bilinearly interpolated between the cell centers, into
+    the float32 buffer `out` (allocated if None). Computed a block of rows
+    at a time."""
+    ny, nx = shape
+    my, mx = mesh.shape
+    if out is None:
+        out = np.empty(shape, dtype=DATA_DTYPE)
+
+    x0, x1, wx = _interpolation(nx, mx, box)
+    y0, y1, wy = _interpolation(ny, my, box)
+    rowmesh = (1 - wx) * mesh[:, x0] + wx * mesh[:, x1]
+
+    for start in range(0, ny, BLOCK_ROWS):
+        rows = slice(start, min(start + BLOCK_ROWS, ny))
+        w = wy[rows, None]
+        out[rows] = (1 - w) * rowmesh[y0[rows]] + w * rowmesh[y1[rows]]
+    return out
+
+
+def _derived_image(image, data, suffix):
+    from .image import FITSImage
+
+    product = FITSImage()
+    product.basename = image.basename.replace('.fits', f'.{suffix}.fits')
+    product.data = data
+    product.header = image.header
+    product.header_comments = image.header_comments
+    # virtual: kept in memory, and only written to disk if a tool needs a
+    # file (see zuds.materialize)
+    return product
+
+
+def background_images(image, box=BKG_BOX_SIZE, filtersize=FILTER_SIZE):
+    """Native replacement for SExtractor's BACKGROUND and BACKGROUND_RMS
+    check images of the calibratable image `image`, from
+    `background_meshes` of the pixels that are not masked (nor, for
+    science images, within MASK_BORDER of the edge, as in
+    `prepare_sextractor`). Returns the background and rms maps as virtual
+    images named like SExtractor's."""
+    good = np.logical_not(image.mask_image.boolean.data)
+    if image.basename.endswith('sciimg.fits'):
+        good[:MASK_BORDER] = False
+        good[-MASK_BORDER:] = False
+        good[:, :MASK_BORDER] = False
+        good[:, -MASK_BORDER:] = False
+
+    bkgmesh, rmsmesh = background_meshes(image.data, good, box=box,
+                                         filtersize=filtersize)
+    shape = image.data.shape
+    return (_derived_image(image, evaluate_mesh(bkgmesh, shape, box), 'bkg'),
+            _derived_image(image, evaluate_mesh(rmsmesh, shape, box), 'rms'))
+
+
+def subtract_background(image, background=None):
+    """Native replacement for SExtractor's -BACKGROUND check image: a
+    virtual copy of `image` minus `background` (by default, the first of
+    `background_images`)."""
+    if background is None:
+        background = background_images(image)[0]
+    data = np.subtract(image.data, background.data, dtype=DATA_DTYPE)
+    return _derived_image(image, data, 'bkgsub')
@@ -0,0 +1,130 @@
+import numpy as np
+
+from .constants import BAD_SUM
+from .arraykernels import mask_dtype
+
+__all__ = ['BitMask']
+
+
+# rows per block of the blockwise operations: temporaries are at most this
+# many rows of the mask (~3 MB for a ZTF quadrant in int32)
+BLOCK_ROWS = 256
+
+
+def _blocks(nrows, size=BLOCK_ROWS):
+    for start in range(0, nrows, size):
+        yield slice(start, min(start + size, nrows))
+
+
+def _as_dtype(bits, dtype):
+    # `bits` as a scalar of the integer type `dtype`, keeping only the bits
+    # it can hold (as numpy refuses python ints out of its range)
+    nbits = 8 * dtype.itemsize
+    unsigned = np.dtype(f'u{dtype.itemsize}')
+    return np.asarray(bits & (2 ** nbits - 1), dtype=unsigned).astype(
+        dtype.newbyteorder('='), casting='unsafe'
+    )[()]
+
+
+class BitMask(object):
+    """A bit mask image (e.g., the data of a `zuds.MaskImage`) held as one
+    integer array in the narrowest FITS integer type that holds its bits,
+    so that it can be saved and loaded as mask images always have been.
+
+    Bits are set, merged and tested in place, a block of rows at a time,
+    so that no operation allocates a temporary the size of the mask. The
+    array is shared, not copied, unless it has to be widened to hold a new
+    bit or converted from floats (e.g., masks coadded by SWarp)."""
+
+    def __init__(self, data):
+        data = np.asarray(data)
+        if data.dtype.kind not in 'iu':
+            maxvalue = int(np.max(data)) if data.size > 0 else 0
+            data = data.astype(mask_dtype(maxvalue))
+        self.data = data
+
+    @classmethod
+    def union(cls, masks, maxbit=None):
+        """OR of the integer arrays `masks`, in a new mask wide enough to
+        also hold bits up to `maxbit` (e.g., bits that will be set later)
+        without another copy."""
+        masks = [cls(m).data for m in masks]
+        dtype = np.result_type(*masks)
+        if maxbit is not None:
+            wide = mask_dtype(2 ** (maxbit + 1) - 1)
+            dtype = np.promote_types(dtype, wide)
+        out = cls(np.zeros(masks[0].shape, dtype=dtype.newbyteorder('=')))
+        for m in masks:
+            out.merge(m)
+        return out
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def _widen(self, bits):
+        # make the array wide enough to hold `bits` on top of what it holds
+        if bits > np.iinfo(self.data.dtype).max:
+            maxvalue = bits | np.iinfo(self.data.dtype).max
+            self.data = self.data.astype(mask_dtype(maxvalue))
+
+    def any(self, bits=BAD_SUM, out=None):
+        """Boolean map of the pixels that have any of `bits` set (by
+        default, the pixels that are bad for science). Computed into the
+        boolean buffer `out` (allocated if None)."""
+        if out is None:
+            out = np.empty(self.shape, dtype=bool)
+        bits = _as_dtype(bits, self.data.dtype)
+        for rows in _blocks(self.shape[0]):
+            np.not_equal(np.bitwise_and(self.data[rows], bits), 0,
+                         out=out[rows])
+        return out
+
+    def plane(self, bit, packed=False):
+        """Boolean map of the pixels that have `bit` set. If `packed`, it is
+        bit-packed along rows with `np.packbits` (1 bit per pixel), and can
+        be restored with `np.unpackbits(plane, axis=1, count=nx)`."""
+        plane = self.any(2 ** bit)
+        if packed:
+            plane = np.packbits(plane, axis=1)
+        return plane
+
+    def set(self, bits, where=None):
+        """Set `bits` on the pixels where the boolean map `where` is True
+        (on all pixels if None), in place."""
+        self._widen(bits)
+        bits = _as_dtype(bits, self.data.dtype)
+        for rows in _blocks(self.shape[0]):
+            block = self.data[rows]
+            np.bitwise_or(block, bits, out=block,
+                          where=True if where is None else where[rows])
+        return self
+
+    def merge(self, other):
+        """OR the bits of `other` (a `BitMask` or integer array) into this
+        mask, in place."""
+        other = other.data if isinstance(other, BitMask) else \
+            BitMask(other).data
+        if not np.can_cast(other.dtype, self.data.dtype):
+            self.data = self.data.astype(np.result_type(self.data, other))
+        for rows in _blocks(self.shape[0]):
+            block = self.data[rows]
+            np.bitwise_or(block, other[rows], out=block)
+        return self
+
+    def flags_in(self, apertures):
+        """OR of the bits under each of `apertures` (photutils
+        `ApertureMask`s, e.g., from `Aperture.to_mask`), over its bounding
+        box as with `np.bitwise_or.reduce` on the aperture's cutout, but
+        reduced on views of the mask rather than copies. Apertures off the
+        mask get 0."""
+        flags = []
+        for aperture in apertures:
+            slices, _ = aperture.get_overlap_slices(self.shape)
+            if slices is None:
+                flags.append(0)
+            else:
+                flags.append(int(np.bitwise_or.reduce(
+                    self.data[slices], axis=None
+                )))
+        return flags
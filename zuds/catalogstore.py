@@ -0,0 +1,280 @@
+import os
+import numpy as np
+from pathlib import Path
+
+from .secrets import get_secret
+from .constants import ACTIVE_FIELDS
+
+__all__ = ['LocalCatalog', 'CatalogStore', 'get_catalog_store',
+           'active_quadrant_centers', 'snapshot_kowalski_catalog']
+
+
+# HEALPix resolution of the on-disk partitions (~0.92 deg pixels)
+STORE_NSIDE = 64
+
+
+def _radec_to_xyz(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cosd = np.cos(dec)
+    return np.stack([cosd * np.cos(ra), cosd * np.sin(ra), np.sin(dec)],
+                    axis=-1)
+
+
+def _chord(radius_deg):
+    return 2 * np.sin(np.radians(radius_deg) / 2)
+
+
+def _lookup(record, key):
+    # resolve dotted keys (e.g., candidate.ra) in nested kowalski records
+    for part in key.split('.'):
+        if record is None:
+            return None
+        record = record.get(part)
+    return record
+
+
+def _as_column(values):
+    # object arrays cannot be memory mapped, so missing values become NaN
+    # in numeric columns and empty strings in text columns
+    arr = np.asarray(values)
+    if arr.dtype != object:
+        return arr
+    try:
+        return np.asarray([np.nan if v is None else v for v in values],
+                          dtype=float)
+    except (TypeError, ValueError):
+        return np.asarray(['' if v is None else str(v) for v in values])
+
+
+class LocalCatalog(object):
+    """A snapshot of an external catalog stored on local disk.
+
+    Rows are partitioned into nested HEALPix pixels. Each pixel is a
+    directory holding one .npy file per column, which are memory mapped
+    on read, so cone searches only touch the pixels (and the columns)
+    they need. Every catalog stores `ra` and `dec` in degrees."""
+
+    def __init__(self, root, name, nside=STORE_NSIDE):
+        self.name = name
+        self.nside = nside
+        self.path = Path(root) / name / f'nside{nside}'
+
+    @property
+    def healpix(self):
+        from astropy_healpix import HEALPix
+        return HEALPix(nside=self.nside, order='nested')
+
+    @property
+    def exists(self):
+        return self.path.exists()
+
+    def _pixdir(self, pix):
+        return self.path / f'{pix:06d}'
+
+    def _read_pixel(self, pix, columns=None):
+        pixdir = self._pixdir(pix)
+        if not pixdir.exists():
+            return None
+        if columns is None:
+            columns = [p.name[:-4] for p in pixdir.glob('*.npy')]
+        return {c: np.load(pixdir / f'{c}.npy', mmap_mode='r')
+                for c in columns}
+
+    def _write_pixel(self, pix, data):
+        pixdir = self._pixdir(pix)
+        pixdir.mkdir(parents=True, exist_ok=True)
+        for column, values in data.items():
+            path = pixdir / f'{column}.npy'
+            tmppath = pixdir / f'{column}.{os.getpid()}.tmp'
+            with open(tmppath, 'wb') as f:
+                np.save(f, np.asarray(values))
+            os.replace(tmppath, path)
+
+    def ingest(self, data, key=None):
+        """Add rows to the catalog. `data` is a dict of equal-length column
+        arrays that must include `ra` and `dec`. Rows are merged into the
+        pixels they fall in; if `key` names a column, rows whose key is
+        already present in a pixel replace the stored ones."""
+        from astropy import units as u
+
+        data = {k: np.asarray(v) for k, v in data.items()}
+        pix = self.healpix.lonlat_to_healpix(data['ra'] * u.deg,
+                                             data['dec'] * u.deg)
+
+        for p in np.unique(pix):
+            sel = pix == p
+            new = {k: v[sel] for k, v in data.items()}
+            old = self._read_pixel(int(p), columns=list(new))
+            if old is not None:
+                keep = np.ones(len(old['ra']), dtype=bool)
+                if key is not None:
+                    keep = ~np.isin(old[key], new[key])
+                new = {k: np.concatenate([np.asarray(old[k])[keep], new[k]])
+                       for k in new}
+            self._write_pixel(int(p), new)
+
+    def _pixels_for(self, ra, dec, radius):
+        from astropy import units as u
+        hp = self.healpix
+        if radius < hp.pixel_resolution.to('deg').value / 2:
+            # a small cone is covered by its own pixel and its neighbours
+            pix = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)
+            neighbours = hp.neighbours(pix).ravel()
+            allpix = np.concatenate([pix, neighbours[neighbours >= 0]])
+        else:
+            allpix = np.concatenate([
+                hp.cone_search_lonlat(r * u.deg, d * u.deg, radius * u.deg)
+                for r, d in zip(ra, dec)
+            ])
+        return np.unique(allpix)
+
+    def cone_search(self, ra, dec, radius, columns=None):
+        """Find all catalog rows within `radius` degrees of each of the
+        positions (`ra`, `dec`).
+
+        Returns an astropy Table with one row per match, sorted by query
+        and then by separation. The column `query_index` gives the index
+        of the query position and `sep` the separation in arcsec."""
+        from astropy.table import Table
+        from scipy.spatial import cKDTree
+
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+
+        if columns is not None:
+            columns = list(dict.fromkeys(['ra', 'dec'] + list(columns)))
+
+        chunks = []
+        for p in self._pixels_for(ra, dec, radius):
+            chunk = self._read_pixel(int(p), columns=columns)
+            if chunk is not None:
+                chunks.append(chunk)
+
+        if len(chunks) == 0:
+            names = ['query_index', 'sep'] + (columns or ['ra', 'dec'])
+            return Table(names=names,
+                         dtype=[int, float] + [float] * (len(names) - 2))
+
+        cat = {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+        tree = cKDTree(_radec_to_xyz(cat['ra'], cat['dec']))
+        qxyz = _radec_to_xyz(ra, dec)
+        hits = tree.query_ball_point(qxyz, _chord(radius))
+
+        qind = np.repeat(np.arange(len(ra)), [len(h) for h in hits])
+        cind = np.fromiter((i for h in hits for i in h), dtype=int,
+                           count=len(qind))
+
+        chord = np.linalg.norm(_radec_to_xyz(cat['ra'][cind],
+                                             cat['dec'][cind]) -
+                               qxyz[qind], axis=-1)
+        sep = np.degrees(2 * np.arcsin(chord / 2)) * 3600.
+
+        order = np.lexsort((sep, qind))
+        result = Table({'query_index': qind[order], 'sep': sep[order]})
+        for k in cat:
+            result[k] = cat[k][cind[order]]
+        return result
+
+
+class CatalogStore(object):
+    """Collection of `LocalCatalog` snapshots rooted at one directory."""
+
+    def __init__(self, root, nside=STORE_NSIDE):
+        self.root = Path(root)
+        self.nside = nside
+
+    def __getitem__(self, name):
+        return LocalCatalog(self.root, name, nside=self.nside)
+
+    def has(self, name):
+        return self[name].exists
+
+    def cone_search(self, name, ra, dec, radius, columns=None):
+        return self[name].cone_search(ra, dec, radius, columns=columns)
+
+
+def get_catalog_store():
+    """Return the `CatalogStore` in the `local_catalog_dir` configured in
+    the secrets file, or None if no local store is configured."""
+    try:
+        root = get_secret('local_catalog_dir')
+    except KeyError:
+        return None
+
+    if root is None:
+        return None
+    return CatalogStore(root)
+
+
+def active_quadrant_centers(fields=ACTIVE_FIELDS):
+    """Mean position of every (field, ccdid, qid) of `fields` that has a
+    science image in the database, as two arrays of ra and dec."""
+    import sqlalchemy as sa
+    from .core import DBSession
+    from .image import ScienceImage
+
+    rows = DBSession().query(
+        sa.func.avg(ScienceImage.ra), sa.func.avg(ScienceImage.dec)
+    ).filter(
+        ScienceImage.field.in_(list(fields))
+    ).group_by(
+        ScienceImage.field, ScienceImage.ccdid, ScienceImage.qid
+    ).all()
+
+    ra = np.asarray([r[0] for r in rows], dtype=float)
+    dec = np.asarray([r[1] for r in rows], dtype=float)
+    return ra, dec
+
+
+def snapshot_kowalski_catalog(store, catalog, projection, ra, dec, radius,
+                              catalog_filter=None, ra_key='ra',
+                              dec_key='dec', key='_id', kowalski=None):
+    """Copy the rows of the Kowalski catalog `catalog` within `radius`
+    degrees of the positions (`ra`, `dec`) into the local catalog of the
+    same name in `store`.
+
+    `projection` lists the columns to keep. The columns named by `ra_key`
+    and `dec_key` (which may be dotted paths into nested records) are
+    stored as `ra` and `dec`. Rows are deduplicated on `key`."""
+    from .crossmatch import logon
+
+    if kowalski is None:
+        kowalski = logon()
+
+    fields = list(dict.fromkeys([key, ra_key, dec_key] + list(projection)))
+    columns = {f: [] for f in fields}
+
+    for r, d in zip(np.atleast_1d(ra), np.atleast_1d(dec)):
+        q = {"query_type": "cone_search",
+             "object_coordinates": {
+                 "radec": [(float(r), float(d))],
+                 "cone_search_radius": f"{radius}",
+                 "cone_search_unit": "deg"
+             },
+             "catalogs": {
+                 catalog: {
+                     "filter": catalog_filter or {},
+                     "projection": {f: 1 for f in fields}
+                 }
+             },
+             "kwargs": {}
+             }
+        result = kowalski.query(query=q)
+        if result['status'] != 'done':
+            raise ValueError(f'Kowalski Error: {result}')
+
+        for matches in result['result_data'][catalog].values():
+            for match in matches:
+                for f in fields:
+                    columns[f].append(_lookup(match, f))
+
+    data = {f: _as_column(v) for f, v in columns.items()}
+    data['ra'] = data.pop(ra_key).astype(float)
+    data['dec'] = data.pop(dec_key).astype(float)
+
+    _, uniq = np.unique(data[key], return_index=True)
+    data = {k: v[uniq] for k, v in data.items()}
+
+    store[catalog].ingest(data, key=key)
+    return len(uniq)
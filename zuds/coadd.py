@@ -8,6 +8,7 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
 from .core import DBSession
+from .secrets import get_secret
 from .constants import GROUP_PROPERTIES
 from .utils import ensure_images_have_the_same_properties
 from .seeing import estimate_seeing
@@ -18,11 +19,44 @@ from .archive import archive
 __all__ = ['Coadd', 'ReferenceImage', 'ScienceCoadd']
 
 
+def _coadd_engine(engine=None):
+    # `engine`, or the configured coadd engine
+    if engine is None:
+        try:
+            engine = get_secret('coadd_engine')
+        except KeyError:
+            engine = None
+        engine = engine or 'swarp'
+
+    if engine not in ('swarp', 'native', 'incremental'):
+        raise ValueError(f'Unknown coadd engine "{engine}", must be "swarp", '
+                         f'"native" or "incremental".')
+    return engine
+
+
 def _coadd_from_images(cls, images, outfile_name, nthreads=1, data_product=False,
                        tmpdir='/tmp', copy_inputs=False, swarp_kws=None,
-                       calculate_seeing=True, addbkg=True):
-    """Make a coadd from a bunch of input images"""
+                       calculate_seeing=True, addbkg=True, engine=None,
+                       combine='clipped', mask_combine='and'):
+    """Make a coadd from a bunch of input images.
+
+    `engine` is 'swarp', 'native' (`zuds.run_native_coadd`, in process)
+    or 'incremental' (`zuds.accumulate_coadd`, in process, keeping running
+    sums next to the coadd so that inputs can later be added or removed
+    one at a time with `update_inputs`). It defaults to `coadd_engine` from
+    the configuration file, or swarp. `combine` is the combine type of the
+    native engine (swarp always uses the CLIPPED combine of
+    astromatic/makecoadd/default.swarp). The masks of the inputs are
+    combined with a bitwise AND (a pixel is flagged only if every input
+    covering it flags it) or, if `mask_combine` is 'or', a bitwise OR."""
     from .swarp import run_coadd
+    from .stacking import run_native_coadd
+    from .accumulator import accumulate_coadd
+
+    engine = _coadd_engine(engine)
+    if mask_combine not in ('and', 'or'):
+        raise ValueError(f'Unknown mask combine type "{mask_combine}", must '
+                         f'be "and" or "or".')
 
     images = np.atleast_1d(images)
     mskoutname = outfile_name.replace('.fits', '.mask.fits')
@@ -42,11 +76,20 @@ def _coadd_from_images(cls, images, outfile_name, nthreads=1, data_product=False
     # make sure all images have the same field, filter, ccdid, qid:
     ensure_images_have_the_same_properties(images, properties)
 
-    # call swarp
-    coadd = run_coadd(cls, images, outfile_name, mskoutname,
-                      addbkg=addbkg, nthreads=nthreads,
-                      tmpdir=tmpdir, copy_inputs=copy_inputs,
-                      swarp_kws=swarp_kws)
+    if engine == 'native':
+        coadd = run_native_coadd(cls, images, outfile_name, mskoutname,
+                                 addbkg=addbkg, nthreads=nthreads,
+                                 combine=combine, mask_combine=mask_combine)
+    elif engine == 'incremental':
+        coadd = accumulate_coadd(cls, images, outfile_name, mskoutname,
+                                 addbkg=addbkg, nthreads=nthreads,
+                                 mask_combine=mask_combine)
+    else:
+        # call swarp
+        coadd = run_coadd(cls, images, outfile_name, mskoutname,
+                          addbkg=addbkg, nthreads=nthreads,
+                          tmpdir=tmpdir, copy_inputs=copy_inputs,
+                          swarp_kws=swarp_kws, mask_combine=mask_combine)
     coaddmask = coadd.mask_image
 
     coadd.header['FIELD'] = coadd.field = images[0].field
@@ -114,6 +157,23 @@ class Coadd(CalibratableImage):
 
     from_images = classmethod(_coadd_from_images)
 
+    def update_inputs(self, add=(), remove=(), nthreads=1,
+                      calculate_seeing=True):
+        """Add the images `add` to and remove the images `remove` from the
+        inputs of this coadd, resampling only those images, and update the
+        coadd on disk and `input_images` (see `zuds.update_coadd_inputs`).
+        The session must be committed to record the new inputs."""
+        from .accumulator import update_coadd_inputs
+
+        images = list(add) + list(remove)
+        ensure_images_have_the_same_properties([self] + images,
+                                               GROUP_PROPERTIES)
+        update_coadd_inputs(self, add=add, remove=remove, nthreads=nthreads)
+
+        if calculate_seeing:
+            estimate_seeing(self)
+            self.save()
+
 
 class ReferenceImage(Coadd):
     id = sa.Column(sa.Integer, sa.ForeignKey('coadds.id', ondelete='CASCADE'),
@@ -1,11 +1,12 @@
 import sys
 import numpy as np
 import traceback
-import math
 import psycopg2
 import os
 
 from .secrets import get_secret
+from .sgscore import sgtable_strip, get_sgscore_index
+from .catalogstore import get_catalog_store
 
 __all__ = ['xmatch']
 
@@ -73,14 +74,36 @@ def getsgtable(dec):
     """
     # Danny: add path to table here
 
+    base = f"hlsp_ps1-psc_ps1_gpc1_{sgtable_strip(dec):d}_multi_v1_cat.fits"
+    return os.path.join(get_secret('ps1_dir'), base)
 
+def lookup_sgscores(objids, decs, dec):
+    """Get the PS1 sgscores of `objids`, NaN where there is no score.
 
-    if dec >= 0:
-        base = f"hlsp_ps1-psc_ps1_gpc1_{math.floor(dec):d}_multi_v1_cat.fits"
-    else:
-        base = f"hlsp_ps1-psc_ps1_gpc1_{math.floor(dec)+1:d}_multi_v1_cat.fits"
+    Reads the memory-mapped index if one has been built (see
+    build_sgscore_index), otherwise loads the sgscore table that
+    corresponds to the source declination `dec`."""
+    from astropy.io import fits
+
+    index = get_sgscore_index()
+    if index is not None:
+        return index.lookup([int(o) for o in objids], decs)
+
+    if len(objids) == 0:
+        return np.asarray([])
+
+    tab = getsgtable(dec)
+    with fits.open(tab) as F:
+        objid = F[1].data['objid']
+        ps_score = F[1].data['ps_score']
+    sgscores = []
+    for oid in objids:
+        try:
+            sgscores.append(float(ps_score[objid == int(oid)][0]))
+        except:
+            sgscores.append(np.nan)
+    return np.asarray(sgscores)
 
-    return os.path.join(get_secret('ps1_dir'), base)
 
 def ps1(s, ra, dec):
     """ Cross-match a position against PS1 DR1
@@ -103,7 +126,6 @@ def ps1(s, ra, dec):
     """
     # Coordinates of source
     from astropy.coordinates import SkyCoord
-    from astropy.io import fits
 
     c1 = SkyCoord(ra, dec, unit='deg')
 
@@ -144,11 +166,10 @@ def ps1(s, ra, dec):
     order = np.argsort(dist)
     closest_matches = matches[order][0:3]
 
-    # Load the sgscore table that corresponds to this declination
-    tab = getsgtable(dec)
-    with fits.open(tab) as F:
-        objid = F[1].data['objid']
-        ps_score = F[1].data['ps_score']
+    nclose = len(closest_matches)
+    sgscores = lookup_sgscores([m['_id'] for m in matches[:nclose]],
+                               [m['decMean'] for m in matches[:nclose]],
+                               dec)
 
     # Return the closest three matches as a dictionary
     out = {}
@@ -158,9 +179,9 @@ def ps1(s, ra, dec):
             out['objectidps%s' % (ii + 1)] = oid
         except:
             out['objectidps%s' % (ii + 1)] = -999
-        try:
-            out['sgscore%s' % (ii + 1)] = float(ps_score[objid==int(oid)][0])
-        except:
+        if np.isfinite(sgscores[ii]):
+            out['sgscore%s' % (ii + 1)] = float(sgscores[ii])
+        else:
             out['sgscore%s' % (ii + 1)] = -999
         try:
             out['distpsnr%s' % (ii + 1)] = float(dist[order][ii])
@@ -383,9 +404,84 @@ def tns(s, ra, dec):
     return names
 
 
+# columns of the local PS1 DR1 snapshot used by `ps1_local`
+PS1_LOCAL_COLUMNS = ['_id'] + [f'{band}MeanPSFMag' for band in 'griz']
+
+
+def ps1_local(store, ra, dec):
+    """ Cross-match a position against the local PS1 DR1 snapshot
+
+    Same output as `ps1`, but served from the `PS1_DR1` catalog of a
+    local `CatalogStore`: -999 for missing magnitudes, and an empty
+    dictionary if there is no match (e.g., outside of the snapshot).
+
+    Parameters
+    ----------
+    store: CatalogStore holding a PS1_DR1 snapshot
+    ra: RA of the source in decimal degrees
+    dec: Dec of the source in decimal degrees
+
+    Returns
+    -------
+    out: dictionary containing info on closest three matches within 30 arcsec
+    """
+    matches = store.cone_search('PS1_DR1', ra, dec, 30 / 3600.,
+                                columns=PS1_LOCAL_COLUMNS)[:3]
+    if len(matches) == 0:
+        return {}
+    sgscores = lookup_sgscores(matches['_id'], matches['dec'], dec)
+
+    out = {}
+    for ii, match in enumerate(matches):
+        out['objectidps%s' % (ii + 1)] = int(match['_id'])
+        if np.isfinite(sgscores[ii]):
+            out['sgscore%s' % (ii + 1)] = float(sgscores[ii])
+        else:
+            out['sgscore%s' % (ii + 1)] = -999
+        out['distpsnr%s' % (ii + 1)] = float(match['sep'])
+        for band in 'griz':
+            mag = float(match['%sMeanPSFMag' % band])
+            out['ps%smag%s' % (band, ii + 1)] = mag if np.isfinite(mag) \
+                else -999
+    return out
+
+
+def names_local(store, catalog, column, ra, dec):
+    """ Cross-match candidate position with a local catalog snapshot
+
+    Parameters
+    ----------
+    store: CatalogStore holding a snapshot of `catalog`
+    catalog: name of the catalog, e.g. milliquas_v6
+    column: name of the column holding the IDs to return
+    ra: RA in decimal degrees
+    dec: Dec in decimal degrees
+
+    Returns
+    -------
+    names (np array): list of IDs for any sources within 1.5 arcsec
+    """
+    matches = store.cone_search(catalog, ra, dec, 1.5 / 3600.,
+                                columns=[column])
+    return np.unique(np.asarray(matches[column]).astype(str))
+
+
+# catalogs that can be served from a local snapshot, and the kowalski
+# cross-match that is used otherwise
+KOWALSKI_XMATCHES = {
+    'ztfname': ('ZTF_alerts', 'objectId', ztfalerts),
+    'mqid': ('milliquas_v6', 'Name', milliquas),
+    'tnsid': ('TNS', 'name', tns)
+}
+
+
 def xmatch(ra, dec, source_id):
     """ Cross-match against all necessary catalogs
 
+    Catalogs that have a snapshot in the local catalog store (see
+    `local_catalog_dir`) are cross-matched locally. Kowalski is only
+    contacted for the remaining ones.
+
     Parameters
     ----------
     ra: RA of source in decimal degrees
@@ -396,17 +492,32 @@ def xmatch(ra, dec, source_id):
     out: dictionary of alert catalog fields
     """
 
-    # Connect to Kowalski and to private
-    s = logon()
+    store = get_catalog_store()
+    local = set()
+    if store is not None:
+        local = {name for name in ['PS1_DR1'] + [
+            v[0] for v in KOWALSKI_XMATCHES.values()
+        ] if store.has(name)}
+
+    # Connect to Kowalski (if needed) and to private
+    s = logon() if len(local) < len(KOWALSKI_XMATCHES) + 1 else None
     cur = private_logon()
 
-    out = ps1(s, ra, dec)
+    if 'PS1_DR1' in local:
+        out = ps1_local(store, ra, dec)
+    else:
+        out = ps1(s, ra, dec)
     out.update(legacysurvey(cur, ra, dec, source_id))
-    out['ztfname'] = ','.join(ztfalerts(s, ra, dec))
-    out['mqid'] = ','.join(milliquas(s, ra, dec))
-    out['tnsid'] = ','.join(tns(s, ra, dec))
 
-    s.close()
+    for key, (catalog, column, remote) in KOWALSKI_XMATCHES.items():
+        if catalog in local:
+            names = names_local(store, catalog, column, ra, dec)
+        else:
+            names = remote(s, ra, dec)
+        out[key] = ','.join(names)
+
+    if s is not None:
+        s.close()
     cur.connection.close()
 
     return out
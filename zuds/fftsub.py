@@ -0,0 +1,396 @@
+import numpy as np
+
+from .constants import BIG_RMS
+
+__all__ = ['kernel_basis', 'fft_convolve', 'fit_kernel', 'fft_subtraction',
+           'fft_subtract', 'template_stamps']
+
+
+# hotpants' default gaussian basis (-ngauss 3 6 0.7 4 1.5 2 3.0)
+GAUSS_SIGMAS = (0.7, 1.5, 3.0)
+GAUSS_DEGREES = (6, 4, 2)
+
+# value hotpants writes into masked output pixels
+MASKED_VALUE = 1e-30
+
+
+def _good_size(n):
+    # smallest 2, 3, 5-smooth integer >= n, a fast length for the FFT
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def kernel_basis(hw, sigmas=GAUSS_SIGMAS, degrees=GAUSS_DEGREES):
+    """Alard & Lupton (1998) kernel basis: gaussians of width `sigmas`
+    multiplied by polynomials in x and y up to `degrees`, on a
+    (2 hw + 1)^2 grid.
+
+    The first function has unit sum and carries the photometric scaling;
+    all others are made to sum to zero, so the flux scaling of a kernel is
+    the coefficient of the first function. Returns an array of shape
+    (nbasis, 2 hw + 1, 2 hw + 1)."""
+
+    y, x = np.mgrid[-hw:hw + 1, -hw:hw + 1].astype(float)
+    basis = []
+    for sigma, degree in zip(sigmas, degrees):
+        g = np.exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2))
+        for i in range(degree + 1):
+            for j in range(degree + 1 - i):
+                basis.append(g * x ** i * y ** j)
+
+    basis = np.asarray(basis)
+    basis[0] /= basis[0].sum()
+    for b in basis[1:]:
+        total = b.sum()
+        if abs(total) > 1e-10 * np.abs(b).sum():
+            b /= total
+            b -= basis[0]
+        b /= np.sqrt((b ** 2).sum())
+    return basis
+
+
+def fft_convolve(image, kernel):
+    """Convolve the last two axes of `image` with those of `kernel` (both
+    may be stacks that broadcast against each other) using real FFTs.
+    Returns the 'same'-sized result; pixels beyond the edges are zero."""
+    ny, nx = image.shape[-2:]
+    ky, kx = kernel.shape[-2:]
+    shape = (_good_size(ny + ky - 1), _good_size(nx + kx - 1))
+    f = np.fft.rfft2(image, shape) * np.fft.rfft2(kernel, shape)
+    full = np.fft.irfft2(f, shape)
+    return full[..., ky // 2:ky // 2 + ny, kx // 2:kx // 2 + nx]
+
+
+def _window_sum(a, h):
+    # sum of `a` over the (2h + 1)^2 window centered on each pixel (zero
+    # outside the image), from a summed-area table
+    ny, nx = a.shape
+    c = np.zeros((ny + 1, nx + 1))
+    c[1:, 1:] = np.cumsum(np.cumsum(a, axis=0), axis=1)
+    y0 = np.clip(np.arange(ny) - h, 0, ny)
+    y1 = np.clip(np.arange(ny) + h + 1, 0, ny)
+    x0 = np.clip(np.arange(nx) - h, 0, nx)
+    x1 = np.clip(np.arange(nx) + h + 1, 0, nx)
+    return c[y1][:, x1] - c[y0][:, x1] - c[y1][:, x0] + c[y0][:, x0]
+
+
+def _find_stamps(snr, usable, hs, region, nstamps, min_snr=10.):
+    """Centers of up to `nstamps` bright, isolated stamps in `region`
+    (y0, y1, x0, x1), brightest first. `usable` marks the pixels that
+    can be the center of a stamp whose pixels (and the template pixels
+    under the kernel) are all good."""
+    from scipy.ndimage import maximum_filter
+
+    y0, y1, x0, x1 = region
+    s = snr[y0:y1, x0:x1]
+    peaks = (s == maximum_filter(s, size=5)) & (s > min_snr) & \
+        usable[y0:y1, x0:x1]
+    py, px = np.nonzero(peaks)
+    order = np.argsort(s[py, px])[::-1]
+
+    centers = []
+    for i in order:
+        cy, cx = py[i] + y0, px[i] + x0
+        if all(abs(cy - oy) > hs or abs(cx - ox) > hs for oy, ox in centers):
+            centers.append((cy, cx))
+            if len(centers) == nstamps:
+                break
+    return centers
+
+
+def template_stamps(ref, refrms, bad, hw, hs, nreg_side=3, nstamps=60):
+    """Centers (y, x) of the bright isolated stamps of a template `ref`
+    with rms `refrms`, up to `nstamps` in each of the nreg_side x
+    nreg_side regions, avoiding the pixels flagged in `bad` by the kernel
+    half width `hw` plus the stamp half width `hs`."""
+    from scipy.ndimage import binary_dilation
+
+    ref = np.asarray(ref, dtype=float)
+    refrms = np.asarray(refrms, dtype=float)
+    with np.errstate(invalid='ignore'):
+        bad = np.asarray(bad, dtype=bool) | ~np.isfinite(ref) | \
+            ~(refrms > 0)
+
+    footprint = np.ones((2 * hw + 1, 2 * hw + 1), dtype=bool)
+    usable = _window_sum(binary_dilation(bad, structure=footprint)
+                         .astype(float), hs) == 0
+    edge = hs + hw
+    usable[:edge] = usable[-edge:] = False
+    usable[:, :edge] = usable[:, -edge:] = False
+
+    level = np.median(ref[~bad]) if (~bad).any() else 0.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        snr = np.where(bad, 0., (ref - level) / refrms)
+
+    ny, nx = ref.shape
+    yb = np.linspace(0, ny, nreg_side + 1).astype(int)
+    xb = np.linspace(0, nx, nreg_side + 1).astype(int)
+    return [c for i in range(nreg_side) for j in range(nreg_side)
+            for c in _find_stamps(snr, usable, hs,
+                                  (yb[i], yb[i + 1], xb[j], xb[j + 1]),
+                                  nstamps)]
+
+
+def _bg_terms(y, x, shape, order):
+    # background polynomial terms in coordinates normalized to [-1, 1]
+    yn = 2. * y / shape[0] - 1.
+    xn = 2. * x / shape[1] - 1.
+    return [yn ** j * xn ** (i - j) for i in range(order + 1)
+            for j in range(i + 1)]
+
+
+def fit_kernel(sci, ref, var, centers, hs, basis, bg_order=0, niter=3,
+               clip=3.):
+    """Fit the kernel that matches `ref` to `sci` on the stamps of half
+    width `hs` at `centers`, as a linear combination of `basis` plus a
+    polynomial background of order `bg_order`, weighting pixels by the
+    inverse of `var`.
+
+    Stamps whose reduced chi^2 is an outlier (more than `clip` scaled
+    MADs above the median) are rejected and the fit is repeated, up to
+    `niter` times. Returns the kernel, the background coefficients and
+    the number of stamps used."""
+
+    hw = basis.shape[-1] // 2
+    centers = np.asarray(centers)
+    off = np.arange(-hs, hs + 1)
+    offk = np.arange(-hs - hw, hs + hw + 1)
+
+    ys = centers[:, 0, None] + off
+    xs = centers[:, 1, None] + off
+    s = sci[ys[:, :, None], xs[:, None, :]]
+    w = 1. / var[ys[:, :, None], xs[:, None, :]]
+    r = ref[(centers[:, 0, None] + offk)[:, :, None],
+            (centers[:, 1, None] + offk)[:, None, :]]
+
+    # convolve every stamp with every basis function and keep the pixels
+    # that the kernel fully covers
+    conv = fft_convolve(r[:, None], basis[None])[..., hw:-hw, hw:-hw]
+    bg = _bg_terms(ys[:, :, None], xs[:, None, :], sci.shape, bg_order)
+    design = np.concatenate(
+        [conv, np.broadcast_to(np.stack(bg, axis=1),
+                               (len(centers), len(bg)) + s.shape[1:])],
+        axis=1)
+
+    nterm = design.shape[1]
+    keep = np.ones(len(centers), dtype=bool)
+    for _ in range(niter):
+        sw = np.sqrt(w[keep])
+        a = (design[keep] * sw[:, None]).transpose(0, 2, 3, 1).reshape(-1, nterm)
+        b = (s[keep] * sw).ravel()
+        coef = np.linalg.lstsq(a, b, rcond=None)[0]
+
+        model = np.tensordot(coef, design, axes=(0, 1))
+        chi2 = (((s - model) ** 2) * w).mean(axis=(1, 2))
+        med = np.median(chi2[keep])
+        mad = 1.4826 * np.median(np.abs(chi2[keep] - med))
+        newkeep = keep & (chi2 <= med + clip * mad)
+        if newkeep.sum() == keep.sum() or newkeep.sum() < 3:
+            break
+        keep = newkeep
+
+    nb = len(basis)
+    kernel = np.tensordot(coef[:nb], basis, axes=(0, 0))
+    return kernel, coef[nb:], int(keep.sum())
+
+
+def fft_subtraction(sci, ref, scirms, refrms, bad, hw, hs, nreg_side=3,
+                    bg_order=0, satlev=np.inf, il=-np.inf, tl=-np.inf,
+                    nstamps=60, min_stamps=5, sigmas=GAUSS_SIGMAS,
+                    degrees=GAUSS_DEGREES, centers=None):
+    """Subtract `ref` from `sci` (which must be on the same pixel grid) by
+    convolving it with a kernel fitted independently in each of the
+    nreg_side x nreg_side regions of the image.
+
+    Pixels are unusable if they are flagged in `bad`, non-finite, above
+    `satlev`, or below the lower limits `il` (science) and `tl`
+    (template). Unusable template pixels spoil every output pixel within
+    the kernel footprint. Regions with fewer than `min_stamps` stamps use
+    the kernel fitted on the stamps of the whole image.
+
+    Stamps are the brightest isolated peaks of each region, unless their
+    (y, x) `centers` are given, e.g., from an earlier subtraction on the
+    same template (centers that are unusable on this image are dropped).
+
+    The output rms combines the science rms with the template variance
+    convolved with the square of the kernel. Returns the difference image,
+    its rms, the output bad-pixel map and a dict of fit information.
+    Masked output pixels are set to 1e-30 (with BIG_RMS in the rms), as
+    hotpants does."""
+
+    from scipy.ndimage import binary_dilation
+
+    sci = np.asarray(sci, dtype=float)
+    ref = np.asarray(ref, dtype=float)
+    scivar = np.asarray(scirms, dtype=float) ** 2
+    refvar = np.asarray(refrms, dtype=float) ** 2
+
+    with np.errstate(invalid='ignore'):
+        badsci = bad | ~np.isfinite(sci) | ~np.isfinite(scivar) | \
+            (sci > satlev) | (sci < il) | (scivar <= 0)
+        badref = ~np.isfinite(ref) | ~np.isfinite(refvar) | \
+            (ref > satlev) | (ref < tl)
+
+    sci = np.where(badsci, 0., sci)
+    ref = np.where(badref, 0., ref)
+    scivar = np.where(badsci, 1., scivar)
+    refvar = np.where(badref, 0., refvar)
+
+    footprint = np.ones((2 * hw + 1, 2 * hw + 1), dtype=bool)
+    outbad = badsci | binary_dilation(badref, structure=footprint)
+
+    # a stamp can be centered where its pixels, and the template pixels
+    # under the kernel, are all good and on the image
+    ny, nx = sci.shape
+    usable = _window_sum(outbad.astype(float), hs) == 0
+    edge = hs + hw
+    usable[:edge] = usable[-edge:] = False
+    usable[:, :edge] = usable[:, -edge:] = False
+
+    good = ~outbad
+    level = np.median(sci[good]) if good.any() else 0.
+    snr = (sci - level) / np.sqrt(scivar)
+
+    basis = kernel_basis(hw, sigmas=sigmas, degrees=degrees)
+
+    yb = np.linspace(0, ny, nreg_side + 1).astype(int)
+    xb = np.linspace(0, nx, nreg_side + 1).astype(int)
+    regions = [(yb[i], yb[i + 1], xb[j], xb[j + 1])
+               for i in range(nreg_side) for j in range(nreg_side)]
+    if centers is None:
+        centers = [_find_stamps(snr, usable, hs, reg, nstamps)
+                   for reg in regions]
+    else:
+        centers = [[(cy, cx) for cy, cx in centers
+                    if y0 <= cy < y1 and x0 <= cx < x1 and usable[cy, cx]]
+                   for y0, y1, x0, x1 in regions]
+
+    allcenters = [c for cs in centers for c in cs]
+    if len(allcenters) < min_stamps:
+        raise RuntimeError(f'Only {len(allcenters)} usable stamps on the '
+                           f'image, cannot fit a convolution kernel.')
+    fallback = None
+
+    sub = np.empty_like(sci)
+    subvar = np.empty_like(sci)
+    info = {'ksum': [], 'nstamps': [], 'centers': allcenters}
+
+    for reg, cs in zip(regions, centers):
+        if len(cs) >= min_stamps:
+            kernel, bgcoef, nused = fit_kernel(sci, ref, scivar + refvar, cs,
+                                               hs, basis, bg_order=bg_order)
+        else:
+            if fallback is None:
+                fallback = fit_kernel(sci, ref, scivar + refvar, allcenters,
+                                      hs, basis, bg_order=bg_order)
+            kernel, bgcoef, nused = fallback
+
+        y0, y1, x0, x1 = reg
+        ya, yz = max(0, y0 - hw), min(ny, y1 + hw)
+        xa, xz = max(0, x0 - hw), min(nx, x1 + hw)
+        cut = (slice(y0 - ya, y0 - ya + y1 - y0),
+               slice(x0 - xa, x0 - xa + x1 - x0))
+
+        conv = fft_convolve(ref[ya:yz, xa:xz], kernel)[cut]
+        convvar = fft_convolve(refvar[ya:yz, xa:xz], kernel ** 2)[cut]
+
+        y, x = np.mgrid[y0:y1, x0:x1]
+        bg = sum(c * t for c, t in
+                 zip(bgcoef, _bg_terms(y, x, sci.shape, bg_order)))
+
+        sub[y0:y1, x0:x1] = sci[y0:y1, x0:x1] - conv - bg
+        subvar[y0:y1, x0:x1] = scivar[y0:y1, x0:x1] + convvar
+
+        info['ksum'].append(float(kernel.sum()))
+        info['nstamps'].append(nused)
+
+    subrms = np.sqrt(np.clip(subvar, 0, None))
+    sub[outbad] = MASKED_VALUE
+    subrms[outbad] = BIG_RMS
+    return sub, subrms, outbad, info
+
+
+def fft_subtract(sci, ref, outname, submask, directory, tmpdir='/tmp',
+                 nreg_side=3, subtract_new_back=True, fft_kws=None,
+                 solution=None):
+    """In-process replacement for running hotpants on the output of
+    `prepare_hotpants`: takes the same inputs, and writes the difference
+    image to `outname` and its rms to the matching .rms.fits file, with
+    masked pixels set to 1e-30 as hotpants does.
+
+    If `solution` (the `KernelSolution` of an earlier subtraction against
+    the same reference) is given, the kernels are fitted on its stamps
+    instead of searching the image for stamps, and the subtraction is
+    redone from scratch if the result fails its quality check. Returns
+    the `KernelSolution` of this subtraction; an accepted warm start keeps
+    the quality of the solution it started from."""
+
+    from astropy.io import fits
+    from .hotpants import prepare_subtraction_inputs
+    from .kernelcache import KernelSolution, residual_quality
+
+    if fft_kws is None:
+        fft_kws = {}
+
+    inputs = prepare_subtraction_inputs(sci, ref, outname, directory,
+                                        tmpdir=tmpdir,
+                                        subtract_new_back=subtract_new_back)
+
+    scimbkg = inputs['scimbkg']
+    wcs = sci.wcs
+    args = (scimbkg.data, ref.data, inputs['scirms'].data,
+            inputs['refrms'].data, np.asarray(submask.data, dtype=bool))
+    kws = dict(hw=int(round(inputs['r'])), hs=int(round(inputs['rss'])),
+               nreg_side=nreg_side, satlev=inputs['satlev'],
+               il=inputs['il'], tl=inputs['tl'], **fft_kws)
+
+    result = None
+    if solution is not None:
+        centers = solution.centers(wcs, args[0].shape)
+        if solution.usable_on(centers, nreg_side):
+            try:
+                result = fft_subtraction(*args, centers=centers, **kws)
+            except RuntimeError:
+                # too few of the stamps are usable on this image
+                result = None
+            if result is not None:
+                quality = residual_quality(result[0], result[1])
+                if not solution.accepts(*quality):
+                    print(f'Warm-started subtraction of {sci.basename} '
+                          f'failed the quality check (residual scatter '
+                          f'{quality[0]:.2f}, masked fraction '
+                          f'{quality[1]:.3f}), redoing it from scratch',
+                          flush=True)
+                    result = None
+                else:
+                    # keep the quality of the last full solve as the
+                    # baseline, so that warm starts cannot drift worse
+                    # epoch by epoch
+                    quality = (solution.zstd, solution.fmask)
+
+    if result is None:
+        result = fft_subtraction(*args, **kws)
+        quality = residual_quality(result[0], result[1])
+
+    sub, subrms, _, info = result
+
+    header = fits.getheader(scimbkg.local_path)
+    header['CONVOL00'] = ('TEMPLATE', 'Convolved image')
+    header['NREGION'] = (len(info['ksum']), 'Number of kernel regions')
+    for i, (ksum, nstamps) in enumerate(zip(info['ksum'], info['nstamps'])):
+        header[f'KSUM{i:02d}'] = (ksum, f'Kernel sum in region {i}')
+        header[f'NSTMP{i:02d}'] = (nstamps, f'Stamps used in region {i}')
+    header['SUBENGIN'] = ('FFT', 'Image subtraction engine')
+
+    fits.writeto(outname, sub.astype('<f4'), header=header, overwrite=True)
+    fits.writeto(inputs['subrms'], subrms.astype('<f4'), header=header,
+                 overwrite=True)
+
+    return KernelSolution.from_centers(info['centers'], wcs, info['ksum'],
+                                       *quality)
@@ -1,8 +1,15 @@
+import subprocess
+import numpy as np
+
 from .utils import initialize_directory, quick_background_estimate
 from .seeing import estimate_seeing
 from .constants import BIG_RMS
+from .arraykernels import add_constant
+from .background import _background_engine, subtract_background
 
-__all__ = ['prepare_hotpants']
+__all__ = ['prepare_hotpants', 'prepare_subtraction_inputs',
+           'hotpants_command', 'run_hotpants', 'run_hotpants_tiled', 'tile_bounds',
+           'stitch_tiles']
 
 
 def chunk(iterable, chunksize):
@@ -12,8 +19,12 @@ def chunk(iterable, chunksize):
         yield i, iterable[i * chunksize : (i + 1) * chunksize]
 
 
-def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
-                     nreg_side=3, subtract_new_back=True, hotpants_kws=None):
+def prepare_subtraction_inputs(sci, ref, outname, directory, tmpdir='/tmp',
+                               subtract_new_back=True):
+    """Stage everything an image subtraction engine needs: the (optionally
+    background subtracted) science image, the seeing-based kernel and
+    stamp half-widths, the rms maps of both images flushed to disk, and
+    the lower and upper valid data limits. Returns them as a dict."""
 
     from .sextractor import run_sextractor
     from .swarp import BKG_VAL
@@ -21,20 +32,17 @@ def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
     initialize_directory(directory)
     # this both creates and unmaps the background subtracted image
 
-    if hotpants_kws is None:
-        hotpants_kws = {}
-
     if subtract_new_back:
-        scimbkg = run_sextractor(sci, checkimage_type=['bkgsub'])[1]
-        scimbkg.data += BKG_VAL
+        if _background_engine() == 'native':
+            scimbkg = subtract_background(sci, sci.background_image)
+            scimbkg.map_to_local_file(str(directory / scimbkg.basename))
+        else:
+            scimbkg = run_sextractor(sci, checkimage_type=['bkgsub'])[1]
+        scimbkg.data = add_constant(scimbkg.data, BKG_VAL)
         scimbkg.save()
     else:
         scimbkg = sci
 
-    # if requested, copy the input images to a temporary working directory
-    impaths = [im.local_path for im in [scimbkg, ref]]
-    scipath, refpath = impaths
-
     if 'SEEING' not in sci.header:
         estimate_seeing(sci)
         sci.save()
@@ -43,9 +51,6 @@ def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
     r = 2.5 * seepix
     rss = 6. * seepix
 
-    nsx = sci.header['NAXIS1'] / 100.
-    nsy = sci.header['NAXIS2'] / 100.
-
     # get the background for the input images
     scirms = sci.rms_image
     refrms = ref.parent_image.rms_image.aligned_to(scirms, tmpdir=tmpdir)
@@ -66,20 +71,47 @@ def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
                                                   mask_image=sci.mask_image)
     refbkg, refbkgstd = quick_background_estimate(ref)
 
-    # output the RMS image from hotpants
-    subrms = outname.replace('.fits', '.rms.fits')
+    return {
+        'scimbkg': scimbkg,
+        'scirms': scirms,
+        'refrms': refrms,
+        'r': r,
+        'rss': rss,
+        'il': scibkg - 10 * scibkgstd,
+        'tl': refbkg - 10 * refbkgstd,
+        'satlev': 5e3,  # not perfect, but close enough.
+        # output the RMS image from the subtraction
+        'subrms': outname.replace('.fits', '.rms.fits')
+    }
+
 
-    il = scibkg - 10 * scibkgstd
-    tl = refbkg - 10 * refbkgstd
+def hotpants_command(scipath, refpath, scirmspath, refrmspath, maskpath,
+                     outname, inputs, naxis1, naxis2, nreg_side=3,
+                     hotpants_kws=None):
+    """Build the hotpants call subtracting `refpath` from `scipath`, given
+    the paths of their rms maps and of the bad-pixel mask, and the limits
+    and kernel sizes of `inputs` (the output of
+    `prepare_subtraction_inputs`)."""
+
+    if hotpants_kws is None:
+        hotpants_kws = {}
+
+    r = inputs['r']
+    rss = inputs['rss']
+    il = inputs['il']
+    tl = inputs['tl']
+    satlev = inputs['satlev']
+    subrms = outname.replace('.fits', '.rms.fits')
 
-    satlev = 5e3  # not perfect, but close enough.
+    nsx = naxis1 / 100.
+    nsy = naxis2 / 100.
 
     syscall = f'hotpants -inim {scipath} -hki -n i -c t ' \
-              f'-tmplim {ref.local_path} -outim {outname} ' \
+              f'-tmplim {refpath} -outim {outname} ' \
               f'-tu {satlev} -iu {satlev}  -tl {tl} -il {il} -r {r} ' \
-              f'-rss {rss} -tni {refrms.local_path} ' \
-              f'-ini {scirms.local_path} ' \
-              f'-imi {submask.local_path}  -v 0 -oni {subrms} ' \
+              f'-rss {rss} -tni {refrmspath} ' \
+              f'-ini {scirmspath} ' \
+              f'-imi {maskpath}  -v 0 -oni {subrms} ' \
               f'-fin {BIG_RMS} -nsx {nsx / nreg_side} -nsy {nsy / nreg_side} ' \
               f'-nrx {nreg_side} -nry {nreg_side} '
 
@@ -95,4 +127,242 @@ def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
     return syscall
 
 
+def prepare_hotpants(sci, ref, outname, submask, directory,  tmpdir='/tmp',
+                     nreg_side=3, subtract_new_back=True, hotpants_kws=None):
+
+    inputs = prepare_subtraction_inputs(sci, ref, outname, directory,
+                                        tmpdir=tmpdir,
+                                        subtract_new_back=subtract_new_back)
+
+    return hotpants_command(inputs['scimbkg'].local_path, ref.local_path,
+                            inputs['scirms'].local_path,
+                            inputs['refrms'].local_path, submask.local_path,
+                            outname, inputs, sci.header['NAXIS1'],
+                            sci.header['NAXIS2'],
+                            nreg_side=nreg_side, hotpants_kws=hotpants_kws)
+
+
+def _kernel_sums(header):
+    return [header[key] for key in sorted(header)
+            if key.startswith('KSUM') and key[4:].isdigit()]
+
+
+def run_hotpants(sci, ref, outname, submask, directory, tmpdir='/tmp',
+                 nreg_side=3, subtract_new_back=True, hotpants_kws=None,
+                 solution=None):
+    """Prepare the inputs of hotpants and run it, writing the difference
+    image to `outname` and its rms to the matching .rms.fits file.
+
+    If `solution` (the `KernelSolution` of an earlier subtraction against
+    the same reference) is given, hotpants is warm started: it fits the
+    kernel on the stamps of that solution (-ssf, -afssc 0) instead of
+    searching the image for stamps. If the result fails the quality check
+    of the solution, the subtraction is redone from scratch.
+
+    Returns the `KernelSolution` of this subtraction. After a full solve,
+    its stamps are the bright isolated stars of the template. An accepted
+    warm start keeps the quality of the solution it started from."""
+
+    from astropy.io import fits
+    from .fftsub import template_stamps
+    from .kernelcache import KernelSolution, residual_quality
+
+    if hotpants_kws is None:
+        hotpants_kws = {}
+
+    inputs = prepare_subtraction_inputs(sci, ref, outname, directory,
+                                        tmpdir=tmpdir,
+                                        subtract_new_back=subtract_new_back)
+    naxis1, naxis2 = sci.header['NAXIS1'], sci.header['NAXIS2']
+    wcs = sci.wcs
+
+    def subtract(kws):
+        command = hotpants_command(inputs['scimbkg'].local_path,
+                                   ref.local_path,
+                                   inputs['scirms'].local_path,
+                                   inputs['refrms'].local_path,
+                                   submask.local_path, outname, inputs,
+                                   naxis1, naxis2, nreg_side=nreg_side,
+                                   hotpants_kws=kws)
+        subprocess.check_call(command.split())
+        with fits.open(outname) as hdul:
+            header = hdul[0].header
+            quality = residual_quality(hdul[0].data,
+                                       fits.getdata(inputs['subrms']))
+        return _kernel_sums(header), quality
+
+    if solution is not None:
+        centers = solution.centers(wcs, (naxis2, naxis1))
+        if solution.usable_on(centers, nreg_side):
+            stampfile = str(directory / 'stamps.xy')
+            with open(stampfile, 'w') as f:
+                for cy, cx in centers:
+                    f.write(f'{cx + 1} {cy + 1}\n')
+            kws = dict(hotpants_kws, ssf=stampfile, afssc=0)
+            ksum, (zstd, fmask) = subtract(kws)
+            if solution.accepts(zstd, fmask):
+                # keep the quality of the last full solve as the baseline,
+                # so that warm starts cannot drift worse epoch by epoch
+                return KernelSolution(solution.ra, solution.dec, ksum,
+                                      solution.zstd, solution.fmask)
+            print(f'Warm-started subtraction of {sci.basename} failed the '
+                  f'quality check (residual scatter {zstd:.2f}, masked '
+                  f'fraction {fmask:.3f}), redoing it from scratch',
+                  flush=True)
+
+    ksum, (zstd, fmask) = subtract(hotpants_kws)
+    centers = template_stamps(ref.data, inputs['refrms'].data, submask.data,
+                              int(np.ceil(inputs['r'])),
+                              int(np.ceil(inputs['rss'])),
+                              nreg_side=nreg_side)
+    return KernelSolution.from_centers(centers, wcs, ksum, zstd, fmask)
+
+
+def tile_bounds(n, nreg_side, margin):
+    """Split an axis of `n` pixels into `nreg_side` equal cores (the
+    kernel regions of a whole-image hotpants run), and grow each core by
+    `margin` pixels on its interior sides. Returns a list of (start,
+    stop, core_start, core_stop)."""
+    edges = [int(e) for e in np.linspace(0, n, nreg_side + 1)]
+    return [(max(0, c0 - margin), min(n, c1 + margin), c0, c1)
+            for c0, c1 in zip(edges[:-1], edges[1:])]
+
+
+def _crossfade(n, c0, c1, blend):
+    # weight of a tile with core [c0, c1) along an axis of n pixels: 1 in
+    # the core, ramping linearly to 0 over 2 * blend pixels centered on
+    # each interior core boundary, so the weights of neighbouring tiles
+    # sum to 1 everywhere
+    x = np.arange(n) + 0.5
+    w = np.ones(n)
+    if c0 > 0:
+        w = np.minimum(w, np.clip((x - c0 + blend) / (2 * blend), 0, 1))
+    if c1 < n:
+        w = np.minimum(w, np.clip((c1 + blend - x) / (2 * blend), 0, 1))
+    return w
+
+
+def stitch_tiles(shape, tiles, subs, rmss, blend):
+    """Combine the subtractions `subs` (with rms maps `rmss`) of the
+    `tiles` (pairs of `tile_bounds` entries along y and x) of an image of
+    `shape`, cross-fading them over 2 * `blend` pixels across the core
+    boundaries. A pixel is masked (1e-30, with BIG_RMS in the rms) if any
+    tile contributing to it masked it."""
+
+    sub = np.zeros(shape)
+    rms = np.zeros(shape)
+    bad = np.zeros(shape, dtype=bool)
+
+    for ((y0, y1, cy0, cy1), (x0, x1, cx0, cx1)), tsub, trms in zip(
+            tiles, subs, rmss):
+        wy = _crossfade(shape[0], cy0, cy1, blend)[y0:y1]
+        wx = _crossfade(shape[1], cx0, cx1, blend)[x0:x1]
+        w = wy[:, None] * wx[None, :]
+        cut = (slice(y0, y1), slice(x0, x1))
+        sub[cut] += w * tsub
+        rms[cut] += w * trms
+        # compare in float32, as hotpants writes it: float32 1e-30 read
+        # into a float64 array is 1.0000000031710769e-30
+        bad[cut] |= (w > 0) & (np.asarray(tsub, dtype='f4') ==
+                               np.float32(1e-30))
+
+    sub[bad] = 1e-30
+    rms[bad] = BIG_RMS
+    return sub, rms, bad
+
+
+def _write_tile(path, data, header, y0, y1, x0, x1):
+    from astropy.io import fits
+    header = header.copy()
+    for key, shift in [('CRPIX1', x0), ('CRPIX2', y0)]:
+        if key in header:
+            header[key] -= shift
+    data = data[y0:y1, x0:x1]
+    if data.dtype == bool:
+        data = data.astype('uint8')
+    fits.writeto(path, data, header=header, overwrite=True)
+
+
+def _run_command(command):
+    subprocess.check_call(command.split())
+
+
+def run_hotpants_tiled(sci, ref, outname, submask, directory, tmpdir='/tmp',
+                       nreg_side=3, subtract_new_back=True,
+                       hotpants_kws=None, nprocs=None):
+    """Run hotpants on the nreg_side x nreg_side kernel regions of a
+    quadrant concurrently, instead of on the whole quadrant at once.
+
+    Each region is cut out with a margin (the kernel and stamp half
+    widths, plus the cross-fade width) and subtracted with a single
+    kernel region by its own hotpants process, on a pool of `nprocs`
+    worker processes (one per tile by default). The tiles are stitched
+    into a single difference image and rms map at `outname`, cross-fading
+    the overlaps, with the header of the science image."""
+
+    from astropy.io import fits
+    from concurrent.futures import ProcessPoolExecutor
+
+    inputs = prepare_subtraction_inputs(sci, ref, outname, directory,
+                                        tmpdir=tmpdir,
+                                        subtract_new_back=subtract_new_back)
+
+    scimbkg = inputs['scimbkg']
+    ny, nx = scimbkg.data.shape
+    blend = int(np.ceil(inputs['rss']))
+    margin = int(np.ceil(inputs['r'] + inputs['rss'])) + blend
+
+    tiles = [(ty, tx) for ty in tile_bounds(ny, nreg_side, margin)
+             for tx in tile_bounds(nx, nreg_side, margin)]
+
+    arrays = {
+        'sci': (scimbkg.data, fits.getheader(scimbkg.local_path)),
+        'ref': (ref.data, fits.getheader(ref.local_path)),
+        'scirms': (inputs['scirms'].data,
+                   fits.getheader(inputs['scirms'].local_path)),
+        'refrms': (inputs['refrms'].data,
+                   fits.getheader(inputs['refrms'].local_path)),
+        'mask': (submask.data, fits.getheader(submask.local_path))
+    }
+
+    commands = []
+    outnames = []
+    for i, ((y0, y1, _, _), (x0, x1, _, _)) in enumerate(tiles):
+        paths = {}
+        for kind, (data, header) in arrays.items():
+            paths[kind] = str(directory / f'tile{i:02d}.{kind}.fits')
+            _write_tile(paths[kind], data, header, y0, y1, x0, x1)
+        tileout = str(directory / f'tile{i:02d}.sub.fits')
+        outnames.append(tileout)
+        commands.append(hotpants_command(
+            paths['sci'], paths['ref'], paths['scirms'], paths['refrms'],
+            paths['mask'], tileout, inputs, x1 - x0, y1 - y0, nreg_side=1,
+            hotpants_kws=hotpants_kws
+        ))
+
+    nprocs = len(tiles) if nprocs is None else nprocs
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        list(pool.map(_run_command, commands))
+
+    subs, rmss, headers = [], [], []
+    for tileout in outnames:
+        with fits.open(tileout) as hdul:
+            subs.append(hdul[0].data)
+            headers.append(hdul[0].header)
+        rmss.append(fits.getdata(tileout.replace('.fits', '.rms.fits')))
+
+    sub, rms, _ = stitch_tiles((ny, nx), tiles, subs, rmss, blend)
+
+    header = arrays['sci'][1].copy()
+    if 'CONVOL00' in headers[0]:
+        header['CONVOL00'] = (headers[0]['CONVOL00'], 'Convolved image')
+    header['NREGION'] = (len(tiles), 'Number of kernel regions')
+    for i, h in enumerate(headers):
+        if 'KSUM00' in h:
+            header[f'KSUM{i:02d}'] = (h['KSUM00'], f'Kernel sum in region {i}')
+    header['NTILES'] = (len(tiles), 'Regions subtracted as separate tiles')
+    header['SUBENGIN'] = ('HOTPANTS', 'Image subtraction engine')
 
+    fits.writeto(outname, sub.astype('<f4'), header=header, overwrite=True)
+    fits.writeto(inputs['subrms'], rms.astype('<f4'), header=header,
+                 overwrite=True)
@@ -1,5 +1,4 @@
 import numpy as np
-import os
 import subprocess
 from pathlib import Path
 
@@ -13,7 +12,9 @@ from .core import ZTFFile, DBSession
 from . import sextractor
 from .fitsfile import HasWCS
 from .plotting import discrete_cmap
-from .constants import BIG_RMS
+from .arraykernels import weight_from_rms, rms_from_weight, saturated_pixels
+from .background import (_background_engine, background_images,
+                         subtract_background)
 from .secrets import get_secret
 from .catalog import PipelineFITSCatalog
 from .photometry import aperture_photometry, ForcedPhotometry
@@ -143,18 +144,9 @@ class CalibratableImageBase(FITSImage):
         except AttributeError:
             # need to calculate the weight map.
 
-            ind = self.mask_image.boolean.data
-            wgt = np.empty_like(ind, dtype='<f4')
-            wgt[~ind] = 1 / self.rms_image.data[~ind] ** 2
-            wgt[ind] = 0.
-
-            try:
-                saturval = self.header['SATURATE']
-            except KeyError:
-                pass
-            else:
-                saturind = self.data >= 0.9 * saturval
-                wgt[saturind] = 0.
+            wgt = weight_from_rms(self.rms_image.data,
+                                  self.mask_image.boolean.data,
+                                  saturated_pixels(self.data, self.header))
 
             self._weightimg = FITSImage()
             self._weightimg.basename = self.basename.replace('.fits',
@@ -162,12 +154,8 @@ class CalibratableImageBase(FITSImage):
             self._weightimg.data = wgt
             self._weightimg.header = self.header
             self._weightimg.header_comments = self.header_comments
-            if self.ismapped:
-                dirname = os.path.dirname(self.local_path)
-                bn = self._weightimg.basename
-                join = os.path.join(dirname, bn)
-                self._weightimg.map_to_local_file(join)
-                self._weightimg.save()  #  to guarantee mapped file exists
+            # virtual: kept in memory, and only written to disk if a tool
+            # needs a file (see zuds.materialize)
         return self._weightimg
 
     @property
@@ -176,32 +164,21 @@ class CalibratableImageBase(FITSImage):
             return self._rmsimg
         except AttributeError:
             if hasattr(self, '_weightimg'):
-                ind = self.mask_image.boolean.data
-                rms = np.empty_like(ind, dtype='<f4')
-                rms[~ind] = 1 / np.sqrt(self.weight_image.data[~ind])
-                rms[ind] = BIG_RMS
-
-                try:
-                    saturval = self.header['SATURATE']
-                except KeyError:
-                    pass
-                else:
-                    saturind = self.data >= 0.9 * saturval
-                    rms[saturind] = BIG_RMS
+                rms = rms_from_weight(self.weight_image.data,
+                                      self.mask_image.boolean.data,
+                                      saturated_pixels(self.data,
+                                                       self.header))
 
                 _rmsimg = FITSImage()
                 _rmsimg.basename = self.basename.replace('.fits', '.rms.fits')
                 _rmsimg.data = rms
                 _rmsimg.header = self.header
                 _rmsimg.header_comments = self.header_comments
-                if self.ismapped:
-                    dirname = os.path.dirname(self.local_path)
-                    bn = _rmsimg.basename
-                    join = os.path.join(dirname, bn)
-                    _rmsimg.map_to_local_file(join)
-                    _rmsimg.save()
+                # virtual, like the weight map
                 self._rmsimg = _rmsimg
                 return self._rmsimg
+            elif _background_engine() == 'native':
+                self._bkgimg, self._rmsimg = background_images(self)
             else:
                 self._call_source_extractor(checkimage_type=['rms'],
                                             use_weightmap=False)
@@ -212,7 +189,10 @@ class CalibratableImageBase(FITSImage):
         try:
             return self._bkgimg
         except AttributeError:
-            self._call_source_extractor(checkimage_type=['bkg'])
+            if _background_engine() == 'native':
+                self._bkgimg = background_images(self)[0]
+            else:
+                self._call_source_extractor(checkimage_type=['bkg'])
         return self._bkgimg
 
     @property
@@ -220,7 +200,11 @@ class CalibratableImageBase(FITSImage):
         try:
             return self._bkgsubimg
         except AttributeError:
-            self._call_source_extractor(checkimage_type=['bkgsub'])
+            if _background_engine() == 'native':
+                self._bkgsubimg = subtract_background(self,
+                                                      self.background_image)
+            else:
+                self._call_source_extractor(checkimage_type=['bkgsub'])
         return self._bkgsubimg
 
     @property
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+from pathlib import Path
+
+from .secrets import get_secret
+
+__all__ = ['KernelSolution', 'KernelCache', 'get_kernel_cache',
+           'residual_quality']
+
+
+# a warm-started subtraction is kept if the robust scatter of its
+# normalized residuals is within this fraction of that of the stored
+# solution (or of 1, if the stored one was better than that)...
+WARM_START_TOLERANCE = 0.1
+
+# ... and if it masks at most this much more of the image
+WARM_START_MASK_TOLERANCE = 0.02
+
+# fewest stored stamps per kernel region that must land on the new image
+# for the solution to be used
+MIN_STAMPS_PER_REGION = 3
+
+
+def residual_quality(sub, rms):
+    """Robust scatter of the normalized residuals `sub` / `rms` of a
+    subtraction over its unmasked pixels (1 for a perfect subtraction),
+    and the fraction of masked (1e-30) pixels."""
+    masked = sub == 1e-30
+    z = sub[~masked] / rms[~masked]
+    if len(z) == 0:
+        return np.inf, 1.
+    med = np.median(z)
+    zstd = 1.4826 * np.median(np.abs(z - med))
+    return float(zstd), float(masked.mean())
+
+
+class KernelSolution(object):
+    """Kernel solution of a subtraction: the sky positions of the stamps
+    the kernel was fitted on, the kernel sum of each region, and the
+    quality of the result (see `residual_quality`)."""
+
+    def __init__(self, ra, dec, ksum, zstd, fmask):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.ksum = np.asarray(ksum, dtype=float)
+        self.zstd = float(zstd)
+        self.fmask = float(fmask)
+
+    @classmethod
+    def from_centers(cls, centers, wcs, ksum, zstd, fmask):
+        """Solution with stamps at the (y, x) pixel `centers` of an image
+        with astropy WCS `wcs`."""
+        centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        ra, dec = wcs.all_pix2world(centers[:, 1], centers[:, 0], 0)
+        return cls(ra, dec, ksum, zstd, fmask)
+
+    def centers(self, wcs, shape):
+        """(y, x) pixel centers of the stored stamps that fall on an image
+        of `shape` with astropy WCS `wcs`."""
+        if len(self.ra) == 0:
+            return []
+        x, y = wcs.all_world2pix(self.ra, self.dec, 0)
+        x = np.round(x).astype(int)
+        y = np.round(y).astype(int)
+        ok = (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+        return list(zip(y[ok].tolist(), x[ok].tolist()))
+
+    def usable_on(self, centers, nreg_side):
+        return len(centers) >= MIN_STAMPS_PER_REGION * nreg_side ** 2
+
+    def accepts(self, zstd, fmask):
+        """Does a subtraction warm started from this solution, with
+        residual quality (`zstd`, `fmask`), pass the quality check?"""
+        return zstd <= max(self.zstd, 1.) * (1 + WARM_START_TOLERANCE) and \
+            fmask <= self.fmask + WARM_START_MASK_TOLERANCE
+
+
+class KernelCache(object):
+    """Kernel solutions of the most recent subtraction against each
+    reference image (i.e., each field, ccd, quadrant and filter), stored
+    as one .npz file per reference in `root`."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, ref):
+        return self.root / ref.basename.replace('.fits', '.kernel.npz')
+
+    def load(self, ref):
+        """Return the stored `KernelSolution` for `ref`, or None."""
+        path = self.path(ref)
+        if not path.exists():
+            return None
+        with np.load(path) as f:
+            return KernelSolution(f['ra'], f['dec'], f['ksum'],
+                                  f['zstd'], f['fmask'])
+
+    def save(self, ref, solution):
+        """Store `solution` as the latest solution for `ref`."""
+        path = self.path(ref)
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmppath, 'wb') as f:
+            np.savez(f, ra=solution.ra, dec=solution.dec,
+                     ksum=solution.ksum, zstd=solution.zstd,
+                     fmask=solution.fmask)
+        os.replace(tmppath, path)
+
+
+def get_kernel_cache():
+    """Return the `KernelCache` in the `kernel_cache_dir` configured in the
+    secrets file, or None if it is not configured."""
+    try:
+        root = get_secret('kernel_cache_dir')
+    except KeyError:
+        return None
+
+    if root is None:
+        return None
+    return KernelCache(root)
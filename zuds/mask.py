@@ -5,6 +5,7 @@ from sqlalchemy import Index
 from .image import FITSImage
 from .core import ZTFFile
 from .constants import MASK_BITS, BAD_SUM, MASK_COMMENTS
+from .bitmask import BitMask
 
 
 __all__ = ['MaskImageBase', 'MaskImage']
@@ -26,10 +27,9 @@ class MaskImageBase(FITSImage):
     def update_from_weight_map(self, weight_image):
         """Update what's in memory based on what's on disk (produced by
         SWarp)."""
-        mskarr = self.data
-        ftsarr = weight_image.data
-        mskarr[ftsarr == 0] += 2 ** 16
-        self.data = mskarr
+        bits = self.bits
+        bits.set(2 ** 16, weight_image.data == 0)
+        self.data = bits.data
         self.refresh_bit_mask_entries_in_header()
 
     @classmethod
@@ -38,6 +38,12 @@ class MaskImageBase(FITSImage):
             f, use_existing_record=use_existing_record,
         )
 
+    @property
+    def bits(self):
+        """The mask as a `zuds.BitMask` sharing its data, for setting,
+        merging and testing bits in place."""
+        return BitMask(self.data)
+
     @property
     def boolean(self):
         """A boolean array that is True when a masked pixel is 'bad', i.e.,
@@ -62,7 +68,7 @@ class MaskImageBase(FITSImage):
             # masked, another of my custom bits)
             # So 6141 -> 71677 --> 202749
 
-            maskpix = (self.data & BAD_SUM) > 0
+            maskpix = self.bits.any(BAD_SUM)
             _boolean = FITSImage()
             _boolean.data = maskpix
             _boolean.header = self.header
@@ -8,6 +8,8 @@ from sqlalchemy.schema import UniqueConstraint
 
 from .core import Base
 from .constants import APER_KEY, APERTURE_RADIUS
+from .virtual import materialize
+from .bitmask import BitMask
 
 __all__ = ['ForcedPhotometry', 'raw_aperture_photometry', 'aperture_photometry']
 
@@ -91,15 +93,13 @@ def raw_aperture_photometry(sci_path, rms_path, mask_path, ra, dec,
 
     pixap = apertures.to_pixel(swcs)
     annulus_masks = pixap.to_mask(method='center')
-    maskpix = [annulus_mask.cutout(maskpix) for annulus_mask in annulus_masks]
 
 
     magzp = header['MAGZP']
     apcor = header[APER_KEY]
 
     # check for invalid photometry on masked pixels
-    phot_table['flags'] = [int(np.bitwise_or.reduce(m, axis=(0, 1))) for
-                           m in maskpix]
+    phot_table['flags'] = BitMask(maskpix).flags_in(annulus_masks)
 
     phot_table['zp'] = magzp + apcor
     phot_table['obsjd'] = header['OBSJD']
@@ -154,11 +154,11 @@ def aperture_photometry(calibratable, ra, dec, apply_calibration=False,
 
         pixap = apertures.to_pixel(wcs)
         annulus_masks = pixap.to_mask(method='center')
-        maskpix = [annulus_mask.cutout(mask.data) for annulus_mask in annulus_masks]
+        flags = BitMask(mask).flags_in(annulus_masks)
 
     else:
         phot_table = []
-        maskpix = []
+        flags = []
         for s in coord:
 
             if direct_load is not None and 'sci' in direct_load:
@@ -177,7 +177,7 @@ def aperture_photometry(calibratable, ra, dec, apply_calibration=False,
             if direct_load is not None and 'rms' in direct_load:
                 rms_path = direct_load['rms']
             else:
-                rms_path = calibratable.rms_image.local_path
+                rms_path = materialize(calibratable.rms_image)
 
             with fits.open(
                 sci_path,
@@ -223,8 +223,7 @@ def aperture_photometry(calibratable, ra, dec, apply_calibration=False,
             pt = photutils.aperture_photometry(pixels_bkgsub, ap, error=bkgrms)
 
             annulus_mask = ap.to_mask(method='center')
-            mp = annulus_mask.cutout(mask.data)
-            maskpix.append(mp)
+            flags.extend(BitMask(mask).flags_in([annulus_mask]))
 
             phot_table.append(pt)
 
@@ -239,8 +238,7 @@ def aperture_photometry(calibratable, ra, dec, apply_calibration=False,
 
 
     # check for invalid photometry on masked pixels
-    phot_table['flags'] = [int(np.bitwise_or.reduce(m, axis=(0, 1))) for
-                           m in maskpix]
+    phot_table['flags'] = flags
 
     # rename some columns
     phot_table.rename_column('aperture_sum', 'flux')
@@ -0,0 +1,114 @@
+import os
+import warnings
+import numpy as np
+from pathlib import Path
+from sqlalchemy.orm import joinedload
+
+from .core import DBSession
+from .image import ScienceImage
+
+__all__ = ['select_reference_inputs', 'verify_fits']
+
+
+# inputs of a reference image, as in scripts/queryref.py
+MAX_REFERENCE_IMAGES = 50
+MIN_REFERENCE_IMAGES = 14
+SEEING_RANGE = (1.7, 2.5)
+MAGLIMIT_RANGE = (19.2, 22.)
+
+# candidates beyond MAX_REFERENCE_IMAGES fetched to stand in for corrupted
+# files
+SPARE_IMAGES = 10
+
+FITS_BLOCK = 2880
+
+
+def verify_fits(path, checksum=False):
+    """Cheap integrity check of the FITS file at `path`, without reading its
+    data: every HDU header must parse, and the file must be exactly as long
+    as its headers say (this catches truncated and partially written
+    files). If `checksum`, the CHECKSUM and DATASUM keywords are also
+    verified where present, which reads the whole file. Returns True if
+    the file passes."""
+    from astropy.io import fits
+
+    try:
+        size = os.path.getsize(path)
+        pos = 0
+        with open(path, 'rb') as f:
+            while pos < size:
+                f.seek(pos)
+                header = fits.Header.fromfile(f)
+                naxis = header.get('NAXIS', 0)
+                nbytes = 0
+                if naxis > 0:
+                    nbytes = abs(header['BITPIX']) // 8 * header.get(
+                        'GCOUNT', 1
+                    ) * (header.get('PCOUNT', 0) + int(np.prod(
+                        [header[f'NAXIS{i + 1}'] for i in range(naxis)]
+                    )))
+                nblocks = -(-nbytes // FITS_BLOCK)
+                pos = f.tell() + nblocks * FITS_BLOCK
+        if pos != size:
+            return False
+
+        if checksum:
+            with warnings.catch_warnings():
+                # astropy warns about checksum mismatches
+                warnings.simplefilter('error')
+                with fits.open(path, checksum=True, memmap=False) as hdul:
+                    for hdu in hdul:
+                        hdu.data
+    except Exception:
+        return False
+    return True
+
+
+def select_reference_inputs(directory, min_date, max_date,
+                            nmax=MAX_REFERENCE_IMAGES, checksum=False):
+    """Choose the inputs of the reference image of the science images in
+    `directory` from their database records alone: the `nmax` images
+    observed between `min_date` and `max_date` with the deepest maglimit
+    among those with good seeing, maglimit and infobits, in one query.
+
+    Only the chosen files (and their masks) are checked with `verify_fits`,
+    and corrupted ones are replaced by the next best candidates. The
+    chosen images are mapped to their files in `directory`."""
+
+    directory = Path(directory)
+    names = [p.name for p in directory.glob('ztf*sciimg.fits')]
+    if len(names) == 0:
+        return []
+
+    candidates = DBSession().query(ScienceImage).options(
+        joinedload(ScienceImage.mask_image)
+    ).filter(
+        ScienceImage.basename.in_(names),
+        ScienceImage.obsdate >= min_date,
+        ScienceImage.obsdate <= max_date,
+        ScienceImage.seeing > SEEING_RANGE[0],
+        ScienceImage.seeing < SEEING_RANGE[1],
+        ScienceImage.maglimit > MAGLIMIT_RANGE[0],
+        ScienceImage.maglimit < MAGLIMIT_RANGE[1],
+        ScienceImage.infobits == 0
+    ).order_by(
+        ScienceImage.maglimit.desc()
+    ).limit(nmax + SPARE_IMAGES).all()
+
+    chosen = []
+    for sci in candidates:
+        if len(chosen) == nmax:
+            break
+        scipath = directory / sci.basename
+        maskpath = directory / sci.mask_image.basename
+        bad = [p.name for p in [scipath, maskpath]
+               if not verify_fits(p, checksum=checksum)]
+        if len(bad) > 0:
+            print(f'bad: File {bad[0]} is corrupted, skipping...',
+                  flush=True)
+            continue
+        sci.map_to_local_file(f'{scipath}', quiet=True)
+        sci.mask_image.map_to_local_file(f'{maskpath}', quiet=True)
+        chosen.append(sci)
+
+    return chosen
@@ -0,0 +1,176 @@
+import os
+import re
+import uuid
+import shutil
+import socket
+from pathlib import Path
+
+from .secrets import get_secret
+
+__all__ = ['scratch_directory', 'release_scratch', 'scratch_root',
+           'clean_scratch', 'scratch_usage', 'scratch_report']
+
+
+# shared memory filesystem the working directories go to by default
+TMPFS = Path('/dev/shm')
+
+# fraction of the node's tmpfs the working directories of all of its
+# processes may take up, unless `scratch_quota_mb` is configured
+DEFAULT_QUOTA_FRACTION = 0.5
+
+# working directories are named <stage>-<pid>-<uuid>@<host>, so that the
+# leftovers of processes that died can be found and removed
+NAME_PATTERN = re.compile(r'^(\w+)-(\d+)-([0-9a-f]+)@(.+)$')
+
+# bytes left in the working directories of each stage by this process,
+# split by where the directories were
+_USAGE = {}
+
+# roots this process has already cleaned
+_CLEANED = set()
+
+
+def scratch_name(stage, unique=True):
+    """Name of a working directory of `stage` owned by this process."""
+    token = uuid.uuid4().hex if unique else '0'
+    return f'{stage}-{os.getpid()}-{token}@{socket.gethostname()}'
+
+
+def scratch_root():
+    """Root of the working directories on tmpfs: `scratch_dir` from the
+    configuration file, or /dev/shm/zuds. None if it is not available."""
+    try:
+        root = get_secret('scratch_dir')
+    except KeyError:
+        root = None
+
+    if root is None:
+        if not TMPFS.is_dir():
+            return None
+        root = TMPFS / 'zuds'
+    return Path(root)
+
+
+def _directory_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                # removed in the meantime
+                pass
+    return total
+
+
+def _quota(root):
+    try:
+        quota = get_secret('scratch_quota_mb')
+    except KeyError:
+        quota = None
+
+    if quota is not None:
+        return float(quota) * 2 ** 20
+    stat = os.statvfs(root)
+    return DEFAULT_QUOTA_FRACTION * stat.f_blocks * stat.f_frsize
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's
+        return True
+    return True
+
+
+def clean_scratch(root):
+    """Remove the working directories under `root` left behind by
+    processes on this node that no longer exist (e.g., ranks that
+    crashed). Returns the number of bytes freed."""
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+
+    host = socket.gethostname()
+    freed = 0
+    for entry in root.iterdir():
+        match = NAME_PATTERN.match(entry.name)
+        if match is None or match.group(4) != host:
+            continue
+        if _pid_alive(int(match.group(2))):
+            continue
+        freed += _directory_bytes(entry)
+        shutil.rmtree(entry, ignore_errors=True)
+    return freed
+
+
+def _clean_once(root):
+    if root not in _CLEANED:
+        _CLEANED.add(root)
+        clean_scratch(root)
+
+
+def scratch_directory(stage, tmpdir='/tmp', nbytes=0):
+    """Create a working directory for the external tool run `stage` (e.g.,
+    'swarp', 'sextractor', 'hotpants') and return its path.
+
+    It goes on tmpfs (see `scratch_root`) unless the working directories
+    of all processes on the node, plus the `nbytes` this one is expected
+    to need, would go over the node's quota (`scratch_quota_mb`, default
+    half of the tmpfs) or over the free space, in which case it goes to
+    `tmpdir` on disk. Pass it to `release_scratch` when done. The
+    leftovers of dead processes are cleaned from a root the first time
+    this process uses it."""
+
+    root = scratch_root()
+    if root is not None:
+        root.mkdir(parents=True, exist_ok=True)
+        _clean_once(root)
+        stat = os.statvfs(root)
+        free = stat.f_bavail * stat.f_frsize
+        used = _directory_bytes(root)
+        if used + nbytes > _quota(root) or nbytes > free:
+            root = None
+
+    if root is None:
+        root = Path(tmpdir)
+        root.mkdir(parents=True, exist_ok=True)
+        _clean_once(root)
+
+    directory = root / scratch_name(stage)
+    directory.mkdir()
+    return directory
+
+
+def release_scratch(directory):
+    """Record the bytes left in the working directory `directory` against
+    its stage, and remove it."""
+    directory = Path(directory)
+    match = NAME_PATTERN.match(directory.name)
+    stage = match.group(1) if match is not None else 'unknown'
+    where = 'tmpfs' if directory.parent == scratch_root() else 'disk'
+
+    usage = _USAGE.setdefault(stage, {'tmpfs': 0, 'disk': 0, 'runs': 0})
+    usage[where] += _directory_bytes(directory)
+    usage['runs'] += 1
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def scratch_usage():
+    """Bytes this process has left in working directories, by stage: a
+    dict mapping each stage to a dict with the bytes on tmpfs and on disk
+    and the number of runs."""
+    return {stage: dict(usage) for stage, usage in _USAGE.items()}
+
+
+def scratch_report():
+    """One line per stage summarizing `scratch_usage`."""
+    lines = []
+    for stage, usage in sorted(_USAGE.items()):
+        lines.append(f'{stage}: {usage["runs"]} runs, '
+                     f'{usage["tmpfs"] / 2**20:.1f} MB on tmpfs, '
+                     f'{usage["disk"] / 2**20:.1f} MB on disk')
+    return '\n'.join(lines)
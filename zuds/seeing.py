@@ -1,35 +1,62 @@
+import os
+import threading
 import numpy as np
+from pathlib import Path
 
 from .secrets import get_secret
 from .catalog import PipelineFITSCatalog
+from .catalogstore import get_catalog_store, _radec_to_xyz, _chord
 
 
-__all__ = ['estimate_seeing']
+__all__ = ['estimate_seeing', 'calibrator_stars', 'catalog_seeing',
+           'half_sample_mode']
 
 
-def estimate_seeing(image):
-    """Estimate the seeing on an image by comparing its catalog to GAIA stars."""
-    from astropy.coordinates import SkyCoord
-    from astropy import units as u
-    import penquins
+# radius of the calibrator star queries around the image center (deg)
+CALIBRATOR_RADIUS = 1.2
 
-    catalog = image.catalog
+# default time to wait for a calibrator star query before falling back to
+# the catalog-only seeing estimate (sec)
+SEEING_QUERY_TIMEOUT = 30.
 
-    if catalog is None or not catalog.ismapped:
-        catalog = PipelineFITSCatalog.from_image(image)
+# in-memory cache of calibrator stars and their KD-trees, keyed by
+# (kind, field, ccdid, qid)
+_CALIBRATORS = {}
+
+# calibrator queries still running in the background after a timeout
+_PENDING = {}
+
+
+def _query_gaia(ra, dec):
+    """Positions of the Gaia DR2 stars (parallax > 0, G > 16) within
+    CALIBRATOR_RADIUS of (ra, dec): from the local catalog store if it has
+    a snapshot of Gaia, otherwise from Kowalski or, without Kowalski
+    credentials, from the Gaia archive."""
 
     # try to connect to kowalski to query gaia
     username = get_secret('kowalski_username')
     password = get_secret('kowalski_password')
 
-    if username is not None and password is not None:
+    store = get_catalog_store()
+
+    if store is not None and store.has('Gaia_DR2'):
+        # use the local snapshot of gaia
+        stars = store.cone_search('Gaia_DR2', ra, dec, CALIBRATOR_RADIUS,
+                                  columns=['parallax', 'phot_g_mean_mag'])
+        stars = stars[(stars['parallax'] > 0.) &
+                      (stars['phot_g_mean_mag'] > 16.)]
+        matchra = list(stars['ra'])
+        matchdec = list(stars['dec'])
+
+    elif username is not None and password is not None:
+        import penquins
 
         kowalski = penquins.Kowalski(username=username, password=password)
 
         q = {"query_type": "cone_search",
              "object_coordinates": {
-                 "radec": [(image.ra, image.dec)],
-                 "cone_search_radius": "1.2",
+                 "radec": [(ra, dec)],
+                 "cone_search_radius": f"{CALIBRATOR_RADIUS}",
                  "cone_search_unit": "deg"
              },
              "catalogs": {
@@ -65,7 +92,8 @@ def estimate_seeing(image):
 
         job = Gaia.launch_job("select ra, dec from gaiadr2.gaia_source "
                               f"WHERE 1=CONTAINS(POINT('ICRS', ra, dec), "
-                              f"CIRCLE('ICRS', {image.ra}, {image.dec}, {1.2}))"
+                              f"CIRCLE('ICRS', {ra}, {dec}, "
+                              f"{CALIBRATOR_RADIUS}))"
                               "AND parallax > 0 and phot_g_mean_mag > 16 ")
 
         r = job.get_results()
@@ -75,44 +103,246 @@ def estimate_seeing(image):
             matchra.append(row['ra'])
             matchdec.append(row['dec'])
 
+    return np.asarray(matchra, dtype=float), np.asarray(matchdec, dtype=float)
+
+
+def _query_sdss(ra, dec):
+    """Positions of the SDSS point sources with 16 < r < 19 within
+    CALIBRATOR_RADIUS of (ra, dec)."""
+    from astroquery.sdss import SDSS
+    from astropy.coordinates import SkyCoord
+
+    pos = SkyCoord(ra, dec, unit='deg')
+
+    g = SDSS.query_region(pos, radius=f'{CALIBRATOR_RADIUS} deg',
+                          photoobj_fields=['ra', 'dec',
+                                           'probPSF',
+                                           'psfMag_r']
+                          )
+
+    if g is None:
+        return np.zeros(0), np.zeros(0)
+
+    calibrators = g[(g['probPSF'] > 0.9) &
+                    (g['psfMag_r'] < 19) &
+                    (g['psfMag_r'] > 16)]
+    return np.asarray(calibrators['ra'], dtype=float), \
+        np.asarray(calibrators['dec'], dtype=float)
+
+
+def _calibrator_cache_path(kind, field, ccdid, qid):
+    try:
+        cache_dir = get_secret('calibrator_cache_dir')
+    except KeyError:
+        return None
+
+    if cache_dir is None:
+        return None
+    return Path(cache_dir) / f'{kind}_{field:06d}_c{ccdid:02d}_q{qid}.npy'
+
+
+def calibrator_stars(image, kind='gaia'):
+    """Calibrator stars for the seeing estimate of `image`, as a KD-tree
+    over their unit vectors. `kind` is 'gaia' or 'sdss'.
+
+    The stars of each (field, ccdid, qid) are queried once and cached, in
+    memory and, if `calibrator_cache_dir` is configured, on disk as an
+    (N, 2) array of (ra, dec), so every later image of the quadrant is
+    matched locally. Images without a field/ccdid/qid are not cached."""
+    return _calibrator_tree(kind, image.ra, image.dec, *_quadrant(image))
+
+
+def _quadrant(image):
+    return (getattr(image, 'field', None), getattr(image, 'ccdid', None),
+            getattr(image, 'qid', None))
+
+
+def _calibrator_tree(kind, ra, dec, field, ccdid, qid):
+    from scipy.spatial import cKDTree
+
+    query = {'gaia': _query_gaia, 'sdss': _query_sdss}[kind]
+    key = (kind, field, ccdid, qid)
+    cacheable = None not in key[1:]
+
+    if cacheable and key in _CALIBRATORS:
+        return _CALIBRATORS[key]
+
+    path = _calibrator_cache_path(*key) if cacheable else None
+    if path is not None and path.exists():
+        radec = np.load(path)
+    else:
+        radec = np.stack(query(ra, dec), axis=-1).reshape(-1, 2)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmppath = path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmppath, 'wb') as f:
+                np.save(f, radec)
+            os.replace(tmppath, path)
+
+    tree = cKDTree(_radec_to_xyz(radec[:, 0], radec[:, 1]).reshape(-1, 3))
+    if cacheable:
+        _CALIBRATORS[key] = tree
+    return tree
+
+
+def _match_calibrators(catalog, tree, radius=1.):
+    """Rows of `catalog` whose nearest calibrator is within `radius`
+    arcsec."""
+    if tree.n == 0:
+        return catalog.data[:0]
+    catxyz = _radec_to_xyz(catalog.data['X_WORLD'], catalog.data['Y_WORLD'])
+    d, _ = tree.query(catxyz, k=1)
+    return catalog.data[d < _chord(radius / 3600.)]
+
+
+def half_sample_mode(values):
+    """Robust mode of `values` (Bickel & Fruhwirth 2006): repeatedly keep
+    the shortest interval containing half of the sorted values."""
+    x = np.sort(np.asarray(values, dtype=float))
+    x = x[np.isfinite(x)]
+    if len(x) == 0:
+        return np.nan
+    while len(x) > 3:
+        h = (len(x) + 1) // 2
+        widths = x[h - 1:] - x[:len(x) - h + 1]
+        i = int(np.argmin(widths))
+        x = x[i:i + h]
+    if len(x) == 3:
+        # keep the closer pair, or the middle value if it is equidistant
+        left, right = x[1] - x[0], x[2] - x[1]
+        if left < right:
+            x = x[:2]
+        elif left > right:
+            x = x[1:]
+        else:
+            x = x[1:2]
+    return float(np.mean(x))
+
+
+def catalog_seeing(catalog, min_snr=20., min_class_star=0.9,
+                   max_elongation=1.3, min_stars=10):
+    """Estimate the seeing (FWHM in pixels) from an image's own SExtractor
+    catalog, without any external catalog.
+
+    Unsaturated, unmasked, isolated (FLAGS == 0, IMAFLAGS_ISO == 0),
+    round, high signal-to-noise point sources (CLASS_STAR > min_class_star,
+    where the catalog has it) are selected, and the seeing is the
+    half-sample mode of their FWHM_IMAGE, which is insensitive to the tail
+    of galaxies and blends that pass the cuts."""
+
+    data = catalog.data
+    names = data.dtype.names
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = data['FLUX_AUTO'] / data['FLUXERR_AUTO']
+
+    ok = (data['FLAGS'] == 0) & (snr > min_snr) & \
+         (data['FWHM_IMAGE'] > 0.5) & (data['ELONGATION'] < max_elongation)
+    if 'IMAFLAGS_ISO' in names:
+        ok &= data['IMAFLAGS_ISO'] == 0
+    if 'CLASS_STAR' in names:
+        ok &= data['CLASS_STAR'] > min_class_star
+
+    if ok.sum() < min_stars:
+        raise RuntimeError(f'Only {ok.sum()} point sources pass the cuts '
+                           f'(need {min_stars}) to estimate the seeing from '
+                           f'the catalog.')
+
+    return half_sample_mode(data['FWHM_IMAGE'][ok])
+
 
-    matchcoord = SkyCoord(matchra, matchdec, unit='deg')
-    catcoord = SkyCoord(catalog.data['X_WORLD'], catalog.data['Y_WORLD'], unit='deg')
+def _calibrators_with_timeout(image, kind, timeout):
+    # run the (possibly remote) calibrator query in a daemon thread. if it
+    # does not finish in time, leave it running so it still fills the
+    # cache for later images of the quadrant, and return None. if it
+    # fails (e.g., kowalski is down), report the error and return None
+    key = (kind, *_quadrant(image))
+    if key in _CALIBRATORS:
+        _PENDING.pop(key, None)
+        return _CALIBRATORS[key]
 
-    idx, d2d, _ = catcoord.match_to_catalog_sky(matchcoord)
-    ind = d2d < 1 * u.arcsec
-    catok = catalog.data[ind]
+    args = (kind, image.ra, image.dec, *key[1:])
+    if None in key:
+        key = args
 
-    # if there are no matches in gaia, try sdss
-    if len(catok) == 0:
-        from astroquery.sdss import SDSS
-        pos = SkyCoord(image.ra, image.dec, unit='deg')
+    pending = _PENDING.get(key)
+    if pending is None:
+        result = {}
+        done = threading.Event()
 
-        g = SDSS.query_region(pos, radius='1.2 deg',
-                              photoobj_fields=['ra', 'dec',
-                                               'probPSF',
-                                               'psfMag_r']
-                              )
+        def target():
+            try:
+                result['tree'] = _calibrator_tree(*args)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
 
-        calibrators = g[(g['probPSF'] > 0.9) &
-                        (g['psfMag_r'] < 19) &
-                        (g['psfMag_r'] > 16)]
+        pending = _PENDING[key] = (done, result)
+        threading.Thread(target=target, daemon=True).start()
 
-        matchcoord = SkyCoord(calibrators['ra'], calibrators['dec'], unit='deg')
-        idx, d2d, _ = catcoord.match_to_catalog_sky(matchcoord)
-        ind = d2d < 1 * u.arcsec
-        catok = catalog.data[ind]
+    done, result = pending
+    if not done.wait(timeout):
+        return None
 
-        if len(catok) == 0:
+    _PENDING.pop(key, None)
+    if 'error' in result:
+        print(f'Calibrator query for "{image.basename}" failed: '
+              f'{result["error"]!r}', flush=True)
+        return None
+    return result['tree']
+
+
+def estimate_seeing(image, timeout=None):
+    """Estimate the seeing on an image by comparing its catalog to GAIA stars.
+
+    If the calibrator stars of the quadrant cannot be retrieved within
+    `timeout` seconds (default: `seeing_query_timeout` from the
+    configuration file, or 30 sec), the query fails, or no calibrators
+    are found, the seeing is estimated from the image catalog alone
+    (`catalog_seeing`)."""
+
+    catalog = image.catalog
+
+    if catalog is None or not catalog.ismapped:
+        catalog = PipelineFITSCatalog.from_image(image)
+
+    if timeout is None:
+        try:
+            timeout = get_secret('seeing_query_timeout')
+        except KeyError:
+            timeout = None
+        timeout = SEEING_QUERY_TIMEOUT if timeout is None else float(timeout)
+
+    catok = []
+    for kind in ['gaia', 'sdss']:
+        # if there are no matches in gaia, try sdss
+        tree = _calibrators_with_timeout(image, kind, timeout)
+        if tree is None:
+            print(f'Calibrator query for "{image.basename}" timed out or '
+                  f'failed, estimating the seeing from the catalog',
+                  flush=True)
+            break
+        catok = _match_calibrators(catalog, tree)
+        if len(catok) > 0:
+            break
+
+    if len(catok) > 0:
+        seeings = []
+        for row in catok:
+            fwhm = row['FWHM_IMAGE']
+            seeings.append(fwhm)
+
+        seeing = np.nanmedian(seeings)
+        comment = 'FWHM of seeing in pixels (Goldstein)'
+    else:
+        try:
+            seeing = catalog_seeing(catalog)
+        except RuntimeError:
             raise RuntimeError('Unable to find any calibrators to estimate '
                                f'the seeing on "{image.basename}"')
+        comment = 'FWHM of seeing in pixels (SExtractor stars)'
 
-    seeings = []
-    for row in catok:
-        fwhm = row['FWHM_IMAGE']
-        seeings.append(fwhm)
-
-    seeing = np.nanmedian(seeings)
     image.header['SEEING'] = float(seeing)
-    image.header_comments['SEEING'] = 'FWHM of seeing in pixels (Goldstein)'
+    image.header_comments['SEEING'] = comment
     image.save()
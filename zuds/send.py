@@ -1,71 +1,242 @@
 """ This code sends ZUDS alerts to IPAC topics """
 import os
-import pickle
+import time
 import json
 from io import BytesIO
+from pathlib import Path
 
+from .secrets import get_secret
 
-__all__ = ['send_alert']
 
+__all__ = ['send_alert', 'load_alert_schema', 'alert_topic', 'encode_alert',
+           'KafkaSink', 'FileSink', 'AlertSender']
 
-def combine_schemas(schema_files):
-    """Combine multiple nested schemas into a single schema.
-    Taken from Eric's lsst-dm Github page
-    """
-    import avro.schema
-    known_schemas = avro.schema.Names()
-
-    for s in schema_files:
-        schema = load_single_avsc(s, known_schemas)
-    # using schema.to_json() doesn't fully propagate the nested schemas
-    # work around as below
-    props = dict(schema.props)
-    fields_json = [field.to_json() for field in props['fields']]
-    props['fields'] = fields_json
-    return props
-
-
-def load_single_avsc(file_path, names):
-    """Load a single avsc file.
-    Taken from Eric's lsst-dm Github page
-    """
 
-    import avro.schema
-    curdir = os.path.dirname(__file__)
-    file_path = os.path.join(curdir, '..', 'alert_schemas', file_path)
+IPAC_BROKERS = 'ztfalerts04.ipac.caltech.edu:9092,' \
+               'ztfalerts05.ipac.caltech.edu:9092,' \
+               'ztfalerts06.ipac.caltech.edu:9092'
 
-    with open(file_path) as file_text:
-        json_data = json.load(file_text)
-    schema = avro.schema.SchemaFromJSONData(json_data, names)
-    return schema
+# nested schemas of each alert type, in dependency order
+ALERT_SCHEMA_FILES = {
+    'single': ['schema_single/candidate.avsc',
+               'schema_single/light_curve.avsc',
+               'schema_single/alert.avsc'],
+    'stack': ['schema_stack/candidate.avsc',
+              'schema_stack/light_curve.avsc',
+              'schema_stack/alert.avsc']
+}
 
+_SCHEMAS = {}
 
-def send(topicname, records, schema):
-    """ Send an avro "packet" to a particular topic at IPAC
-    Parameters
-    ----------
-    topic: name of the topic, e.g. ztf_20191221_programid2_zuds
-    records: a list of dictionaries
-    schema: schema definition
-    """
-    # Parse the schema file
-    #schema_definition = fastavro.schema.load_schema(schemafile)
 
-    # Write into an in-memory "file"
+def load_alert_schema(alert_type):
+    """Parse the nested avro schema of `alert_type` ('single' or 'stack')
+    with fastavro. The schema is parsed once per process and cached."""
 
     import fastavro
-    import confluent_kafka
 
-    out = BytesIO()
-    fastavro.writer(out, schema, records)
-    out.seek(0) # go back to the beginning
+    try:
+        return _SCHEMAS[alert_type]
+    except KeyError:
+        pass
+
+    curdir = os.path.dirname(__file__)
+    named_schemas = {}
+    for fname in ALERT_SCHEMA_FILES[alert_type]:
+        path = os.path.join(curdir, 'alert_schemas', fname)
+        with open(path) as f:
+            schema = fastavro.parse_schema(json.load(f),
+                                           named_schemas=named_schemas)
+
+    _SCHEMAS[alert_type] = schema
+    return schema
+
+
+def alert_topic(alert_object):
+    """Name of the IPAC topic an alert is written to, e.g.,
+    ztf_20191221_programid2_zuds (_stack for stack alerts)."""
+    ac = alert_object.created_at
+    alert_date = f'{ac.year}{ac.month:02d}{ac.day:02d}'
+    topicname = f'ztf_{alert_date}_programid2_zuds'
+    if alert_object.alert['candidate']['alert_type'] == 'stack':
+        topicname += '_stack'
+    return topicname
 
-    # Connect to the IPAC Kafka brokers
-    producer = confluent_kafka.Producer({'bootstrap.servers': 'ztfalerts04.ipac.caltech.edu:9092,ztfalerts05.ipac.caltech.edu:9092,ztfalerts06.ipac.caltech.edu:9092'})
 
-    # Send an avro alert
-    producer.produce(topic=topicname, value=out.read())
-    producer.flush()
+def encode_alert(record, schema):
+    """Serialize a single alert record as an avro container (the format
+    IPAC expects on the topics)."""
+    import fastavro
+    out = BytesIO()
+    fastavro.writer(out, schema, [record])
+    return out.getvalue()
+
+
+class KafkaSink(object):
+    """Writes messages to Kafka, keeping one producer per topic for the
+    lifetime of the sink. Messages are pipelined: `produce` only queues
+    them, and delivery is confirmed through the callback on `poll` or
+    `flush`."""
+
+    def __init__(self, bootstrap_servers=None, config=None):
+        if bootstrap_servers is None:
+            try:
+                bootstrap_servers = get_secret('kafka_bootstrap_servers')
+            except KeyError:
+                bootstrap_servers = None
+        self.bootstrap_servers = bootstrap_servers or IPAC_BROKERS
+        self.config = config or {}
+        self._producers = {}
+
+    def producer(self, topic):
+        import confluent_kafka
+        try:
+            return self._producers[topic]
+        except KeyError:
+            config = {'bootstrap.servers': self.bootstrap_servers}
+            config.update(self.config)
+            producer = self._producers[topic] = \
+                confluent_kafka.Producer(config)
+            return producer
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        producer = self.producer(topic)
+        while True:
+            try:
+                producer.produce(topic=topic, value=value, key=key,
+                                 on_delivery=on_delivery)
+                break
+            except BufferError:
+                # local queue is full, wait for deliveries to drain it
+                producer.poll(1)
+        producer.poll(0)
+
+    def flush(self, timeout=None):
+        """Block until all queued messages are delivered. Returns the
+        number of messages still undelivered."""
+        remaining = 0
+        for producer in self._producers.values():
+            if timeout is None:
+                remaining += producer.flush()
+            else:
+                remaining += producer.flush(timeout)
+        return remaining
+
+
+class FileSink(object):
+    """Drop-in replacement for `KafkaSink` that writes each message to
+    `directory`/<topic>/<key>.avro (or a running number if no key is
+    given). Used for testing and dry runs."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.count = 0
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        topicdir = self.directory / topic
+        topicdir.mkdir(parents=True, exist_ok=True)
+        name = key.decode() if isinstance(key, bytes) else key
+        if name is None:
+            name = f'{self.count:08d}'
+        path = topicdir / f'{name}.avro'
+        with open(path, 'wb') as f:
+            f.write(value)
+        self.count += 1
+        if on_delivery is not None:
+            on_delivery(None, path)
+
+    def flush(self, timeout=None):
+        return 0
+
+
+class AlertSender(object):
+    """Sends alerts to their topics through a long-lived `sink`
+    (`KafkaSink` by default, `FileSink` for testing).
+
+    Schemas are parsed once per process, and alerts are queued with one
+    `produce` call each and flushed once per batch, instead of opening a
+    producer and flushing for every alert. Delivery is tracked by the
+    delivery callbacks: `flush` returns the alerts that were delivered
+    since the previous flush, and errors are stored in `self.errors`,
+    keyed by candid."""
+
+    def __init__(self, sink=None, schemas=None):
+        self.sink = KafkaSink() if sink is None else sink
+        self.schemas = schemas or {}
+        self.nsent = 0
+        self.errors = {}
+        self._delivered = []
+        self._nproduced = 0
+        self._start = None
+
+    def schema(self, alert_type):
+        try:
+            return self.schemas[alert_type]
+        except KeyError:
+            schema = self.schemas[alert_type] = load_alert_schema(alert_type)
+            return schema
+
+    def encode(self, alert_object):
+        record = alert_object.to_dict()
+        alert_type = record['candidate']['alert_type']
+        return encode_alert(record, self.schema(alert_type))
+
+    def _on_delivery(self, alert_object):
+        def on_delivery(err, msg):
+            if err is None:
+                self._delivered.append(alert_object)
+            else:
+                self.errors[alert_object.alert['candid']] = err
+        return on_delivery
+
+    def produce(self, alert_object, value=None):
+        """Queue one alert. Does not wait for it to be delivered. `value`
+        is the encoded alert, if it was already encoded (see `encode`)."""
+        if alert_object.sent:
+            raise RuntimeError(f'Refusing to send alert '
+                               f'{alert_object.alert["objectId"]},'
+                               f' alert has already been sent out.')
+
+        if self._start is None:
+            self._start = time.time()
+
+        if value is None:
+            value = self.encode(alert_object)
+        self.sink.produce(alert_topic(alert_object), value,
+                          key=str(alert_object.alert['candid']).encode(),
+                          on_delivery=self._on_delivery(alert_object))
+        self._nproduced += 1
+
+    def flush(self, timeout=None):
+        """Wait for the queued alerts to be delivered, and return the list
+        of alerts delivered since the last flush."""
+
+        remaining = self.sink.flush(timeout)
+        stop = time.time()
+        start = stop if self._start is None else self._start
+
+        delivered = self._delivered
+        nfailed = self._nproduced - len(delivered) - remaining
+        self.nsent += len(delivered)
+        rate = len(delivered) / max(stop - start, 1e-9)
+        print(f'sent {len(delivered)} alerts in {stop - start:.2f} sec '
+              f'({rate:.1f} alerts/s), {nfailed} failed, '
+              f'{remaining} undelivered', flush=True)
+
+        self._delivered = []
+        self._nproduced = 0
+        self._start = None
+        return delivered
+
+    def send(self, alert_objects, timeout=None):
+        """Send a batch of alerts and wait for them to be delivered.
+        Returns the list of alerts that were delivered."""
+        for alert_object in alert_objects:
+            self.produce(alert_object)
+        return self.flush(timeout)
+
+
+_SENDER = None
 
 
 def send_alert(alert_object):
@@ -73,37 +244,12 @@ def send_alert(alert_object):
     Send an alert to IPAC. Figure out the alert type,
     and write to the relevant topic.
     """
-    # Placeholder -- alert creation date UTC
-    # Eventually this will come from the alert
-
-    if alert_object.sent:
-        raise RuntimeError(f'Refusing to send alert '
-                           f'{alert_object.alert["objectId"]},'
-                           f' alert has already been sent out.')
-
-
-    ac = alert_object.created_at
-    alert_date = f'{ac.year}{ac.month:02d}{ac.day:02d}'
-    alert = alert_object.to_dict()
-
-    imtype = alert['candidate']['alert_type']
-    if imtype == 'single':
-        schema = combine_schemas(
-            ["schema_single/candidate.avsc", "schema_single/light_curve.avsc",
-             "schema_single/alert.avsc"])
-        topicname = "ztf_%s_programid2_zuds" %alert_date
-        send(topicname, [alert], schema)
-    elif imtype == 'stack':
-        schema = combine_schemas(
-            ["schema_stack/candidate.avsc", "schema_stack/light_curve.avsc",
-             "schema_stack/alert.avsc"])
-        topicname = "ztf_%s_programid2_zuds_stack" %alert_date
-        send(topicname, [alert], schema)
-
-
-if __name__=="__main__":
-    alerts = pickle.load(open('zuds_alerts.test2.pkl','rb'))
-    for ii,alert in enumerate(alerts):
-        print(ii)
-        print(alert['candidate']['alert_type'])
-        send_alert(alert)
+    global _SENDER
+    if _SENDER is None:
+        _SENDER = AlertSender()
+
+    delivered = _SENDER.send([alert_object])
+    if len(delivered) == 0:
+        raise RuntimeError(f'Alert {alert_object.alert["candid"]} was not '
+                           f'delivered: '
+                           f'{_SENDER.errors.get(alert_object.alert["candid"])}')
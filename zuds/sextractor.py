@@ -1,13 +1,13 @@
 import numpy as np
 import subprocess
 from pathlib import Path
-import shutil
-import uuid
 
 import os
 
 from .core import ZTFFile
 from .constants import BKG_BOX_SIZE, MASK_BORDER
+from .virtual import stage_product
+from .scratch import scratch_directory, release_scratch
 
 __all__ = ['prepare_sextractor', 'run_sextractor']
 
@@ -96,8 +96,8 @@ def prepare_sextractor(image, directory, checkimage_type=None,
         syscall += f'-WEIGHT_IMAGE {weightname} -WEIGHT_TYPE MAP_WEIGHT'
 
     else:
-        syscall += f'-WEIGHT_IMAGE {image.weight_image.local_path} ' \
-                   f'-WEIGHT_TYPE MAP_WEIGHT'
+        wgtpath = stage_product(image.weight_image, directory)
+        syscall += f'-WEIGHT_IMAGE {wgtpath} -WEIGHT_TYPE MAP_WEIGHT'
 
     for kw in sextractor_kws:
         syscall += f' -{kw} {sextractor_kws[kw]} '
@@ -115,8 +115,10 @@ def run_sextractor(image, checkimage_type=None, catalog_type='FITS_LDAC',
     from .image import FITSImage
     from .catalog import PipelineFITSCatalog
 
-    directory = Path(tmpdir) / uuid.uuid4().hex
-    directory.mkdir(exist_ok=True, parents=True)
+    # the weight map (staged or written) or the false weight map is about
+    # the size of the image
+    directory = scratch_directory('sextractor', tmpdir=tmpdir,
+                                  nbytes=os.path.getsize(image.local_path))
 
     command, outnames = prepare_sextractor(
         image, directory, checkimage_type=checkimage_type,
@@ -146,5 +148,5 @@ def run_sextractor(image, checkimage_type=None, catalog_type='FITS_LDAC',
             product.fid = image.fid
         result.append(product)
 
-    shutil.rmtree(directory)
+    release_scratch(directory)
     return result
@@ -0,0 +1,166 @@
+import os
+import math
+import numpy as np
+from pathlib import Path
+
+from .secrets import get_secret
+
+__all__ = ['sgtable_strip', 'build_sgscore_index', 'SGScoreIndex',
+           'get_sgscore_index']
+
+
+PSC_PATTERN = 'hlsp_ps1-psc_ps1_gpc1_*_multi_v1_cat.fits'
+
+
+def sgtable_strip(dec):
+    """Integer label of the 1-degree declination strip of the Tachibana and
+    Miller (2018) PS1 point source catalog that contains `dec`.
+
+    For positive declinations, this integer specifies the lower limit,
+    such that strip 7 contains sources in the range [7,8]. For negative
+    declinations, it specifies the upper limit, such that strip -7 contains
+    sources in the range [-8,-7]."""
+    if dec >= 0:
+        return math.floor(dec)
+    else:
+        return math.floor(dec) + 1
+
+
+def _index_paths(index_dir, strip):
+    index_dir = Path(index_dir)
+    return (index_dir / f'ps1_psc_{strip:d}.objid.npy',
+            index_dir / f'ps1_psc_{strip:d}.score.npy')
+
+
+def _strip_from_filename(fname):
+    # hlsp_ps1-psc_ps1_gpc1_<declination>_multi_v1_cat.fits
+    return int(Path(fname).name.split('_')[4])
+
+
+def build_sgscore_index(files=None, index_dir=None, overwrite=False):
+    """Convert PS1 point source catalog strips into objid-sorted
+    lookup tables that can be memory mapped by `SGScoreIndex`.
+
+    This is a one-time build step. For each strip, two flat .npy files are
+    written to `index_dir`: the sorted int64 objids and the float32
+    ps_scores in the same order. Files are written to a temporary name and
+    renamed into place, so concurrent readers never see a partial index.
+
+    Parameters
+    ----------
+    files: paths of the hlsp_ps1-psc_*.fits strips to convert. Defaults to
+        all strips in the `ps1_dir` directory from the configuration file.
+    index_dir: output directory. Defaults to `ps1_index_dir` from the
+        configuration file.
+    overwrite: if False, strips that already have an index are skipped.
+
+    Returns
+    -------
+    written: list of strips that were converted
+    """
+    import fitsio
+
+    if files is None:
+        files = sorted(Path(get_secret('ps1_dir')).glob(PSC_PATTERN))
+
+    if index_dir is None:
+        index_dir = get_secret('ps1_index_dir')
+
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    written = []
+    for fname in np.atleast_1d(files):
+        strip = _strip_from_filename(fname)
+        idpath, scorepath = _index_paths(index_dir, strip)
+        if idpath.exists() and scorepath.exists() and not overwrite:
+            continue
+
+        data = fitsio.read(str(fname), columns=['objid', 'ps_score'], ext=1)
+        objid = np.asarray(data['objid'], dtype='<i8')
+        score = np.asarray(data['ps_score'], dtype='<f4')
+
+        order = np.argsort(objid, kind='stable')
+        for path, arr in zip([idpath, scorepath],
+                             [objid[order], score[order]]):
+            tmppath = path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmppath, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmppath, path)
+
+        print(f'Indexed {len(objid)} sources from {fname} into {idpath}',
+              flush=True)
+        written.append(strip)
+
+    return written
+
+
+class SGScoreIndex(object):
+    """Read-only objid -> ps_score lookup over the tables written by
+    `build_sgscore_index`.
+
+    The tables are opened with np.load(mmap_mode='r'), so every process on a
+    node shares a single copy of the pages through the OS page cache and
+    nothing is parsed on the lookup path. Each lookup is a binary search
+    over the sorted objids of one declination strip."""
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        self._strips = {}
+
+    def _load(self, strip):
+        try:
+            return self._strips[strip]
+        except KeyError:
+            idpath, scorepath = _index_paths(self.index_dir, strip)
+            if idpath.exists() and scorepath.exists():
+                tables = (np.load(idpath, mmap_mode='r'),
+                          np.load(scorepath, mmap_mode='r'))
+            else:
+                tables = None
+            self._strips[strip] = tables
+            return tables
+
+    def lookup(self, objids, decs):
+        """Return the ps_score of each PS1 objid in `objids`, located in the
+        declination strip of the corresponding entry of `decs`. Objects
+        that are not in the index get a score of NaN."""
+
+        objids = np.atleast_1d(np.asarray(objids, dtype='<i8'))
+        decs = np.broadcast_to(np.atleast_1d(decs), objids.shape)
+        scores = np.full(objids.shape, np.nan)
+
+        strips = np.asarray([sgtable_strip(d) for d in decs])
+        for strip in np.unique(strips):
+            tables = self._load(int(strip))
+            if tables is None or len(tables[0]) == 0:
+                continue
+            ids, psc = tables
+            sel = np.flatnonzero(strips == strip)
+            pos = np.searchsorted(ids, objids[sel])
+            pos[pos == len(ids)] = len(ids) - 1
+            found = ids[pos] == objids[sel]
+            scores[sel[found]] = psc[pos[found]]
+
+        return scores
+
+
+_INDEX = {}
+
+
+def get_sgscore_index():
+    """Return the process-wide `SGScoreIndex` for the `ps1_index_dir`
+    configured in the secrets file, or None if no index is configured."""
+    try:
+        index_dir = get_secret('ps1_index_dir')
+    except KeyError:
+        return None
+
+    if index_dir is None:
+        return None
+
+    try:
+        return _INDEX[index_dir]
+    except KeyError:
+        index = _INDEX[index_dir] = SGScoreIndex(index_dir)
+        return index
@@ -18,6 +18,37 @@ import numpy as np
 __all__ = ['Source']
 
 
+_LIGHT_CURVE_COLUMNS = (
+    ForcedPhotometry.obsjd - MJD_TO_JD,
+    ForcedPhotometry.filtercode,
+    ForcedPhotometry.zp,
+    ForcedPhotometry.flux,
+    ForcedPhotometry.fluxerr,
+    ForcedPhotometry.flags,
+    ForcedPhotometry.id
+)
+
+
+def _light_curve_table(phot):
+    """Convert rows of `_LIGHT_CURVE_COLUMNS` into a light curve table."""
+    from astropy.table import Table
+    lc_raw = []
+
+    for photpoint in phot:
+        photd = {'mjd': photpoint[0],
+                 'filter': 'ztf' + photpoint[1][-1],
+                 'zp': photpoint[2],  # ap-correct the ZP
+                 'zpsys': 'ab',
+                 'flux': photpoint[3],
+                 'fluxerr': photpoint[4],
+                 'flags': photpoint[5],
+                 'lim_mag': -2.5 * np.log10(5 * photpoint[4]) + photpoint[2],
+                 'id': photpoint[-1]}
+        lc_raw.append(photd)
+
+    return Table(lc_raw)
+
+
 class Source(Base, SpatiallyIndexed):
     id = sa.Column(sa.String, primary_key=True)
     # TODO should this column type be decimal? fixed-precison numeric
@@ -82,34 +113,36 @@ class Source(Base, SpatiallyIndexed):
 
     @property
     def light_curve(self):
-        from astropy.table import Table
-        lc_raw = []
-
         phot = DBSession().query(
-            ForcedPhotometry.obsjd - MJD_TO_JD,
-            ForcedPhotometry.filtercode,
-            ForcedPhotometry.zp,
-            ForcedPhotometry.flux,
-            ForcedPhotometry.fluxerr,
-            ForcedPhotometry.flags,
-            ForcedPhotometry.id
+            *_LIGHT_CURVE_COLUMNS
         ).filter(
             ForcedPhotometry.source_id == self.id
+        ).order_by(
+            ForcedPhotometry.id
         )
 
+        return _light_curve_table(phot)
+
+    @classmethod
+    def light_curves(cls, source_ids):
+        """Light curves of many sources from a single query. Returns a
+        dictionary mapping each source id to the table that
+        `Source.light_curve` would return for it."""
+
+        phot = DBSession().query(
+            ForcedPhotometry.source_id, *_LIGHT_CURVE_COLUMNS
+        ).filter(
+            ForcedPhotometry.source_id.in_(list(source_ids))
+        ).order_by(
+            ForcedPhotometry.id
+        )
+
+        rows = {source_id: [] for source_id in source_ids}
         for photpoint in phot:
-            photd = {'mjd': photpoint[0],
-                     'filter': 'ztf' + photpoint[1][-1],
-                     'zp': photpoint[2],  # ap-correct the ZP
-                     'zpsys': 'ab',
-                     'flux': photpoint[3],
-                     'fluxerr': photpoint[4],
-                     'flags': photpoint[5],
-                     'lim_mag': -2.5 * np.log10(5 * photpoint[4]) + photpoint[2],
-                     'id': photpoint[-1]}
-            lc_raw.append(photd)
-
-        return Table(lc_raw)
+            rows[photpoint[0]].append(photpoint[1:])
+
+        return {source_id: _light_curve_table(rows[source_id])
+                for source_id in rows}
 
     @property
     def unphotometered_images(self):
@@ -0,0 +1,452 @@
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import BKG_BOX_SIZE, BKG_VAL, GROUP_PROPERTIES
+from .secrets import get_secret
+from .arraykernels import (DATA_DTYPE, as_data_array, add_constant,
+                           mask_dtype)
+from .background import background_meshes, _cell_statistics, _fill_and_filter
+from .bitmask import BitMask
+
+__all__ = ['coadd_grid', 'lanczos_resample', 'combine_stack',
+           'background_mesh', 'run_native_coadd']
+
+
+# order of the lanczos resampling kernel (swarp RESAMPLING_TYPE LANCZOS3)
+LANCZOS_ORDER = 3
+
+# outlier rejection of the clipped combine, as in
+# astromatic/makecoadd/default.swarp
+CLIP_SIGMA = 4.
+CLIP_AMPFRAC = 0.3
+
+# header keywords copied from the first input to the coadd (swarp
+# COPY_KEYWORDS)
+COPY_KEYWORDS = ['OBJECT', 'FIELDID', 'CCDID', 'QID', 'FILTERID', 'FID']
+
+# spacing, in output pixels, of the grid on which the output to input
+# pixel mapping is computed exactly. it is interpolated bilinearly in
+# between (swarp PROJECTION_ERR)
+MAPPING_STEP = 16
+
+# default memory budget of a native coadd (MB)
+DEFAULT_MEMORY_MB = 1024
+
+# bytes per input pixel of a band of rows whose background mesh is being
+# computed: the data, mask and weight rows, the good pixel map, and the
+# good pixels of each cell
+MESH_BYTES_PER_PIXEL = 32
+
+
+def _config(key, default):
+    try:
+        value = get_secret(key)
+    except KeyError:
+        return default
+    return default if value is None else value
+
+
+def coadd_grid(wcss, shapes):
+    """Tangent-plane WCS and shape of the output grid of a coadd of images
+    with astropy WCSs `wcss` and array shapes `shapes`: centered on the
+    middle of their footprint, at their median pixel scale, and large
+    enough to hold all of them (swarp CENTER_TYPE ALL, PIXELSCALE_TYPE
+    MEDIAN)."""
+    from astropy.wcs import WCS
+    from astropy.wcs.utils import proj_plane_pixel_scales
+
+    corners = np.concatenate([
+        w.calc_footprint(axes=(s[1], s[0])) for w, s in zip(wcss, shapes)
+    ])
+    ra, dec = corners[:, 0], corners[:, 1]
+    dra = (ra - ra[0] + 180.) % 360. - 180.
+    ra0 = (ra[0] + (dra.min() + dra.max()) / 2) % 360.
+    dec0 = (dec.min() + dec.max()) / 2
+    scale = np.median([proj_plane_pixel_scales(w).mean() for w in wcss])
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra0, dec0]
+    wcs.wcs.crpix = [1., 1.]
+    wcs.wcs.cd = [[-scale, 0.], [0., scale]]
+
+    x, y = wcs.all_world2pix(ra, dec, 0)
+    # the footprint corners are pixel centers
+    x0, y0 = np.round(x.min()), np.round(y.min())
+    shape = (int(np.round(y.max() - y0)) + 1, int(np.round(x.max() - x0)) + 1)
+    wcs.wcs.crpix = [1. - x0, 1. - y0]
+    return wcs, shape
+
+
+def _lanczos(x, a=LANCZOS_ORDER):
+    return np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0.)
+
+
+def lanczos_resample(data, good, x, y, a=LANCZOS_ORDER):
+    """Interpolate `data` at the 0-based pixel coordinates (`x`, `y`) with a
+    lanczos kernel of order `a`. Pixels where `good` is False (and pixels
+    off the image) are left out and the kernel is renormalized over the
+    others. Returns the interpolated values and the fraction of the kernel
+    that fell on good pixels."""
+
+    ny, nx = data.shape
+    width = nx + 2 * a
+
+    # pad by the kernel half width, so that every tap of a point on (or
+    # just off) the image is a fixed offset from its base pixel
+    padded = np.zeros((ny + 2 * a, width))
+    padded[a:-a, a:-a] = np.where(good, data, 0.)
+    flat = padded.ravel()
+
+    padgood = np.zeros((ny + 2 * a, width))
+    padgood[a:-a, a:-a] = good
+    flatgood = padgood.ravel()
+
+    ix = np.floor(x).astype(int)
+    iy = np.floor(y).astype(int)
+    fx = x - ix
+    fy = y - iy
+    ix = np.clip(ix, -1, nx - 1)
+    iy = np.clip(iy, -1, ny - 1)
+    base = (iy + a) * width + ix + a
+
+    taps = range(-a + 1, a + 1)
+    wx = [_lanczos(fx - i, a) for i in taps]
+    wy = [_lanczos(fy - j, a) for j in taps]
+
+    out = np.zeros(x.shape)
+    norm = np.zeros(x.shape)
+    total = np.zeros(x.shape)
+    for j, wj in zip(taps, wy):
+        for i, wi in zip(taps, wx):
+            ind = base + (j * width + i)
+            w = wj * wi
+            total += w
+            w *= flatgood.take(ind)
+            out += w * flat.take(ind)
+            norm += w
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(norm != 0, out / norm, 0.)
+        frac = np.where(total != 0, norm / total, 0.)
+    return values, frac
+
+
+def background_mesh(data, good, box=BKG_BOX_SIZE, filtersize=3):
+    """Background of an image on a mesh of `box` x `box` pixel cells: the
+    median of the good pixels of each cell, median filtered over
+    `filtersize` cells (swarp / SExtractor BACK_SIZE, BACK_FILTERSIZE).
+    Cells without good pixels take the median of the others."""
+    return background_meshes(data, good, box=box, filtersize=filtersize)[0]
+
+
+def _input_mesh(inp, box=BKG_BOX_SIZE, filtersize=3):
+    # `background_mesh` of an input, reading it a band of `box` rows at a
+    # time rather than all at once
+    ny = inp.shape[0]
+    bands = [_cell_statistics(inp.data[r0:r0 + box],
+                              inp.good(slice(r0, r0 + box)), box=box)[0]
+             for r0 in range(0, ny, box)]
+    return _fill_and_filter(np.concatenate(bands), filtersize)
+
+
+def _mesh_workers(nx, nthreads, memory_mb, box=BKG_BOX_SIZE):
+    # inputs whose meshes can be computed at once within `memory_mb`
+    band = box * nx * MESH_BYTES_PER_PIXEL
+    return int(np.clip(memory_mb * 2 ** 20 // band, 1, max(nthreads, 1)))
+
+
+def _evaluate_mesh(mesh, x, y, box=BKG_BOX_SIZE):
+    # bilinear interpolation of a background mesh between the cell centers
+    from scipy.ndimage import map_coordinates
+    return map_coordinates(mesh, [(y + 0.5) / box - 0.5,
+                                  (x + 0.5) / box - 0.5],
+                           order=1, mode='nearest')
+
+
+def combine_stack(values, weights, combine='clipped'):
+    """Combine a stack of resampled images `values` (n, ny, nx) with
+    inverse variance `weights` (0 where an input has no data) into an image
+    and its weight map.
+
+    `combine` is 'weighted' (inverse variance weighted mean), 'median', or
+    'clipped' (weighted mean of the inputs within CLIP_SIGMA sigma plus
+    CLIP_AMPFRAC of the median flux of the median, swarp CLIPPED)."""
+
+    has = weights > 0
+    if combine == 'weighted':
+        keep = has
+    elif combine in ('median', 'clipped'):
+        stack = np.where(has, values, np.nan)
+        with warnings.catch_warnings():
+            # all-nan slices, i.e., pixels no input covers
+            warnings.simplefilter('ignore', RuntimeWarning)
+            med = np.nanmedian(stack, axis=0)
+        if combine == 'median':
+            wsum = weights.sum(axis=0)
+            return np.where(np.isnan(med), 0., med), wsum
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma = np.where(has, 1. / np.sqrt(weights), np.inf)
+            keep = has & (np.abs(values - med) <=
+                          CLIP_SIGMA * sigma + CLIP_AMPFRAC * np.abs(med))
+    else:
+        raise ValueError(f'Unknown combine type "{combine}", must be '
+                         f'"weighted", "median" or "clipped".')
+
+    w = np.where(keep, weights, 0.)
+    wsum = w.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        image = np.where(wsum > 0, (w * values).sum(axis=0) / wsum, 0.)
+    return image, wsum
+
+
+def _fluxscale(header):
+    # factor that scales an image to a zeropoint of 25
+    if 'MAGZP' in header:
+        return 10 ** (-0.4 * (header['MAGZP'] - 25.))
+    return 1.
+
+
+class _Input(object):
+    # one memory-mapped input of a native coadd
+
+    def __init__(self, image):
+        self.image = image
+        self._hduls = []
+        self.data = self._open(image.local_path)
+        self.mask = self._open(image.mask_image.local_path)
+        weight = image.weight_image
+        self.weight = self._open(weight.local_path) if weight.ismapped \
+            else weight.data
+        self.wcs = image.wcs
+        self.shape = self.data.shape
+
+        self.fluxscale = _fluxscale(image.header)
+
+    def _open(self, path):
+        from astropy.io import fits
+        hdul = fits.open(path, memmap=True)
+        self._hduls.append(hdul)
+        return hdul[0].data
+
+    def good(self, rows):
+        good = BitMask(self.mask[rows]).any()
+        np.logical_not(good, out=good)
+        good &= np.asarray(self.weight[rows]) > 0
+        return good
+
+    def close(self):
+        for hdul in self._hduls:
+            hdul.close()
+
+
+def _pixel_mapping(outwcs, inwcs, rows, nx, step=MAPPING_STEP):
+    # input pixel coordinates of the output pixels in `rows`, computed
+    # exactly every `step` pixels and bilinearly interpolated in between
+    from scipy.ndimage import map_coordinates
+
+    r0, r1 = rows.start, rows.stop
+    gy = np.arange(r0, r1 + step, step, dtype=float)
+    gx = np.arange(0, nx + step, step, dtype=float)
+    X, Y = np.meshgrid(gx, gy)
+    ra, dec = outwcs.all_pix2world(X, Y, 0)
+    ix, iy = inwcs.all_world2pix(ra, dec, 0, quiet=True)
+
+    y, x = np.mgrid[r0:r1, 0:nx].astype(float)
+    coords = [(y - r0) / step, x / step]
+    return (map_coordinates(ix, coords, order=1, mode='nearest'),
+            map_coordinates(iy, coords, order=1, mode='nearest'))
+
+
+def _chunk_rows(ny, nx, ninputs, nthreads, memory_mb):
+    # rows of output per chunk that keep the working set of `nthreads`
+    # chunks under `memory_mb`: the values, weights and masks of every
+    # input, plus the temporaries of the resampling, per output pixel
+    bytes_per_row = nx * (ninputs * 48 + 200)
+    chunk = int(memory_mb * 2 ** 20 / (bytes_per_row * max(nthreads, 1)))
+    return int(np.clip(chunk, MAPPING_STEP, ny))
+
+
+def _resample_chunk(inp, mesh, outwcs, rows, nx, subtract_back):
+    # resample the part of one input that lands on the output `rows`
+    a = LANCZOS_ORDER
+    x, y = _pixel_mapping(outwcs, inp.wcs, rows, nx)
+    shape = (rows.stop - rows.start, nx)
+
+    ny_in, nx_in = inp.shape
+    covered = (x > -0.5) & (x < nx_in - 0.5) & (y > -0.5) & (y < ny_in - 0.5)
+    if not covered.any():
+        return (np.zeros(shape), np.zeros(shape),
+                np.zeros(shape, dtype=np.int64), covered)
+
+    # only read the input rows under this chunk
+    ya = max(int(np.floor(y[covered].min())) - a, 0)
+    yb = min(int(np.ceil(y[covered].max())) + a + 1, ny_in)
+    inrows = slice(ya, yb)
+    data = np.asarray(inp.data[inrows], dtype=float)
+    good = inp.good(inrows)
+    weight = np.asarray(inp.weight[inrows], dtype=float)
+    mask = np.asarray(inp.mask[inrows]).astype(np.int64)
+
+    values, frac = lanczos_resample(data, good, x, y - ya, a=a)
+    if subtract_back:
+        values -= _evaluate_mesh(mesh, x, y)
+
+    # nearest input pixel for the weights and the mask bits
+    nx_ = np.clip(np.round(x).astype(int), 0, nx_in - 1)
+    ny_ = np.clip(np.round(y).astype(int) - ya, 0, yb - ya - 1)
+    w = np.where(covered & (frac > 0.5), weight[ny_, nx_], 0.)
+    w *= good[ny_, nx_]
+    m = np.where(covered, mask[ny_, nx_], 0)
+
+    # scale to the common zeropoint
+    values *= inp.fluxscale
+    w /= inp.fluxscale ** 2
+    return values, w, m, covered
+
+
+def run_native_coadd(cls, images, outname, mskoutname, addbkg=True,
+                     nthreads=1, combine='clipped', mask_combine='and',
+                     subtract_back=True, memory_mb=None):
+    """Coadd `images` in process, as a drop-in replacement for `run_coadd`
+    (which runs swarp twice).
+
+    The inputs are scaled to a common zeropoint of 25 from their MAGZP in
+    memory (the input files are not rewritten), background subtracted
+    (BKG_BOX_SIZE meshes), resampled with a lanczos3 kernel onto the grid
+    of `coadd_grid`, and combined with `combine_stack`. The masks are
+    resampled to the nearest pixel and combined with a bitwise AND (a
+    pixel is flagged in the coadd only if every input covering it flags
+    it, as with swarp's mask combine) or OR (`mask_combine`='or'). Output
+    pixels no input covers get bit 16.
+
+    The output is produced in chunks of rows, reading only the input rows
+    under each chunk from the memory-mapped inputs, with `nthreads`
+    threads and chunk sizes that keep the working set under `memory_mb`
+    (default: `coadd_memory_mb` from the configuration file, or 1024).
+    The background meshes are also computed from bands of input rows,
+    on as many threads as fit in `memory_mb`."""
+
+    if memory_mb is None:
+        memory_mb = float(_config('coadd_memory_mb', DEFAULT_MEMORY_MB))
+    if mask_combine not in ('and', 'or'):
+        raise ValueError(f'Unknown mask combine type "{mask_combine}", must '
+                         f'be "and" or "or".')
+
+    inputs = [_Input(image) for image in images]
+    try:
+        outwcs, (ny, nx) = coadd_grid([i.wcs for i in inputs],
+                                      [i.shape for i in inputs])
+
+        # the background meshes are computed a band of rows of each input
+        # at a time, on as many threads as fit in `memory_mb`
+        meshes = [None] * len(inputs)
+        if subtract_back:
+            nworkers = _mesh_workers(max(i.shape[1] for i in inputs),
+                                     nthreads, memory_mb)
+            with ThreadPoolExecutor(max_workers=nworkers) as pool:
+                meshes = list(pool.map(_input_mesh, inputs))
+
+        chunk = _chunk_rows(ny, nx, len(inputs), nthreads, memory_mb)
+
+        coadd = np.zeros((ny, nx), dtype=DATA_DTYPE)
+        weight = np.zeros((ny, nx), dtype=DATA_DTYPE)
+        mask = np.zeros((ny, nx), dtype=mask_dtype(2 ** 17 - 1))
+
+        def work(r0):
+            rows = slice(r0, min(r0 + chunk, ny))
+            parts = [_resample_chunk(inp, mesh, outwcs, rows, nx,
+                                     subtract_back)
+                     for inp, mesh in zip(inputs, meshes)]
+            values = np.stack([p[0] for p in parts])
+            weights = np.stack([p[1] for p in parts])
+            image, wsum = combine_stack(values, weights, combine=combine)
+
+            covered = np.stack([p[3] for p in parts])
+            bits = np.stack([p[2] for p in parts])
+            if mask_combine == 'and':
+                m = np.bitwise_and.reduce(
+                    np.where(covered, bits, -1), axis=0
+                )
+            else:
+                m = np.bitwise_or.reduce(bits, axis=0)
+            ncover = covered.sum(axis=0)
+            m = np.where(ncover > 0, m, 0) + np.where(ncover > 0, 0, 2 ** 16)
+
+            coadd[rows] = image
+            weight[rows] = wsum
+            mask[rows] = m
+
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(work, range(0, ny, chunk)))
+    finally:
+        for inp in inputs:
+            inp.close()
+
+    header = _coadd_header(images, outwcs, combine)
+    return _write_coadd(cls, images, outname, mskoutname, header, coadd,
+                        weight, mask, addbkg)
+
+
+def _coadd_header(images, outwcs, combine):
+    # header of a coadd of `images` on the grid `outwcs`
+    header = outwcs.to_header(relax=True)
+    first = images[0].header
+    for key in COPY_KEYWORDS:
+        if key in first:
+            header[key] = first[key]
+
+    headers = [image.header for image in images]
+    scales = [_fluxscale(h) for h in headers]
+    if any('MAGZP' in h for h in headers):
+        header['FLXSCLZP'] = (25., 'FLXSCALE equivalent ZP / DG')
+    if all('SATURATE' in h for h in headers):
+        header['SATURATE'] = (min(h['SATURATE'] * s
+                                  for h, s in zip(headers, scales)),
+                              'Saturation level of the scaled inputs')
+    if all('GAIN' in h for h in headers):
+        header['GAIN'] = (sum(h['GAIN'] / s for h, s in zip(headers, scales)),
+                          'Effective gain of the coadd')
+    header['NCOMBINE'] = (len(images), 'Number of coadded images')
+    header['COMBINET'] = (combine.upper(), 'Combine type')
+    header['COADDENG'] = ('NATIVE', 'Coadd engine')
+    return header
+
+
+def _write_coadd(cls, images, outname, mskoutname, header, coadd, weight,
+                 mask, addbkg):
+    # write a coadd, its weight map and mask, and load them as run_coadd
+    # does
+    from astropy.io import fits
+    from .image import FITSImage
+    from .mask import MaskImage
+
+    wgtoutname = outname.replace('.fits', '.weight.fits')
+    fits.writeto(outname, as_data_array(coadd), header=header,
+                 overwrite=True)
+    fits.writeto(wgtoutname, as_data_array(weight), header=header,
+                 overwrite=True)
+    fits.writeto(mskoutname, mask.astype(mask_dtype(mask.max())),
+                 header=header, overwrite=True)
+
+    result = cls.from_file(outname)
+    result._weightimg = FITSImage.from_file(wgtoutname)
+
+    coaddmask = MaskImage.from_file(mskoutname)
+    coaddmask.refresh_bit_mask_entries_in_header()
+
+    result.input_images = list(images)
+    result.mask_image = coaddmask
+    coaddmask.parent_image = result
+
+    for prop in GROUP_PROPERTIES:
+        for img in [result, coaddmask]:
+            setattr(img, prop, getattr(images[0], prop))
+
+    if addbkg:
+        result.data = add_constant(result.data, BKG_VAL)
+
+    result.save()
+    coaddmask.save()
+    return result
@@ -0,0 +1,101 @@
+import os
+import uuid
+import errno
+import shutil
+from pathlib import Path
+
+__all__ = ['stage_file', 'commit_file', 'commit_files']
+
+
+# linux ioctl that makes `dst` a copy-on-write clone of `src` (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def stage_file(src, directory):
+    """Make the file `src` available in the working directory `directory`
+    without copying its contents, and return the staged path.
+
+    The file is hard linked into the directory if possible, otherwise
+    cloned (reflink) on filesystems that support it, otherwise symlinked
+    (e.g., if `directory` is on another filesystem). It is only copied if
+    none of these work.
+
+    A staged input shares its data with the original, so it must be
+    treated as read only: files in the working directory are replaced,
+    never modified in place. `FITSFile.save` does this (astropy and fitsio
+    unlink the file before writing it), so re-saving a staged image
+    detaches it from the original instead of overwriting it."""
+
+    src = Path(src)
+    dst = Path(directory) / src.name
+
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+
+    try:
+        _reflink(src, dst)
+        return dst
+    except OSError:
+        pass
+
+    try:
+        os.symlink(src.absolute(), dst)
+        return dst
+    except OSError:
+        pass
+
+    shutil.copy(src, dst)
+    return dst
+
+
+def commit_file(src, dst):
+    """Move the finished product `src` to `dst` atomically: readers of
+    `dst` see either the previous version of the file or the complete new
+    one, never a partial write.
+
+    Within a filesystem this is a single rename. Across filesystems `src`
+    is first copied next to `dst` under a temporary name, which is then
+    renamed over `dst`."""
+
+    src = Path(src)
+    dst = Path(dst)
+
+    try:
+        os.replace(src, dst)
+        return dst
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp = dst.with_name(f'.{dst.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if tmp.exists():
+            os.remove(tmp)
+        raise
+    os.remove(src)
+    return dst
+
+
+def commit_files(product_map):
+    """Commit the products of a transaction, a dict mapping working paths
+    to final paths, in order. Put the file whose presence signals a
+    complete set of products last."""
+    for src, dst in product_map.items():
+        commit_file(src, dst)
@@ -0,0 +1,121 @@
+import os
+import mmap
+import struct
+import datetime
+from pathlib import Path
+
+from .secrets import get_secret
+
+__all__ = ['StampStore', 'get_stamp_store']
+
+
+# one entry of the offset index that sits next to each pack: the offset
+# and length of a stamp in the pack, and the id of its thumbnail row
+INDEX_ENTRY = struct.Struct('<QIq')
+
+
+class StampStore(object):
+    """Append-only storage of gzipped FITS stamps outside the database.
+
+    Stamps are appended to one pack file per night, stamps_<YYYYMMDD>.pack
+    in `root`, so that a thumbnail row only needs to hold the name of the
+    pack and the offset and length of its payload. Each pack has an offset
+    index (a .idx file of fixed-size (offset, length, thumbnail id)
+    entries) from which the mapping can be rebuilt without the database.
+
+    Appends take an exclusive lock on the pack, so any number of
+    processes can write to the same night. Reads memory map the packs,
+    so reading any number of stamps from a pack is one mmap lookup plus
+    slicing."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._maps = {}
+
+    def pack_name(self, night=None):
+        if night is None:
+            night = datetime.datetime.utcnow()
+        if isinstance(night, (datetime.date, datetime.datetime)):
+            night = f'{night.year}{night.month:02d}{night.day:02d}'
+        return f'stamps_{night}.pack'
+
+    def append(self, payloads, night=None, ids=None):
+        """Append the byte strings `payloads` to the pack of `night` (UTC
+        today by default). `ids` are the thumbnail ids recorded in the
+        offset index (-1 if unknown). Returns the pack name and the list
+        of (offset, length) of the payloads."""
+        import fcntl
+
+        payloads = list(payloads)
+        if ids is None:
+            ids = [-1] * len(payloads)
+
+        name = self.pack_name(night)
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / name
+
+        extents = []
+        with open(path, 'ab') as f, open(path.with_suffix('.idx'), 'ab') as fi:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                for payload in payloads:
+                    extents.append((offset, len(payload)))
+                    offset += len(payload)
+                f.write(b''.join(payloads))
+                f.flush()
+                fi.write(b''.join(
+                    INDEX_ENTRY.pack(o, n, -1 if i is None else i)
+                    for (o, n), i in zip(extents, ids)
+                ))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return name, extents
+
+    def _map(self, name, end):
+        m = self._maps.get(name)
+        if m is None or len(m) < end:
+            # the pack has grown since it was mapped
+            if m is not None:
+                m.close()
+            with open(self.root / name, 'rb') as f:
+                m = self._maps[name] = mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ)
+        return m
+
+    def read(self, name, offset, length):
+        """Return the payload at (`offset`, `length`) of pack `name`."""
+        return self._map(name, offset + length)[offset:offset + length]
+
+    def read_many(self, refs):
+        """Return the payloads of a list of (name, offset, length)."""
+        return [self.read(*ref) for ref in refs]
+
+    def index(self, name):
+        """Read the offset index of pack `name` as a list of (offset,
+        length, thumbnail id)."""
+        with open((self.root / name).with_suffix('.idx'), 'rb') as f:
+            data = f.read()
+        return list(INDEX_ENTRY.iter_unpack(data))
+
+
+_STORE = {}
+
+
+def get_stamp_store():
+    """Return the process-wide `StampStore` in the `stamp_store_dir`
+    configured in the secrets file, or None if it is not configured."""
+    try:
+        root = get_secret('stamp_store_dir')
+    except KeyError:
+        return None
+
+    if root is None:
+        return None
+
+    try:
+        return _STORE[root]
+    except KeyError:
+        store = _STORE[root] = StampStore(root)
+        return store
@@ -1,9 +1,7 @@
 import os
+import time
 import shutil
-import uuid
-import subprocess
 import numpy as np
-from pathlib import Path
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
@@ -13,15 +11,28 @@ from .fitsfile import HasWCS
 from .image import (CalibratableImageBase, ScienceImage, CalibratableImage,
                     FITSImage, CalibratedImage)
 from .mask import MaskImageBase, MaskImage
-from .coadd import _coadd_from_images, ScienceCoadd
-from .constants import APER_KEY
+from .bitmask import BitMask
+from .coadd import _coadd_from_images, _coadd_engine, ScienceCoadd
+from .constants import APER_KEY, GROUP_PROPERTIES
 from .archive import archive
+from .staging import stage_file, commit_files
+from .virtual import stage_product
+from .scratch import scratch_directory, release_scratch
+from .secrets import get_secret
 
 
 __all__ = ['sub_name', 'Subtraction', 'SingleEpochSubtraction',
            'MultiEpochSubtraction']
 
 
+def _autotune_default():
+    try:
+        autotune = get_secret('subtraction_autotune')
+    except KeyError:
+        return False
+    return bool(autotune)
+
+
 def sub_name(frame, template):
     frame = f'{frame}'
     template = f'{template}'
@@ -58,32 +69,65 @@ class Subtraction(HasWCS):
     def from_images(cls, sci, ref, data_product=False, tmpdir='/tmp',
                     **kwargs):
 
-        from .hotpants import prepare_hotpants
+        from .hotpants import run_hotpants, run_hotpants_tiled
+        from .kernelcache import get_kernel_cache, residual_quality
+        from .tuning import tune_subtraction, record_subtraction
+        from .fftsub import fft_subtract
         from astropy.io import fits
 
         subtract_new_back = kwargs.get('subtract_back', True)
-        nreg_side = kwargs.get('nreg_side', 3)
-        hotpants_kws = kwargs.get('hotpants_kws', {})
-
-        directory = Path(tmpdir) / uuid.uuid4().hex
-        directory.mkdir(exist_ok=True, parents=True)
-
-        # we are gonna copy the inputs into the directory, then reload them
-        # off of disk to keep things transactionally isolated
-        shutil.copy(sci.local_path, directory)
-        shutil.copy(sci.mask_image.local_path, directory)
+        nreg_side = kwargs.get('nreg_side')
+        hotpants_kws = dict(kwargs.get('hotpants_kws') or {})
+        backend = kwargs.get('backend', 'hotpants')
+        tiled = kwargs.get('tiled', False)
+
+        # choose the regions and kernel order that were not given from the
+        # recorded runs of this quadrant, and record this run
+        autotune = kwargs.get('autotune')
+        if autotune is None:
+            autotune = _autotune_default()
+
+        if autotune and backend == 'hotpants' and not tiled and \
+                (nreg_side is None or 'ko' not in hotpants_kws):
+            tuned_nreg_side, tuned_ko = tune_subtraction(sci)
+            if nreg_side is None:
+                nreg_side = tuned_nreg_side
+            hotpants_kws.setdefault('ko', tuned_ko)
+
+        if nreg_side is None:
+            nreg_side = 3
+
+        # kernel solution of the last subtraction against this reference
+        kernel_cache = get_kernel_cache() if \
+            kwargs.get('reuse_kernel', True) else None
+        solution = kernel_cache.load(ref) if kernel_cache is not None \
+            else None
+
+        if backend not in ('hotpants', 'fft'):
+            raise ValueError(f'Unknown subtraction backend "{backend}", '
+                             f'must be "hotpants" or "fft".')
+
+        # the virtual weight or rms maps of the images are written to the
+        # directory, each about the size of the science image
+        nbytes = 2 * os.path.getsize(sci.local_path)
+        directory = scratch_directory(backend, tmpdir=tmpdir, nbytes=nbytes)
+
+        # stage the inputs in the directory (linked, not copied), then reload
+        # them off of disk to keep things transactionally isolated
+        stage_file(sci.local_path, directory)
+        stage_file(sci.mask_image.local_path, directory)
 
         if hasattr(sci, '_rmsimg'):
-            shutil.copy(sci.rms_image.local_path, directory)
+            stage_product(sci.rms_image, directory)
         elif hasattr(sci, '_weightimg'):
-            shutil.copy(sci.weight_image.local_path, directory)
+            stage_product(sci.weight_image, directory)
         else:
             raise ValueError('Science image must have a weight map or '
                              'rms map defined prior to subtraction.')
 
-        shutil.copy(ref.local_path, directory)
-        shutil.copy(ref.mask_image.local_path, directory)
-        shutil.copy(ref.weight_image.local_path, directory)
+        stage_file(ref.local_path, directory)
+        stage_file(ref.mask_image.local_path, directory)
+        stage_product(ref.weight_image, directory)
 
         sciname = os.path.join(directory, sci.basename)
         scimaskn = os.path.join(directory, sci.mask_image.basename)
@@ -132,8 +176,10 @@ class Subtraction(HasWCS):
         submask.fid = sci.fid
 
         submask.map_to_local_file(outmask)
-        badpix = remapped_refmask.data | sci.mask_image.data
-        submask.data = badpix
+        # wide enough for the hotpants bit (17) set below
+        badpix = BitMask.union([remapped_refmask.data, sci.mask_image.data],
+                               maxbit=17)
+        submask.data = badpix.data
         submask.header = sci.mask_image.header
         submask.header_comments = sci.mask_image.header_comments
         submask.save()
@@ -141,25 +187,50 @@ class Subtraction(HasWCS):
         submask.boolean.map_to_local_file(directory / submask.boolean.basename)
         submask.boolean.save()
 
-        command = prepare_hotpants(transact_sci, remapped_ref, outname,
-                                   submask.boolean, directory, tmpdir=tmpdir,
-                                   nreg_side=nreg_side,
-                                   subtract_new_back=subtract_new_back,
-                                   hotpants_kws=hotpants_kws
-                                   )
-
         final_dir = os.path.dirname(sci.local_path)
         final_out = os.path.join(final_dir, os.path.basename(outname))
+        # the subtraction itself goes last, so that its presence in the
+        # final directory implies the rms and mask are complete
         product_map = {
-            outname: final_out,
             outname.replace('.fits', '.rms.fits'): final_out.replace('.fits',
                                                                      '.rms.fits'),
             outname.replace('.fits', '.mask.fits'): final_out.replace(
-                '.fits', '.mask.fits')
+                '.fits', '.mask.fits'),
+            outname: final_out
         }
 
-        # run HOTPANTS
-        subprocess.check_call(command.split())
+        start = time.time()
+        if backend == 'hotpants' and tiled:
+            # run HOTPANTS on the kernel regions concurrently
+            run_hotpants_tiled(transact_sci, remapped_ref, outname,
+                               submask.boolean, directory, tmpdir=tmpdir,
+                               nreg_side=nreg_side,
+                               subtract_new_back=subtract_new_back,
+                               hotpants_kws=hotpants_kws,
+                               nprocs=kwargs.get('nprocs'))
+            solution = None
+        elif backend == 'hotpants':
+            # run HOTPANTS
+            solution = run_hotpants(transact_sci, remapped_ref, outname,
+                                    submask.boolean, directory,
+                                    tmpdir=tmpdir, nreg_side=nreg_side,
+                                    subtract_new_back=subtract_new_back,
+                                    hotpants_kws=hotpants_kws,
+                                    solution=solution)
+        else:
+            # fit and convolve the kernel in process
+            solution = fft_subtract(transact_sci, remapped_ref, outname,
+                                    submask.boolean, directory,
+                                    tmpdir=tmpdir, nreg_side=nreg_side,
+                                    subtract_new_back=subtract_new_back,
+                                    fft_kws=kwargs.get('fft_kws'),
+                                    solution=solution)
+
+        walltime = time.time() - start
+
+        # warm start the next subtraction against this reference
+        if kernel_cache is not None and solution is not None:
+            kernel_cache.save(ref, solution)
 
         # now modify the sub mask to include the stuff that's masked out from
         # hotpants
@@ -167,20 +238,34 @@ class Subtraction(HasWCS):
         with fits.open(outname) as hdul:
             sd = hdul[0].data
 
-        hotbad = np.zeros_like(submask.data, dtype=int)
-        hotbad[sd == 1e-30] = 2**17
+        hotbad = sd == 1e-30
+
+        if autotune:
+            zstd, fmask = residual_quality(
+                sd, fits.getdata(outname.replace('.fits', '.rms.fits'))
+            )
+            if backend == 'hotpants':
+                ko = int(hotpants_kws.get('ko', 4))
+                bgo = int(hotpants_kws.get('bgo', 0))
+            else:
+                ko = None
+                bgo = int((kwargs.get('fft_kws') or {}).get('bg_order', 0))
+            record_subtraction(sci, ref, backend, nreg_side, ko, bgo,
+                               walltime, zstd, fmask,
+                               input_masked_fraction=float(
+                                   np.mean(submask.data != 0)
+                               ), tiled=tiled)
 
         # flip the bits
-        submask.data |= hotbad
+        submask.data = submask.bits.set(2 ** 17, hotbad).data
         submask.header['BIT17'] = 17
         submask.header_comments['BIT17'] = 'MASKED BY HOTPANTS (1e-30) / DG'
         submask.save()
 
-        # now copy the output files to the target directory, ending the
+        # now move the output files to the target directory, ending the
         # transaction
 
-        for f in product_map:
-            shutil.copy(f, product_map[f])
+        commit_files(product_map)
 
         # now read the final output products into database mapped records
         sub = cls.from_file(final_out, load_others=False)
@@ -221,7 +306,7 @@ class Subtraction(HasWCS):
             archive(sub)
             archive(sub.mask_image)
 
-        shutil.rmtree(directory)
+        release_scratch(directory)
 
         return sub
 
@@ -258,6 +343,81 @@ def overlapping_subtractions(sci, ref):
     return subq.all()
 
 
+def _previous_stack(images, ref, basename):
+    """The multi-epoch subtraction against `ref`, other than `basename`,
+    that shares the most inputs with `images`, or None."""
+    from .joins import StackedSubtractionFrame
+
+    row = DBSession().query(
+        MultiEpochSubtraction,
+        sa.func.count(StackedSubtractionFrame.singleepochsubtraction_id)
+    ).join(
+        StackedSubtractionFrame,
+        StackedSubtractionFrame.multiepochsubtraction_id ==
+        MultiEpochSubtraction.id
+    ).filter(
+        MultiEpochSubtraction.reference_image_id == ref.id,
+        MultiEpochSubtraction.basename != basename,
+        StackedSubtractionFrame.singleepochsubtraction_id.in_(
+            [image.id for image in images]
+        )
+    ).group_by(
+        MultiEpochSubtraction.id
+    ).order_by(
+        sa.func.count(StackedSubtractionFrame.singleepochsubtraction_id).desc()
+    ).first()
+
+    return None if row is None else row[0]
+
+
+def _stack_from_previous(cls, previous, images, outfile_name, nthreads=1):
+    """Make the stack of the subtractions `images` from the stack
+    `previous`, by copying it and its accumulator and then adding and
+    removing only the inputs that differ. Returns None if `previous` has
+    no accumulator, or if that would resample at least as many images as
+    making the stack from scratch."""
+    from .accumulator import accumulator_path, update_coadd_inputs
+
+    inputs = list(previous.input_images)
+    remove = [image for image in inputs if image not in images]
+    add = [image for image in images if image not in inputs]
+    if len(add) + len(remove) >= len(images):
+        return None
+
+    if not previous.ismapped:
+        previous.basic_map(quiet=True)
+    accpath = accumulator_path(previous.local_path)
+    if not os.path.exists(accpath):
+        return None
+
+    mskoutname = outfile_name.replace('.fits', '.mask.fits')
+    for src, dst in [
+        (previous.local_path, outfile_name),
+        (previous.local_path.replace('.fits', '.weight.fits'),
+         outfile_name.replace('.fits', '.weight.fits')),
+        (previous.mask_image.local_path, mskoutname),
+        (accpath, accumulator_path(outfile_name))
+    ]:
+        shutil.copy(src, dst)
+
+    coadd = cls.from_file(outfile_name)
+    coaddmask = MaskImage.from_file(mskoutname)
+    coadd.mask_image = coaddmask
+    coaddmask.parent_image = coadd
+    for prop in GROUP_PROPERTIES:
+        for img in [coadd, coaddmask]:
+            setattr(img, prop, getattr(images[0], prop))
+
+    for image in remove:
+        if not image.ismapped:
+            image.basic_map(quiet=True)
+
+    coadd.input_images = inputs
+    update_coadd_inputs(coadd, add=add, remove=remove, nthreads=nthreads,
+                        addbkg=False)
+    return coadd
+
+
 class MultiEpochSubtraction(Subtraction, CalibratableImage):
     id = sa.Column(sa.Integer, sa.ForeignKey('calibratableimages.id',
                                              ondelete='CASCADE'),
@@ -306,9 +466,22 @@ class MultiEpochSubtraction(Subtraction, CalibratableImage):
 
         outfile_name = sub_name(sci.local_path, ref.local_path)
 
-        coadd = _coadd_from_images(cls, images, outfile_name,
-                                   nthreads=nthreads, addbkg=False,
-                                   calculate_seeing=False)
+        # with the incremental engine, start from the stack of the
+        # previous (e.g., overlapping rolling window) bin, so that only the
+        # subtractions that entered or left the window are resampled
+        engine = _coadd_engine(kwargs.get('engine'))
+        coadd = None
+        if engine == 'incremental':
+            previous = _previous_stack(images, ref,
+                                       os.path.basename(outfile_name))
+            if previous is not None:
+                coadd = _stack_from_previous(cls, previous, images,
+                                             outfile_name, nthreads=nthreads)
+
+        if coadd is None:
+            coadd = _coadd_from_images(cls, images, outfile_name,
+                                       nthreads=nthreads, addbkg=False,
+                                       calculate_seeing=False, engine=engine)
 
         coadd.reference_image = ref
         coadd.target_image = sci
@@ -1,4 +1,4 @@
-import uuid
+import os
 import shutil
 from pathlib import Path
 import subprocess
@@ -7,9 +7,13 @@ import subprocess
 from .utils import initialize_directory
 from .constants import BKG_BOX_SIZE, GROUP_PROPERTIES, BKG_VAL
 from .mask import MaskImageBase, MaskImage
+from .staging import stage_file
+from .virtual import materialize
+from .scratch import scratch_directory, release_scratch
+from .arraykernels import add_constant
 
 __all__ = ['prepare_swarp_sci', 'prepare_swarp_mask', 'prepare_swarp_align',
-           'run_coadd', 'run_align']
+           'run_coadd', 'run_align', 'write_swarp_head']
 
 
 CONF_DIR = Path(__file__).parent / 'astromatic/makecoadd'
@@ -18,20 +22,43 @@ MSK_CONF = CONF_DIR / 'mask.swarp'
 
 
 
+def write_swarp_head(path, cards):
+    """Write the external header that swarp reads for the image at `path`
+    (HEADER_SUFFIX .head), with the keywords `cards`, a dict mapping each
+    keyword to a (value, comment) tuple. Its keywords take precedence
+    over those in the image's own header."""
+    from astropy.io import fits
+
+    header = fits.Header()
+    for key, (value, comment) in cards.items():
+        header[key] = (value, comment)
+
+    headpath = str(path).replace('.fits', '.head')
+    with open(headpath, 'w') as f:
+        for card in header.cards:
+            f.write(f'{card.image}\n')
+        f.write('END\n')
+    return headpath
+
+
 def prepare_swarp_sci(images, outname, directory, copy_inputs=False,
                       nthreads=1, swarp_kws=None):
     conf = SCI_CONF
     initialize_directory(directory)
 
-    if copy_inputs:
-        impaths = []
-        for image in images:
+    # stage the inputs in the working directory (hard links, not copies),
+    # so that swarp picks up the .head files written next to them
+    impaths = []
+    for image in images:
+        if copy_inputs:
             shutil.copy(image.local_path, directory)
             impaths.append(str(directory / image.basename))
-    else:
-        impaths = [im.local_path for im in images]
+        else:
+            impaths.append(str(stage_file(image.local_path, directory)))
 
-    # normalize all images to the same zeropoint
+    # normalize all images to the same zeropoint. the flux scales go into
+    # external headers that swarp reads instead of the input headers, so
+    # the inputs themselves are never rewritten
     for im, path in zip(images, impaths):
         if 'MAGZP' in im.header:
             fluxscale = 10**(-0.4 * (im.header['MAGZP'] - 25.))
@@ -39,21 +66,19 @@ def prepare_swarp_sci(images, outname, directory, copy_inputs=False,
             im.header_comments['FLXSCALE'] = 'Flux scale factor for coadd / DG'
             im.header['FLXSCLZP'] = 25.
             im.header_comments['FLXSCLZP'] = 'FLXSCALE equivalent ZP / DG'
-            opath = im.local_path
-            im.map_to_local_file(path)
-            im.save()
-            im.map_to_local_file(opath)
+            write_swarp_head(path, {
+                key: (im.header[key], im.header_comments[key])
+                for key in ['FLXSCALE', 'FLXSCLZP']
+            })
 
     # if weight images do not exist yet, write them to temporary
     # directory
     wgtpaths = []
     for image in images:
-        if not image.weight_image.ismapped or copy_inputs:
-            wgtpath = f"{directory / image.basename.replace('.fits', '.weight.fits')}"
-            image.weight_image.map_to_local_file(wgtpath)
-            image.weight_image.save()
+        if copy_inputs:
+            wgtpath = materialize(image.weight_image, directory)
         else:
-            wgtpath = image.weight_image.local_path
+            wgtpath = materialize(image.weight_image)
         wgtpaths.append(wgtpath)
 
     # need to write the images to a list, to avoid shell commands that are too
@@ -88,7 +113,7 @@ def prepare_swarp_sci(images, outname, directory, copy_inputs=False,
 
 
 def prepare_swarp_mask(masks, outname, mskoutweightname, directory,
-                       copy_inputs=False, nthreads=1):
+                       copy_inputs=False, nthreads=1, combine_type='AND'):
     conf = MSK_CONF
     initialize_directory(directory)
 
@@ -105,6 +130,7 @@ def prepare_swarp_mask(masks, outname, mskoutweightname, directory,
               f'-VMEM_DIR {directory} ' \
               f'-RESAMPLE_DIR {directory} ' \
               f'-WEIGHTOUT_NAME {mskoutweightname} ' \
+              f'-COMBINE_TYPE {combine_type} ' \
               f'-NTHREADS {nthreads}'
 
     return syscall
@@ -115,8 +141,12 @@ def prepare_swarp_align(image, other, directory, nthreads=1,
 
     from astropy.wcs import WCS
     conf = SCI_CONF
-    shutil.copy(image.local_path, directory)
-    impath = str(directory / image.basename)
+    if image.ismapped:
+        shutil.copy(image.local_path, directory)
+        impath = str(directory / image.basename)
+    else:
+        # a virtual product, e.g. an rms map
+        impath = materialize(image, directory)
     align_header = other.astropy_header
 
     # now get the WCS keys to align the header to
@@ -165,8 +195,7 @@ def run_align(image, other, tmpdir='/tmp',
 
     from .image import FITSImage
 
-    directory = Path(tmpdir) / uuid.uuid4().hex
-    directory.mkdir(exist_ok=True, parents=True)
+    directory = scratch_directory('align', tmpdir=tmpdir)
 
     command, outname, outweight = prepare_swarp_align(
         image, other,
@@ -205,19 +234,22 @@ def run_align(image, other, tmpdir='/tmp',
         del result._path
 
     # clean up the swarp working dir
-    shutil.rmtree(directory)
+    release_scratch(directory)
 
     return result
 
 
 def run_coadd(cls, images, outname, mskoutname, addbkg=True,
-              nthreads=1, tmpdir='/tmp', copy_inputs=False, swarp_kws=None):
-    """Run swarp on images `images`"""
+              nthreads=1, tmpdir='/tmp', copy_inputs=False, swarp_kws=None,
+              mask_combine='and'):
+    """Run swarp on images `images`. Their masks are combined with a
+    bitwise AND, or OR if `mask_combine` is 'or'."""
 
     from .image import FITSImage
 
-    directory = Path(tmpdir) / uuid.uuid4().hex
-    directory.mkdir(exist_ok=True, parents=True)
+    # swarp resamples every input and its weight map into the directory
+    nbytes = 2 * sum(os.path.getsize(image.local_path) for image in images)
+    directory = scratch_directory('swarp', tmpdir=tmpdir, nbytes=nbytes)
 
     command = prepare_swarp_sci(images, outname, directory,
                                 copy_inputs=copy_inputs,
@@ -241,7 +273,8 @@ def run_coadd(cls, images, outname, mskoutname, addbkg=True,
     mskoutweightname = directory / Path(mskoutname.replace('.fits', '.weight.fits')).name
     command = prepare_swarp_mask(masks, mskoutname, mskoutweightname,
                                  directory, copy_inputs=False,
-                                 nthreads=nthreads)
+                                 nthreads=nthreads,
+                                 combine_type=mask_combine.upper())
 
     # run swarp
     while True:
@@ -277,8 +310,13 @@ def run_coadd(cls, images, outname, mskoutname, addbkg=True,
         for img in [coadd, coaddmask]:
             setattr(img, prop, getattr(images[0], prop))
 
+    # the zeropoint of the flux scales in the external headers
+    if any('MAGZP' in image.header for image in images):
+        coadd.header['FLXSCLZP'] = 25.
+        coadd.header_comments['FLXSCLZP'] = 'FLXSCALE equivalent ZP / DG'
+
     if addbkg:
-        coadd.data += BKG_VAL
+        coadd.data = add_constant(coadd.data, BKG_VAL)
 
     # save the coadd to disk
     coadd.save()
@@ -286,8 +324,9 @@ def run_coadd(cls, images, outname, mskoutname, addbkg=True,
 
     # clean up
     for im in [coadd] + images.tolist():
-        if f'{directory}' in im.weight_image.local_path:
+        if im.weight_image.ismapped and \
+                f'{directory}' in im.weight_image.local_path:
             del im._weightimg
 
-    shutil.rmtree(directory)
+    release_scratch(directory)
     return coadd
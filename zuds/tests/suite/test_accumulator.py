@@ -0,0 +1,117 @@
+import os
+import uuid
+import pytest
+import numpy as np
+from astropy.io import fits
+
+import zuds
+
+
+def test_incremental_stack_add_remove(sci_image_data_20200531,
+                                      sci_image_data_20200601):
+    first, second = sci_image_data_20200531, sci_image_data_20200601
+    outdir = os.path.dirname(first.local_path)
+    outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+
+    stack = zuds.ReferenceImage.from_images([first, second], outname,
+                                            engine='incremental')
+    assert os.path.exists(zuds.accumulator_path(outname))
+    assert stack.header['NCOMBINE'] == 2
+    both = stack.data.copy()
+
+    stack.update_inputs(remove=[second], calculate_seeing=False)
+    assert stack.input_images == [first]
+    assert stack.header['NCOMBINE'] == 1
+    acc = zuds.CoaddAccumulator.load(zuds.accumulator_path(outname))
+    assert acc.image_ids == [first.id]
+
+    # the mask on disk describes the remaining input
+    scratchname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+    scratch = zuds.ReferenceImage.from_images([first], scratchname,
+                                              engine='incremental')
+    mask, header = fits.getdata(stack.mask_image.local_path, header=True)
+    np.testing.assert_array_equal(
+        mask, fits.getdata(scratch.mask_image.local_path)
+    )
+    assert header['NCOMBINE'] == 1
+
+    stack.update_inputs(add=[second], calculate_seeing=False)
+    assert len(stack.input_images) == 2
+    assert second in stack.input_images
+    np.testing.assert_allclose(stack.data, both, atol=1e-3)
+
+    zuds.DBSession().add(stack)
+    zuds.DBSession().commit()
+
+
+def test_incremental_stack_rejects_bad_updates(sci_image_data_20200531,
+                                               sci_image_data_20200601):
+    first, second = sci_image_data_20200531, sci_image_data_20200601
+    outdir = os.path.dirname(first.local_path)
+    outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+
+    stack = zuds.ReferenceImage.from_images([first], outname,
+                                            engine='incremental')
+    for kwargs in [{'add': [first]}, {'remove': [second]},
+                   {'remove': [first]}]:
+        with pytest.raises(ValueError):
+            stack.update_inputs(calculate_seeing=False, **kwargs)
+
+
+def test_incremental_stack_from_previous_window(sci_image_data_20200531,
+                                                sci_image_data_20200601,
+                                                sci_image_data_20200604,
+                                                refimg_data_first2_imgs,
+                                                monkeypatch):
+    ref = refimg_data_first2_imgs
+    scis = [sci_image_data_20200531, sci_image_data_20200601,
+            sci_image_data_20200604]
+    outdir = os.path.dirname(scis[0].local_path)
+
+    subs = []
+    for sci in scis:
+        _ = sci.weight_image
+        subs.append(zuds.SingleEpochSubtraction.from_images(
+            sci, ref, nreg_side=1, hotpants_kws={'ko': 0, 'bgo': 0}
+        ))
+    zuds.DBSession().add_all(subs)
+    zuds.DBSession().commit()
+
+    def window(images):
+        outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+        coadd = zuds.ScienceCoadd.from_images(images, outname)
+        zuds.DBSession().add(coadd)
+        zuds.DBSession().commit()
+        stack = zuds.MultiEpochSubtraction.from_images(coadd, ref,
+                                                       engine='incremental')
+        zuds.DBSession().add(stack)
+        zuds.DBSession().commit()
+        return stack
+
+    window(scis[:2])
+
+    # the second window only resamples the subtraction that entered it
+    def rebuild(*args, **kwargs):
+        raise AssertionError('the stack was made from scratch')
+
+    with monkeypatch.context() as m:
+        m.setattr(zuds.subtraction, '_coadd_from_images', rebuild)
+        second = window(scis)
+
+    assert sorted(i.id for i in second.input_images) == \
+        sorted(s.id for s in subs)
+    acc = zuds.CoaddAccumulator.load(zuds.accumulator_path(second.local_path))
+    assert sorted(acc.image_ids) == sorted(s.id for s in subs)
+
+    outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+    scratch = zuds.accumulate_coadd(zuds.MultiEpochSubtraction, subs,
+                                    outname,
+                                    outname.replace('.fits', '.mask.fits'),
+                                    addbkg=False)
+    np.testing.assert_allclose(second.data, scratch.data, atol=1e-3)
+    # the mask copied from the first window is rewritten on disk
+    mask, header = fits.getdata(second.mask_image.local_path, header=True)
+    np.testing.assert_array_equal(
+        mask, fits.getdata(scratch.mask_image.local_path)
+    )
+    assert header['NCOMBINE'] == len(subs)
@@ -0,0 +1,78 @@
+import pytest
+
+import zuds
+from zuds.tests.suite.test_send import FakeAlert, SCHEMA
+
+
+class ListSink(object):
+    """Delivers every message at once, recording their keys in order."""
+
+    def __init__(self, fail_on=None):
+        self.keys = []
+        self.fail_on = fail_on
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        if int(key) == self.fail_on:
+            raise BufferError('queue full')
+        self.keys.append(int(key))
+        on_delivery(None, None)
+
+    def flush(self, timeout=None):
+        return 0
+
+
+def fake_xmatch(ra, dec, source_id):
+    if source_id == 'down':
+        raise ConnectionError('kowalski is down')
+    return {'source': source_id}
+
+
+def _stage(sink, **kwargs):
+    sender = zuds.AlertSender(sink=sink,
+                              schemas={'single': SCHEMA, 'stack': SCHEMA})
+    return zuds.AlertStage(sender=sender, nthreads=4, nprocs=1, **kwargs)
+
+
+def _todo(ids, down=()):
+    return [(i, 0., 0., 'down' if i in down else f's{i}') for i in ids]
+
+
+def test_alert_stage_order_and_inflight(monkeypatch):
+    monkeypatch.setattr(zuds.crossmatch, 'xmatch', fake_xmatch)
+    sink = ListSink()
+    stage = _stage(sink, max_inflight=2, chunk_size=3)
+
+    unsent = [FakeAlert(1, 'single'), FakeAlert(2, 'stack')]
+    made = []
+
+    def make_alerts(ids, candidates):
+        assert candidates == {i: {'source': f's{i}'} for i in ids}
+        # no more than max_inflight alerts wait to be handed to the sink
+        assert len(unsent) + len(made) - len(sink.keys) <= 2
+        alerts = [FakeAlert(i, 'single') for i in ids]
+        made.extend(alerts)
+        return alerts
+
+    stage._queue_alerts(_todo(range(10, 20)), unsent, make_alerts)
+    assert sink.keys == [1, 2] + list(range(10, 20))
+    assert stage.sender.flush() == unsent + made
+
+
+def test_alert_stage_errors_propagate(monkeypatch):
+    monkeypatch.setattr(zuds.crossmatch, 'xmatch', fake_xmatch)
+
+    def make_alerts(ids, candidates):
+        return [FakeAlert(i, 'single') for i in ids]
+
+    # a failed cross-match
+    stage = _stage(ListSink(), chunk_size=2)
+    with pytest.raises(ConnectionError):
+        stage._queue_alerts(_todo(range(10, 16), down=[13]), [],
+                            make_alerts)
+
+    # a failed delivery
+    sink = ListSink(fail_on=12)
+    stage = _stage(sink, chunk_size=2)
+    with pytest.raises(BufferError):
+        stage._queue_alerts(_todo(range(10, 16)), [], make_alerts)
+    assert sink.keys == [10, 11]
@@ -0,0 +1,54 @@
+import numpy as np
+
+from zuds.constants import BIG_RMS
+from zuds.arraykernels import (weight_from_rms, rms_from_weight,
+                               saturated_pixels, add_constant, mask_dtype)
+
+
+def _maps():
+    rng = np.random.default_rng(0)
+    data = rng.normal(150., 10., (64, 80)).astype('>f4')
+    data[5, 5] = 1e5
+    rms = rng.uniform(5., 15., (64, 80)).astype('<f4')
+    bad = rng.random((64, 80)) < 0.1
+    return data, rms, bad
+
+
+def test_weight_from_rms():
+    data, rms, bad = _maps()
+    saturated = saturated_pixels(data, {'SATURATE': 5e4})
+    weight = weight_from_rms(rms, bad, saturated)
+
+    expect = np.empty_like(rms)
+    expect[~bad] = 1 / rms[~bad] ** 2
+    expect[bad] = 0.
+    expect[data >= 0.9 * 5e4] = 0.
+
+    assert weight.dtype == np.float32
+    np.testing.assert_array_equal(weight, expect)
+    assert saturated_pixels(data, {}) is None
+
+
+def test_rms_from_weight():
+    data, rms, bad = _maps()
+    weight = weight_from_rms(rms, bad)
+    out = np.empty(rms.shape, dtype='float32')
+    result = rms_from_weight(weight, bad, out=out)
+
+    assert result is out
+    np.testing.assert_allclose(result[~bad], rms[~bad], rtol=1e-6)
+    assert (result[bad] == np.float32(BIG_RMS)).all()
+
+
+def test_dtype_policy():
+    data = np.ones((4, 4), dtype='>f4')
+    result = add_constant(data, 150.)
+    assert result.dtype == np.dtype('float32')
+    assert (result == 151.).all()
+
+    data = np.ones((4, 4), dtype='float32')
+    assert add_constant(data, 1.) is data
+
+    assert mask_dtype(255) == np.uint8
+    assert mask_dtype(2 ** 15 - 1) == np.int16
+    assert mask_dtype(2 ** 17 - 1) == np.int32
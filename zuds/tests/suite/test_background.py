@@ -0,0 +1,64 @@
+import numpy as np
+
+from zuds.background import (sample_grid, robust_statistics,
+                             estimate_background, background_meshes,
+                             evaluate_mesh)
+
+
+def test_robust_statistics():
+    rng = np.random.default_rng(0)
+    values = rng.normal(100., 5., 10001)
+    median, rms, err = robust_statistics(values.copy())
+    assert median == np.median(values)
+    expect = 1.4826 * np.median(np.abs(values - np.median(values)))
+    assert np.isclose(rms, expect)
+    # the half width of the 95% interval is ~1.96 * 1.25 sigma / sqrt(n)
+    assert 0.05 < err < 0.2
+    assert np.isnan(robust_statistics(np.array([]))).all()
+
+
+def test_estimate_background():
+    rng = np.random.default_rng(1)
+    data = rng.normal(150., 10., (3080, 3072)).astype('f4')
+    mask = np.zeros(data.shape, dtype='int16')
+    # a bright masked source and a few unmasked hot pixels
+    data[1000:1200, 1000:1200] = 5e4
+    mask[1000:1200, 1000:1200] = 2 ** 1
+    data[::97, ::89] = 1e5
+    data[0, 0] = np.nan
+
+    slices = sample_grid(data.shape)
+    assert 2 ** 15 < data[slices].size < 2 ** 17
+    assert sample_grid((10, 10)) == (slice(None), slice(None))
+
+    bkg, rms, err = estimate_background(data, mask=mask)
+    exact = np.median(data[(mask == 0) & np.isfinite(data)])
+    assert abs(bkg - exact) < 3 * err
+    assert abs(rms - 10.) < 0.3
+
+    bkg2, rms2, err2 = estimate_background(data, good=mask == 0)
+    assert (bkg, rms, err) == (bkg2, rms2, err2)
+
+
+def test_background_map():
+    y, x = np.mgrid[0:600, 0:500]
+    truth = 100. + 0.05 * x + 0.02 * y
+    rng = np.random.default_rng(2)
+    data = (truth + rng.normal(0., 3., truth.shape)).astype('f4')
+    good = np.ones(data.shape, dtype=bool)
+    good[:128, :128] = False
+
+    bkgmesh, rmsmesh = background_meshes(data, good, box=64)
+    assert bkgmesh.shape == (10, 8)
+    assert np.abs(rmsmesh - 3.).max() < 0.5
+
+    bkg = evaluate_mesh(bkgmesh, data.shape, box=64)
+    assert bkg.dtype == np.float32
+    # away from the edges and from the masked cells, which take the median
+    # of the others
+    inner = (slice(256, -64), slice(256, -64))
+    assert np.abs(bkg - truth)[inner].max() < 1.
+
+    # constant mesh -> constant map
+    flat = evaluate_mesh(np.full((3, 2), 7.), (150, 100), box=64)
+    assert (flat == 7.).all()
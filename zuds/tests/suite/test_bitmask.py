@@ -0,0 +1,64 @@
+import numpy as np
+
+from zuds.constants import BAD_SUM
+from zuds.bitmask import BitMask
+
+
+def _masks():
+    rng = np.random.default_rng(0)
+    bits = rng.integers(0, 12, (300, 40))
+    a = np.where(rng.random((300, 40)) < 0.2, 2 ** bits, 0).astype('>i2')
+    b = np.where(rng.random((300, 40)) < 0.2, 2 ** bits[::-1], 0).astype('>i2')
+    return a, b
+
+
+def test_bitmask_any_and_planes():
+    a, _ = _masks()
+    mask = BitMask(a)
+    assert mask.data is a
+    np.testing.assert_array_equal(mask.any(),
+                                  (a.astype(int) & BAD_SUM) > 0)
+    np.testing.assert_array_equal(mask.plane(3), (a & 8) > 0)
+    packed = mask.plane(3, packed=True)
+    assert packed.shape == (300, 5)
+    np.testing.assert_array_equal(np.unpackbits(packed, axis=1, count=40),
+                                  (a & 8) > 0)
+
+
+def test_bitmask_union_set_merge():
+    a, b = _masks()
+    union = BitMask.union([a, b], maxbit=17)
+    assert union.data.dtype == np.int32
+    np.testing.assert_array_equal(union.data, a | b)
+
+    where = np.zeros(a.shape, dtype=bool)
+    where[100:110] = True
+    union.set(2 ** 17, where)
+    np.testing.assert_array_equal(union.data[where], (a | b)[where].astype(int) + 2 ** 17)
+    np.testing.assert_array_equal(union.data[~where], (a | b)[~where])
+
+    # widened to hold the new bit
+    mask = BitMask(a.copy())
+    mask.set(2 ** 16, where)
+    assert mask.data.dtype == np.int32
+    assert mask.any(2 ** 16).sum() == where.sum()
+
+    mask = BitMask(a.copy()).merge(BitMask(b))
+    np.testing.assert_array_equal(mask.data, a | b)
+
+    # swarp writes masks as floats
+    mask = BitMask(a.astype('f4'))
+    assert mask.data.dtype.kind == 'i'
+    np.testing.assert_array_equal(mask.data, a)
+
+
+def test_bitmask_flags_in():
+    import photutils
+    a, _ = _masks()
+    apertures = photutils.CircularAperture([(10., 20.), (30., 250.),
+                                            (-50., -50.)], r=6.)
+    cutouts = apertures.to_mask(method='center')
+    flags = BitMask(a).flags_in(cutouts)
+    expect = [int(np.bitwise_or.reduce(m.cutout(a), axis=(0, 1)))
+              for m in cutouts[:2]]
+    assert flags == expect + [0]
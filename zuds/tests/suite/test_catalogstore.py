@@ -0,0 +1,52 @@
+import os
+import uuid
+import zuds
+import numpy as np
+from zuds.tests.fixtures import TMP_DIR
+
+
+def test_local_cone_search():
+    store = zuds.CatalogStore(os.path.join(TMP_DIR, uuid.uuid4().hex))
+    ra = np.asarray([213.5613, 213.5614, 213.9, 0.0])
+    dec = np.asarray([38.2261, 38.2261, 38.2261, -89.9])
+    store['milliquas_v6'].ingest({'ra': ra, 'dec': dec,
+                                  '_id': np.arange(4),
+                                  'Name': np.asarray(['a', 'b', 'c', 'd'])},
+                                 key='_id')
+
+    matches = store.cone_search('milliquas_v6', [213.5613, 0.], [38.2261,
+                                                                 -89.9],
+                                1.5 / 3600.)
+    assert list(matches['Name']) == ['a', 'b', 'd']
+    assert list(matches['query_index']) == [0, 0, 1]
+    np.testing.assert_allclose(matches['sep'][1], 0.2828, rtol=1e-3)
+
+    assert not store.has('TNS')
+
+
+def test_ps1_local(monkeypatch):
+    from zuds import crossmatch
+
+    store = zuds.CatalogStore(os.path.join(TMP_DIR, uuid.uuid4().hex))
+    store['PS1_DR1'].ingest({'ra': np.asarray([213.5613, 213.5623]),
+                             'dec': np.asarray([38.2261, 38.2261]),
+                             '_id': np.asarray([10, 11]),
+                             'gMeanPSFMag': np.asarray([20.1, np.nan]),
+                             'rMeanPSFMag': np.asarray([19.8, 21.]),
+                             'iMeanPSFMag': np.asarray([19.6, 20.8]),
+                             'zMeanPSFMag': np.asarray([19.5, 20.7])},
+                            key='_id')
+    monkeypatch.setattr(crossmatch, 'lookup_sgscores',
+                        lambda objids, decs, dec: np.asarray(
+                            [0.9, np.nan])[:len(objids)])
+
+    out = crossmatch.ps1_local(store, 213.5613, 38.2261)
+    assert out['objectidps1'] == 10
+    assert out['objectidps2'] == 11
+    assert out['sgscore1'] == 0.9
+    assert out['sgscore2'] == -999
+    assert out['psgmag1'] == 20.1
+    assert out['psgmag2'] == -999
+
+    # far outside of the snapshot
+    assert crossmatch.ps1_local(store, 10., -40.) == {}
@@ -0,0 +1,79 @@
+import zuds
+import numpy as np
+
+
+def _render(shape, sigma, x, y, flux):
+    img = np.zeros(shape)
+    yy, xx = np.mgrid[-15:16, -15:16]
+    for cx, cy, f in zip(x, y, flux):
+        ix, iy = int(cx), int(cy)
+        psf = np.exp(-((xx - cx + ix) ** 2 + (yy - cy + iy) ** 2) /
+                     (2 * sigma ** 2))
+        img[iy - 15:iy + 16, ix - 15:ix + 16] += f * psf / psf.sum()
+    return img
+
+
+def test_fft_subtraction_synthetic():
+    rng = np.random.RandomState(0)
+    shape = (400, 400)
+    n = 300
+    x = rng.uniform(20, 380, n)
+    y = rng.uniform(20, 380, n)
+    flux = 10 ** rng.uniform(2.5, 4.5, n)
+
+    ref = _render(shape, 1.2, x, y, flux) + 100.
+    ref += rng.normal(0, 2., shape)
+    sci = _render(shape, 2., x, y, 1.3 * flux) + 150.
+    sci += rng.normal(0, 5., shape)
+    bad = np.zeros(shape, dtype=bool)
+    bad[100:105, 200:210] = True
+
+    sub, rms, outbad, info = zuds.fft_subtraction(
+        sci, ref, np.full(shape, 5.), np.full(shape, 2.), bad, hw=6, hs=12,
+        nreg_side=2
+    )
+
+    # photometric scaling is recovered in every region
+    np.testing.assert_allclose(info['ksum'], 1.3, rtol=0.01)
+
+    assert outbad[bad].all()
+    assert (sub[outbad] == 1e-30).all()
+    z = sub[~outbad] / rms[~outbad]
+    assert abs(np.median(z)) < 0.1
+    assert 1.4826 * np.median(np.abs(z - np.median(z))) < 1.2
+
+
+def test_sub_fft_backend(sci_image_data_20200604, refimg_data_first2_imgs):
+    _ = sci_image_data_20200604.weight_image
+    sub = zuds.SingleEpochSubtraction.from_images(sci_image_data_20200604,
+                                                  refimg_data_first2_imgs,
+                                                  nreg_side=1,
+                                                  backend='fft')
+    assert sub.header['SUBENGIN'] == 'FFT'
+    good = ~sub.mask_image.boolean.data
+    z = sub.data[good] / sub.rms_image.data[good]
+    assert 1.4826 * np.median(np.abs(z - np.median(z))) < 2.
+
+
+def test_fft_subtraction_warm_start():
+    rng = np.random.RandomState(1)
+    shape = (300, 300)
+    n = 200
+    x = rng.uniform(20, 280, n)
+    y = rng.uniform(20, 280, n)
+    flux = 10 ** rng.uniform(2.5, 4.5, n)
+
+    ref = _render(shape, 1.2, x, y, flux) + rng.normal(0, 2., shape)
+    sci = _render(shape, 1.8, x, y, 0.8 * flux) + rng.normal(0, 5., shape)
+    args = (sci, ref, np.full(shape, 5.), np.full(shape, 2.),
+            np.zeros(shape, dtype=bool))
+
+    _, _, _, cold = zuds.fft_subtraction(*args, hw=6, hs=12, nreg_side=1)
+
+    # fitting on the stamps of the previous solution skips the search
+    # and gives the same kernel
+    centers = cold['centers'] + [(0, 0), (150, shape[1] - 1)]
+    _, _, _, warm = zuds.fft_subtraction(*args, hw=6, hs=12, nreg_side=1,
+                                         centers=centers)
+    assert warm['centers'] == cold['centers']
+    np.testing.assert_allclose(warm['ksum'], cold['ksum'])
@@ -0,0 +1,54 @@
+import os
+import uuid
+import numpy as np
+from astropy.wcs import WCS
+
+import zuds
+from zuds.tests.fixtures import TMP_DIR
+
+
+class FakeReference(object):
+    basename = 'ztf_000550_zr_c12_q2_refimg.fits'
+
+
+def _wcs(crpix):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150., 30.]
+    wcs.wcs.crpix = crpix
+    wcs.wcs.cdelt = [-1.0 / 3600, 1.0 / 3600]
+    return wcs
+
+
+def test_kernel_cache_roundtrip():
+    cache = zuds.KernelCache(os.path.join(TMP_DIR, 'kernels',
+                                          uuid.uuid4().hex))
+    ref = FakeReference()
+    assert cache.load(ref) is None
+
+    centers = [(10, 20), (100, 50), (250, 299)]
+    solution = zuds.KernelSolution.from_centers(centers, _wcs([150, 150]),
+                                                [1.1, 1.2], 1.05, 0.01)
+    cache.save(ref, solution)
+    loaded = cache.load(ref)
+    np.testing.assert_allclose(loaded.ksum, [1.1, 1.2])
+
+    # the stamps follow the sky to the pixel grid of a later epoch, and
+    # those that fall off the image are dropped
+    later = loaded.centers(_wcs([140, 150]), (300, 300))
+    assert later == [(10, 10), (100, 40), (250, 289)]
+    later = loaded.centers(_wcs([160, 150]), (300, 300))
+    assert later == [(10, 30), (100, 60)]
+
+    assert loaded.accepts(1.1, 0.02)
+    assert not loaded.accepts(1.5, 0.01)
+    assert not loaded.accepts(1.0, 0.1)
+
+
+def test_residual_quality():
+    rng = np.random.RandomState(0)
+    sub = rng.normal(0, 2., (200, 200))
+    sub[:20] = 1e-30
+    zstd, fmask = zuds.residual_quality(sub, np.full(sub.shape, 2.))
+    assert abs(zstd - 1) < 0.05
+    assert fmask == 0.1
@@ -0,0 +1,42 @@
+import numpy as np
+from astropy.io import fits
+
+from zuds.refselect import verify_fits
+
+
+def test_verify_fits(tmp_path):
+    good = tmp_path / 'good.fits'
+    fits.writeto(good, np.random.random((100, 101)).astype('<f4'),
+                 checksum=True)
+    assert verify_fits(good)
+    assert verify_fits(good, checksum=True)
+
+    contents = good.read_bytes()
+
+    truncated = tmp_path / 'truncated.fits'
+    truncated.write_bytes(contents[:-3000])
+    assert not verify_fits(truncated)
+
+    # flipped bits in the data are only caught by the checksums
+    corrupted = tmp_path / 'corrupted.fits'
+    flipped = bytearray(contents)
+    flipped[-100] ^= 0xff
+    corrupted.write_bytes(bytes(flipped))
+    assert verify_fits(corrupted)
+    assert not verify_fits(corrupted, checksum=True)
+
+    garbage = tmp_path / 'garbage.fits'
+    garbage.write_bytes(b'garbage' * 1000)
+    assert not verify_fits(garbage)
+
+
+def test_verify_fits_extensions(tmp_path):
+    path = tmp_path / 'mef.fits'
+    fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.ImageHDU(np.zeros((10, 10), dtype='<i2')),
+        fits.BinTableHDU.from_columns([
+            fits.Column('a', 'E', array=np.arange(5.))
+        ])
+    ]).writeto(path)
+    assert verify_fits(path)
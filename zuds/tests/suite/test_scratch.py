@@ -0,0 +1,44 @@
+import os
+import socket
+import subprocess
+
+import zuds
+
+
+def test_scratch_directory_release(tmp_path):
+    directory = zuds.scratch_directory('teststage', tmpdir=tmp_path)
+    assert directory.is_dir()
+    (directory / 'intermediate.fits').write_bytes(b'x' * 1000)
+
+    before = zuds.scratch_usage().get('teststage', {'runs': 0})['runs']
+    zuds.release_scratch(directory)
+    assert not directory.exists()
+    usage = zuds.scratch_usage()['teststage']
+    assert usage['runs'] == before + 1
+    assert usage['tmpfs'] + usage['disk'] >= 1000
+
+
+def test_scratch_falls_back_to_disk(tmp_path):
+    # more than any tmpfs can hold
+    directory = zuds.scratch_directory('teststage', tmpdir=tmp_path,
+                                       nbytes=2 ** 62)
+    assert directory.parent == tmp_path
+    zuds.release_scratch(directory)
+
+
+def test_clean_scratch_removes_dead_processes(tmp_path):
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+
+    host = socket.gethostname()
+    dead = tmp_path / f'swarp-{proc.pid}-0@{host}'
+    alive = tmp_path / f'swarp-{os.getpid()}-0@{host}'
+    other = tmp_path / 'not-a-scratch-directory'
+    for d in [dead, alive, other]:
+        d.mkdir()
+    (dead / 'resampled.fits').write_bytes(b'x' * 100)
+
+    assert zuds.clean_scratch(tmp_path) == 100
+    assert not dead.exists()
+    assert alive.exists()
+    assert other.exists()
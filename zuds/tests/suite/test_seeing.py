@@ -6,3 +6,41 @@ def test_seeing(sci_image_data_20200531):
     zuds.estimate_seeing(sci_image_data_20200531)
     np.testing.assert_allclose(sci_image_data_20200531.header['SEEING'], 2.004896)
 
+
+
+def test_seeing_calibrators_cached(sci_image_data_20200531):
+    image = sci_image_data_20200531
+    tree = zuds.calibrator_stars(image)
+    assert zuds.calibrator_stars(image) is tree
+    zuds.estimate_seeing(image)
+    np.testing.assert_allclose(image.header['SEEING'], 2.004896)
+
+
+def test_half_sample_mode():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.normal(2., 0.05, size=200),
+                             rng.uniform(2., 10., size=100)])
+    assert abs(zuds.half_sample_mode(values) - 2.) < 0.05
+    assert zuds.half_sample_mode([1., 2., 2.2]) == 2.1
+
+
+def test_catalog_seeing(sci_image_data_20200531):
+    catalog = zuds.PipelineFITSCatalog.from_image(sci_image_data_20200531)
+    seeing = zuds.catalog_seeing(catalog)
+    np.testing.assert_allclose(seeing, 2.004896, rtol=0.2)
+
+
+def test_seeing_calibrator_query_fails(sci_image_data_20200531, monkeypatch):
+    image = sci_image_data_20200531
+
+    def outage(*args, **kwargs):
+        raise ConnectionError('kowalski is down')
+
+    monkeypatch.setattr(zuds.seeing, '_CALIBRATORS', {})
+    monkeypatch.setattr(zuds.seeing, '_PENDING', {})
+    monkeypatch.setattr(zuds.seeing, '_calibrator_tree', outage)
+
+    zuds.estimate_seeing(image)
+    assert image.header_comments['SEEING'] == \
+        'FWHM of seeing in pixels (SExtractor stars)'
+    np.testing.assert_allclose(image.header['SEEING'], 2.004896, rtol=0.2)
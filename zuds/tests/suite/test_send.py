@@ -0,0 +1,57 @@
+import os
+import zuds
+import fastavro
+import datetime
+from zuds.tests.fixtures import TMP_DIR
+
+
+class FakeAlert(object):
+
+    def __init__(self, candid, alert_type):
+        self.alert = {'candid': candid, 'objectId': f'ZUDS20aaa{candid}',
+                      'candidate': {'alert_type': alert_type}}
+        self.created_at = datetime.datetime(2020, 5, 31, 10)
+        self.sent = False
+
+    def to_dict(self):
+        return dict(self.alert, candidate={'alert_type':
+                                           self.alert['candidate']['alert_type']})
+
+
+SCHEMA = fastavro.parse_schema({
+    'type': 'record', 'name': 'alert', 'fields': [
+        {'name': 'candid', 'type': 'long'},
+        {'name': 'objectId', 'type': 'string'},
+        {'name': 'candidate', 'type': {
+            'type': 'record', 'name': 'candidate', 'fields': [
+                {'name': 'alert_type', 'type': 'string'}]}}
+    ]
+})
+
+
+def test_alert_schemas_parse():
+    for alert_type in ['single', 'stack']:
+        schema = zuds.load_alert_schema(alert_type)
+        assert schema['name'] == 'zuds.alert'
+        assert zuds.load_alert_schema(alert_type) is schema
+
+
+def test_send_to_file_sink():
+    outdir = os.path.join(TMP_DIR, 'alerts')
+    sender = zuds.AlertSender(sink=zuds.FileSink(outdir),
+                              schemas={'single': SCHEMA, 'stack': SCHEMA})
+    alerts = [FakeAlert(1, 'single'), FakeAlert(2, 'stack'),
+              FakeAlert(3, 'single')]
+
+    delivered = sender.send(alerts)
+    assert delivered == alerts
+    assert sender.nsent == 3
+
+    path = os.path.join(outdir, 'ztf_20200531_programid2_zuds_stack',
+                        '2.avro')
+    with open(path, 'rb') as f:
+        records = list(fastavro.reader(f))
+    assert records == [alerts[1].to_dict()]
+    assert len(os.listdir(os.path.join(
+        outdir, 'ztf_20200531_programid2_zuds'
+    ))) == 2
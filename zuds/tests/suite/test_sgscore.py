@@ -0,0 +1,29 @@
+import os
+import zuds
+import fitsio
+import numpy as np
+from zuds.tests.fixtures import TMP_DIR
+
+
+def test_sgscore_index():
+    outdir = os.path.join(TMP_DIR, 'sgscore')
+    os.makedirs(outdir, exist_ok=True)
+    strip = os.path.join(outdir,
+                         'hlsp_ps1-psc_ps1_gpc1_38_multi_v1_cat.fits')
+    data = np.zeros(4, dtype=[('objid', '<i8'), ('ps_score', '<f4')])
+    data['objid'] = [155932135611530004, 155932135611530001,
+                     155932135611530003, 155932135611530002]
+    data['ps_score'] = [0.4, 0.1, 0.3, 0.2]
+    fitsio.write(strip, data, clobber=True)
+
+    assert zuds.build_sgscore_index([strip], outdir) == [38]
+    assert zuds.build_sgscore_index([strip], outdir) == []
+
+    index = zuds.SGScoreIndex(outdir)
+    scores = index.lookup([155932135611530003, 155932135611530001,
+                           155932135611530005], 38.2)
+    np.testing.assert_allclose(scores[:2], [0.3, 0.1], rtol=1e-6)
+    assert np.isnan(scores[2])
+
+    # strips that have not been indexed have no scores
+    assert np.isnan(index.lookup([155932135611530003], -12.)[0])
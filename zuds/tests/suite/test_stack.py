@@ -34,3 +34,34 @@ def test_stack_input_images(sci_image_data_20200531, sci_image_data_20200601):
     assert len(stack.input_images) == 2
     assert sci_image_data_20200601 in stack.input_images
     assert sci_image_data_20200531 in stack.input_images
+
+
+def test_native_stack(sci_image_data_20200531, sci_image_data_20200601):
+    images = [sci_image_data_20200531, sci_image_data_20200601]
+    outdir = os.path.dirname(images[0].local_path)
+    outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+    stack = zuds.ReferenceImage.from_images(images, outname, engine='native')
+    naxis1, naxis2 = stack.header['NAXIS1'], stack.header['NAXIS2']
+    assert abs(naxis1 - 544) <= 2
+    assert abs(naxis2 - 545) <= 2
+    assert stack.header['COADDENG'] == 'NATIVE'
+    assert abs(np.median(stack.data) - zuds.BKG_VAL) < 5
+    assert stack.mask_image.data.shape == stack.data.shape
+    assert len(stack.input_images) == 2
+
+
+def test_native_stack_or_mask(sci_image_data_20200531,
+                              sci_image_data_20200601):
+    images = [sci_image_data_20200531, sci_image_data_20200601]
+    outdir = os.path.dirname(images[0].local_path)
+    stacks = []
+    for mask_combine in ['and', 'or']:
+        outname = os.path.join(outdir, f'{uuid.uuid4().hex}.fits')
+        stacks.append(zuds.ReferenceImage.from_images(
+            images, outname, engine='native', mask_combine=mask_combine
+        ))
+    andmask, ormask = [s.mask_image.data.astype(int) for s in stacks]
+
+    # every bit of the AND combine is also set in the OR combine
+    assert ((andmask & ormask) == andmask).all()
+    assert (ormask != andmask).any()
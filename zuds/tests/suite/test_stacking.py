@@ -0,0 +1,65 @@
+import numpy as np
+from astropy.wcs import WCS
+
+from zuds.stacking import coadd_grid, lanczos_resample, combine_stack
+
+
+def _wcs():
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150., 2.]
+    wcs.wcs.crpix = [200., 150.]
+    wcs.wcs.cd = [[-2.8e-4, 0.], [0., 2.8e-4]]
+    return wcs
+
+
+def test_coadd_grid_single_image():
+    wcs, shape = coadd_grid([_wcs()], [(300, 400)])
+    assert shape == (300, 400)
+    x, y = wcs.all_world2pix(*_wcs().all_pix2world([0, 399], [0, 299], 0), 0)
+    # the grid is centered on the footprint, so it can be offset by half
+    # a pixel
+    np.testing.assert_allclose(x, [0, 399], atol=0.5 + 1e-3)
+    np.testing.assert_allclose(y, [0, 299], atol=0.5 + 1e-3)
+
+
+def test_lanczos_resample():
+    y, x = np.mgrid[0:60, 0:80].astype(float)
+    data = np.sin(x / 7.) + np.cos(y / 9.)
+    good = np.ones(data.shape, dtype=bool)
+
+    # identity
+    values, frac = lanczos_resample(data, good, x, y)
+    np.testing.assert_allclose(values, data, atol=1e-12)
+    np.testing.assert_allclose(frac, 1.)
+
+    # subpixel shift of a smooth image
+    xs, ys = x[10:-10, 10:-10] + 0.3, y[10:-10, 10:-10] + 0.4
+    values, _ = lanczos_resample(data, good, xs, ys)
+    np.testing.assert_allclose(values, np.sin(xs / 7.) + np.cos(ys / 9.),
+                               atol=1e-2)
+
+    # bad pixels are left out of the kernel
+    data[30, 40] = 1e9
+    good[30, 40] = False
+    values, frac = lanczos_resample(data, good, x + 0.2, y + 0.2)
+    assert np.abs(values).max() < 10
+    assert frac.min() < 1
+
+
+def test_combine_stack_rejects_outliers():
+    values = np.ones((5, 4, 4))
+    values[2, 1, 1] = 1000.
+    weights = np.ones((5, 4, 4))
+    weights[4] = 0.
+
+    image, wsum = combine_stack(values, weights, combine='clipped')
+    np.testing.assert_allclose(image, 1.)
+    assert wsum[1, 1] == 3
+    assert wsum[0, 0] == 4
+
+    image, _ = combine_stack(values, weights, combine='weighted')
+    assert image[1, 1] > 100
+
+    image, _ = combine_stack(values, weights, combine='median')
+    np.testing.assert_allclose(image, 1.)
@@ -0,0 +1,45 @@
+import os
+import uuid
+import numpy as np
+from astropy.io import fits
+
+import zuds
+from zuds.tests.fixtures import TMP_DIR
+
+
+def test_staged_input_is_not_modified():
+    root = os.path.join(TMP_DIR, 'staging', uuid.uuid4().hex)
+    workdir = os.path.join(root, 'work')
+    os.makedirs(workdir)
+
+    src = os.path.join(root, 'image.fits')
+    fits.writeto(src, np.zeros((4, 4), dtype='<f4'))
+
+    staged = zuds.stage_file(src, workdir)
+    np.testing.assert_array_equal(fits.getdata(staged), 0)
+
+    # re-saving the staged file replaces it, leaving the original intact
+    fits.writeto(staged, np.ones((4, 4), dtype='<f4'), overwrite=True)
+    np.testing.assert_array_equal(fits.getdata(src), 0)
+    np.testing.assert_array_equal(fits.getdata(staged), 1)
+
+
+def test_commit_files():
+    root = os.path.join(TMP_DIR, 'staging', uuid.uuid4().hex)
+    os.makedirs(root)
+
+    product_map = {}
+    for name in ['a.rms.fits', 'a.fits']:
+        work = os.path.join(root, f'work.{name}')
+        with open(work, 'w') as f:
+            f.write(name)
+        product_map[work] = os.path.join(root, name)
+
+    with open(os.path.join(root, 'a.fits'), 'w') as f:
+        f.write('old')
+
+    zuds.commit_files(product_map)
+    for work, final in product_map.items():
+        assert not os.path.exists(work)
+        with open(final) as f:
+            assert f.read() == os.path.basename(final)
@@ -0,0 +1,44 @@
+import os
+import zuds
+from zuds.tests.fixtures import TMP_DIR
+
+
+def test_stamp_store_roundtrip():
+    store = zuds.StampStore(os.path.join(TMP_DIR, 'stampstore'))
+    night = '20200531'
+
+    name, extents = store.append([b'abc', b'', b'defgh'], night=night,
+                                 ids=[1, 2, 3])
+    assert name == 'stamps_20200531.pack'
+    assert store.read(name, *extents[2]) == b'defgh'
+
+    # the pack is remapped when it grows
+    name2, extents2 = store.append([b'xyz'], night=night)
+    assert name2 == name
+    refs = [(name, o, n) for o, n in extents + extents2]
+    assert store.read_many(refs) == [b'abc', b'', b'defgh', b'xyz']
+
+    index = store.index(name)
+    assert [i[2] for i in index] == [1, 2, 3, -1]
+    assert [tuple(i[:2]) for i in index] == extents + extents2
+
+
+def test_pack_before_insert():
+    store = zuds.StampStore(os.path.join(TMP_DIR, 'stampstore'))
+    thumbs = [zuds.Thumbnail(type='sub', bytes=payload)
+              for payload in [b'abc', b'defgh']]
+
+    zuds.Thumbnail.pack(thumbs, store=store, night='20200601')
+    ids = [t.id for t in thumbs]
+    assert None not in ids
+    assert all(t.bytes is None for t in thumbs)
+    assert [i[2] for i in store.index(thumbs[0].pack_file)] == ids
+
+    zuds.DBSession().add_all(thumbs)
+    zuds.DBSession().commit()
+    stored = zuds.DBSession().query(
+        zuds.Thumbnail.id, zuds.Thumbnail.bytes
+    ).filter(zuds.Thumbnail.id.in_(ids)).all()
+    assert sorted(stored) == [(i, None) for i in sorted(ids)]
+    assert store.read_many([(t.pack_file, t.pack_offset, t.pack_length)
+                            for t in thumbs]) == [b'abc', b'defgh']
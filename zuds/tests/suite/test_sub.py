@@ -29,3 +29,49 @@ def test_sub(sci_image_data_20200604, refimg_data_first2_imgs):
     np.testing.assert_allclose(stamp, stampcent)
     assert sub.reference_image is refimg_data_first2_imgs
     assert sub.target_image is sci_image_data_20200604
+
+
+def test_sub_tiled_single_region(sci_image_data_20200604,
+                                 refimg_data_first2_imgs):
+    # with one region the only tile is the whole image
+    _ = sci_image_data_20200604.weight_image
+    sub = zuds.SingleEpochSubtraction.from_images(sci_image_data_20200604,
+                                                  refimg_data_first2_imgs,
+                                                  nreg_side=1, tiled=True,
+                                                  hotpants_kws={'ko': 0,
+                                                                'bgo': 0})
+    naxis1, naxis2 = sub.header['NAXIS1'], sub.header['NAXIS2']
+    stamp = sub.data[naxis1 // 2 - 3:naxis1 // 2 + 3,
+            naxis2 // 2 - 3:naxis2 // 2 + 3]
+    assert sub.header['NTILES'] == 1
+    np.testing.assert_allclose(stamp, stampcent, rtol=1e-6)
+
+
+def test_stitch_tiles(tmp_path):
+    from astropy.io import fits
+
+    shape = (100, 120)
+    image = np.random.RandomState(0).normal(size=shape).astype('f4')
+    tiles = [(ty, tx) for ty in zuds.tile_bounds(shape[0], 3, 15)
+             for tx in zuds.tile_bounds(shape[1], 3, 15)]
+
+    subs, rmss = [], []
+    for (y0, y1, _, _), (x0, x1, _, _) in tiles:
+        subs.append(image[y0:y1, x0:x1].copy())
+        rmss.append(np.ones((y1 - y0, x1 - x0)))
+
+    # masked in one tile only, but inside the cross-fade of two tiles
+    (y0, y1, _, cy1), (x0, x1, _, _) = tiles[0]
+    subs[0][cy1 - 2 - y0, 10 - x0] = 1e-30
+
+    # as hotpants writes them: float32 on disk
+    for i, tsub in enumerate(subs):
+        fits.writeto(tmp_path / f'tile{i}.fits', tsub)
+    subs = [fits.getdata(tmp_path / f'tile{i}.fits') for i in range(len(subs))]
+
+    for tsubs in [subs, [tsub.astype(float) for tsub in subs]]:
+        sub, rms, bad = zuds.stitch_tiles(shape, tiles, tsubs, rmss, blend=5)
+        assert bad.sum() == 1 and bad[cy1 - 2, 10]
+        assert sub[bad] == 1e-30
+        np.testing.assert_allclose(sub[~bad], image[~bad], rtol=1e-6)
+        np.testing.assert_allclose(rms[~bad], 1)
@@ -0,0 +1,42 @@
+import zuds
+import numpy as np
+from astropy.coordinates import SkyCoord
+
+
+def test_make_stamps_matches_make_stamp(sci_image_data_20200531):
+    image = sci_image_data_20200531
+    ny, nx = image.data.shape
+
+    # interior positions and positions whose stamps run off the edge
+    x = np.array([100.3, nx / 2, nx - 200.6, 5.2, nx - 3.7])
+    y = np.array([1500.8, ny / 2, 250.1, 12.4, ny - 20.5])
+    ra, dec = image.wcs.all_pix2world(x, y, 0)
+
+    coord = SkyCoord(ra, dec, unit='deg')
+    cutouts, headers = zuds.make_stamps(coord, image.data, image.wcs)
+    assert len(cutouts) == len(headers) == len(x)
+
+    for r, d, cutout, header in zip(ra, dec, cutouts, headers):
+        expected = zuds.make_stamp(None, r, d, None, None, image.data,
+                                   image.wcs, save=False)
+        np.testing.assert_array_equal(cutout, expected.data)
+        expheader = expected.wcs.to_header()
+        assert header['CRPIX1'] == expheader['CRPIX1']
+        assert header['CRPIX2'] == expheader['CRPIX2']
+
+
+def test_render_stamps_matches_zscale():
+    from astropy.visualization.interval import ZScaleInterval
+
+    rng = np.random.RandomState(0)
+    arrays = [rng.normal(100., 10., size=(63, 63)) for _ in range(20)]
+    arrays[3][10, 10] = np.nan
+
+    vmin, vmax = zuds.zscale_limits(arrays)
+    for arr, lo, hi in zip(arrays, vmin, vmax):
+        explo, exphi = ZScaleInterval().get_limits(arr)
+        np.testing.assert_allclose([lo, hi], [explo, exphi], rtol=1e-6)
+
+    images = zuds.render_stamps(arrays, vmin, vmax)
+    assert all(i.dtype == np.uint8 and i.shape == (63, 63) for i in images)
+    assert images[3][10, 10] == 255
@@ -0,0 +1,33 @@
+import zuds
+
+
+def _runs(nreg_side, ko, walltime, zstd, fmask=0.05, n=3):
+    return [(nreg_side, ko, walltime, zstd, fmask)] * n
+
+
+def test_tuner_starts_from_the_default():
+    assert zuds.choose_subtraction_parameters([]) == (3, 4)
+    assert zuds.choose_subtraction_parameters(_runs(3, 4, 60., 1.1, n=2)) \
+        == (3, 4)
+
+
+def test_tuner_steps_down_on_sparse_fields():
+    history = _runs(3, 4, 60., 1.10)
+    assert zuds.choose_subtraction_parameters(history) == (2, 4)
+
+    # as good and faster
+    history += _runs(2, 4, 35., 1.11)
+    assert zuds.choose_subtraction_parameters(history) == (2, 2)
+
+    # faster but worse
+    history += _runs(2, 2, 25., 1.40)
+    assert zuds.choose_subtraction_parameters(history) == (2, 4)
+
+
+def test_tuner_protects_crowded_fields():
+    history = _runs(3, 4, 90., 1.20) + _runs(2, 4, 50., 1.35)
+    assert zuds.choose_subtraction_parameters(history) == (3, 4)
+
+    # masks too much more of the image
+    history = _runs(3, 4, 90., 1.20) + _runs(2, 4, 50., 1.20, fmask=0.1)
+    assert zuds.choose_subtraction_parameters(history) == (3, 4)
@@ -0,0 +1,67 @@
+import gc
+import os
+import numpy as np
+from astropy.io import fits
+
+import zuds
+
+
+def _virtual_image():
+    image = zuds.FITSImage()
+    image.basename = f'virtual_{os.getpid()}.rms.fits'
+    image.data = np.arange(12, dtype='float32').reshape(3, 4)
+    image.header = {'SEEING': 2.}
+    image.header_comments = {'SEEING': 'FWHM in pixels'}
+    return image
+
+
+def test_materialize_virtual_product(tmp_path):
+    image = _virtual_image()
+
+    path = zuds.materialize(image)
+    assert os.path.dirname(path) == str(zuds.virtual_product_dir())
+    np.testing.assert_array_equal(fits.getdata(path), image.data)
+    assert fits.getheader(path)['SEEING'] == 2.
+
+    # still virtual, and only written once
+    assert not image.ismapped
+    assert zuds.materialize(image) == path
+
+    # a tool's own working directory
+    other = zuds.materialize(image, tmp_path)
+    assert other == str(tmp_path / image.basename)
+    assert os.path.exists(other)
+
+    # removed with the image
+    del image
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_materialize_mapped_image(tmp_path):
+    image = _virtual_image()
+    path = tmp_path / image.basename
+    image.map_to_local_file(path, quiet=True)
+    image.save()
+    assert zuds.materialize(image) == str(path)
+
+
+def test_stage_product(tmp_path):
+    image = _virtual_image()
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+
+    # a virtual image is written to the working directory only
+    path = zuds.stage_product(image, workdir)
+    assert path == str(workdir / image.basename)
+    np.testing.assert_array_equal(fits.getdata(path), image.data)
+    assert not hasattr(image, '_virtual_path')
+
+    # a mapped one is staged
+    os.remove(path)
+    mapped = tmp_path / image.basename
+    image.map_to_local_file(mapped, quiet=True)
+    image.save()
+    path = zuds.stage_product(image, workdir)
+    assert path == str(workdir / image.basename)
+    assert os.path.samefile(path, mapped)
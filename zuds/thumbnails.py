@@ -16,7 +16,12 @@ from .archive import URL_PREFIX, STAMP_PREFIX, _mkdir_recursive
 from .utils import fid_map
 
 
-__all__ = ['make_stamp', 'Thumbnail']
+# gray levels of the 256 entries of matplotlib's 'gray' colormap
+GRAY_LUT = (np.linspace(0, 1, 256) * 255).astype(np.uint8)
+
+
+__all__ = ['make_stamp', 'make_stamps', 'zscale_limits', 'render_stamps',
+           'write_stamp_image', 'Thumbnail']
 
 
 class Thumbnail(Base):
@@ -29,6 +34,11 @@ class Thumbnail(Base):
     origin = sa.Column(sa.String, nullable=True)
     bytes = deferred(sa.Column(psql.BYTEA))
 
+    # location of the payload in the stamp store, if it is not in `bytes`
+    pack_file = sa.Column(sa.Text, nullable=True)
+    pack_offset = sa.Column(sa.BigInteger, nullable=True)
+    pack_length = sa.Column(sa.Integer, nullable=True)
+
     image_id = sa.Column(sa.Integer, sa.ForeignKey('calibratableimages.id',
                                                    ondelete='CASCADE'),
                          index=True, nullable=True)
@@ -53,79 +63,173 @@ class Thumbnail(Base):
 
     @classmethod
     def from_detection(cls, detection, image):
+        return cls.from_detections([detection], [image])[0]
+
+    @classmethod
+    def from_detections(cls, detections, images, nthreads=None):
+        """Make the stamps of each detection in `detections` on each image in
+        `images`.
+
+        Positions are converted to pixels with one WCS call per image and
+        all the stamps of an image are cut out with a single fancy-indexing
+        operation. The gzipped FITS payloads are encoded on a pool of
+        `nthreads` threads (zlib releases the GIL). Returns the unsaved
+        `Thumbnail` rows, image-major."""
 
         from .subtraction import Subtraction
         from .coadd import ReferenceImage
-        from astropy.io import fits
-
-        if isinstance(image, Base):
-            linkimage = image
+        from astropy.coordinates import SkyCoord
+        from concurrent.futures import ThreadPoolExecutor
+
+        detections = list(detections)
+        if len(detections) == 0:
+            return []
+
+        coord = SkyCoord([d.ra for d in detections],
+                         [d.dec for d in detections],
+                         frame='icrs', unit='deg')
+
+        stamps = []
+        payloads = []
+        for image in images:
+
+            if isinstance(image, Base):
+                linkimage = image
+            else:
+                linkimage = image.parent_image
+
+            if isinstance(linkimage, Subtraction):
+                stamptype = 'sub'
+            elif isinstance(linkimage, ReferenceImage):
+                stamptype = 'ref'
+            else:
+                stamptype = 'new'
+
+            cutouts, headers = make_stamps(coord, image.data, image.wcs,
+                                           size=CUTOUT_SIZE)
+
+            for detection, cutout, header in zip(detections, cutouts,
+                                                 headers):
+                stamp = cls(image=linkimage, detection=detection,
+                            type=stamptype)
+                stamps.append(stamp)
+                payloads.append((cutout, header))
+
+        if len(payloads) == 1:
+            encoded = [_encode_stamp(payloads[0])]
         else:
-            linkimage = image.parent_image
+            with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                encoded = list(pool.map(_encode_stamp, payloads))
 
-        stamp = cls(image=linkimage, detection=detection)
+        for stamp, payload in zip(stamps, encoded):
+            stamp.bytes = payload
 
-        if isinstance(linkimage, Subtraction):
-            stamp.type = 'sub'
-        elif isinstance(linkimage, ReferenceImage):
-            stamp.type = 'ref'
-        else:
-            stamp.type = 'new'
+        return stamps
 
-        cutout = make_stamp(
-            None, detection.ra, detection.dec, None,
-            None, image.data, image.wcs, save=False,
-            size=CUTOUT_SIZE
-        )
+    def persist(self):
+        """Persist a thumbnail to the disk. Currently only works on cori."""
+        self.persist_many([self])
 
-        # convert the cutout data to bytes
-        # and store that in the database
+    @classmethod
+    def persist_many(cls, thumbnails, ext='jpg'):
+        """Render a batch of thumbnails to grayscale images on disk and set
+        their `file_uri` and `public_url`. Currently only works on cori.
 
-        fitsbuf = io.BytesIO()
-        gzbuf = io.BytesIO()
+        The stamps are scaled with a batched ZScale and an 8-bit grayscale
+        lookup table in numpy (the same mapping as plt.imsave with
+        cmap='gray'), and encoded with Pillow, or, for PNGs, with a
+        bundled zlib-based writer if Pillow is not available. Each output
+        directory is created once per batch."""
 
-        fits.writeto(fitsbuf, cutout.data, header=cutout.wcs.to_header())
-        with gzip.open(gzbuf, 'wb') as fz:
-            fz.write(fitsbuf.getvalue())
+        if os.getenv('NERSC_HOST') != 'cori':
+            raise RuntimeError('Must be on cori to persist stamps.')
 
-        stamp.bytes = gzbuf.getvalue()
-        stamp.detection = detection
+        thumbnails = list(thumbnails)
+        images = render_stamps([t.array for t in thumbnails])
 
-        return stamp
+        made = set()
+        for thumb, image in zip(thumbnails, images):
+            thumb.source = thumb.detection.source
+            img = thumb.image
+            base = f'stamp.{thumb.id}.{ext}'
+            reldir = f'stamps/{img.field:06d}/c{img.ccdid:02d}/' \
+                     f'q{img.qid}/{fid_map[img.fid]}'
+            thumb.public_url = f'{Path(URL_PREFIX) / reldir / base}'
+            thumb.file_uri = f'{Path(STAMP_PREFIX) / reldir / base}'
 
-    def persist(self):
-        """Persist a thumbnail to the disk. Currently only works on cori."""
-        from astropy.visualization.interval import ZScaleInterval
+            if reldir not in made:
+                _mkdir_recursive(Path(thumb.file_uri).parent)
+                made.add(reldir)
 
-        if os.getenv('NERSC_HOST') != 'cori':
-            raise RuntimeError('Must be on cori to persist stamps.')
+            write_stamp_image(thumb.file_uri, image)
+            os.chmod(thumb.file_uri, 0o774)
 
-        data = self.array
-        self.source = self.detection.source
-        vmin, vmax = ZScaleInterval().get_limits(data)
-        img = self.image
-        base = f'stamp.{self.id}.jpg'
-        relpath = f'stamps/{img.field:06d}/c{img.ccdid:02d}/' \
-                  f'q{img.qid}/{fid_map[img.fid]}/{base}'
-        name = Path(URL_PREFIX) / relpath
-        self.public_url = f'{name}'
-        self.file_uri = f'{Path(STAMP_PREFIX) / relpath}'
-        _mkdir_recursive(Path(self.file_uri).parent)
+    @classmethod
+    def pack(cls, thumbnails, store=None, night=None):
+        """Move the payloads of `thumbnails` out of the database and into
+        the stamp store (by default, the one in `stamp_store_dir`), leaving
+        only their location in the rows. Pack them before they are added
+        to the session, so that their payloads never reach the database:
+        the thumbnails that have no id yet get one from the table's
+        sequence, as the store's index records them."""
+        from .stampstore import get_stamp_store
+
+        if store is None:
+            store = get_stamp_store()
+        if store is None:
+            raise ValueError('No stamp store configured (stamp_store_dir).')
+
+        thumbnails = [t for t in thumbnails if t.bytes is not None]
+        cls._reserve_ids(thumbnails)
+        name, extents = store.append([t.bytes for t in thumbnails],
+                                     night=night,
+                                     ids=[t.id for t in thumbnails])
+        for thumb, (offset, length) in zip(thumbnails, extents):
+            thumb.pack_file = name
+            thumb.pack_offset = offset
+            thumb.pack_length = length
+            thumb.bytes = None
 
-        import matplotlib.pyplot as plt
-        plt.imsave(self.file_uri, data, vmin=vmin, vmax=vmax,
-                   cmap='gray')
+    @classmethod
+    def _reserve_ids(cls, thumbnails):
+        # assign ids from the table's sequence to the thumbnails that have
+        # none, in one round trip and without inserting the rows
+        from .core import DBSession
+
+        missing = [t for t in thumbnails if t.id is None]
+        if len(missing) == 0:
+            return
+        rows = DBSession().execute(
+            sa.text('SELECT nextval(pg_get_serial_sequence(:table, \'id\')) '
+                    'FROM generate_series(1, :n)'),
+            {'table': cls.__tablename__, 'n': len(missing)}
+        ).fetchall()
+        for thumb, row in zip(missing, rows):
+            thumb.id = row[0]
 
-        os.chmod(self.file_uri, 0o774)
+    @property
+    def payload(self):
+        """The gzipped FITS stamp, from the stamp store if the thumbnail
+        was packed, otherwise from the database."""
+        if self.pack_file is not None:
+            from .stampstore import get_stamp_store
+            store = get_stamp_store()
+            if store is None:
+                raise ValueError('Thumbnail is in the stamp store, but no '
+                                 'stamp store is configured.')
+            return store.read(self.pack_file, self.pack_offset,
+                              self.pack_length)
+        return self.bytes
 
     @property
     def array(self):
         """Convert the bytes property of a Thumbnail to a numpy array
         representing the equivalent pixel values"""
         from astropy.io import fits
-        if self.bytes is None:
+        payload = self.payload
+        if payload is None:
             raise ValueError('Cannot coerce array from empty bytes attribute')
-        fitsbuf = io.BytesIO(gzip.decompress(self.bytes))
+        fitsbuf = io.BytesIO(gzip.decompress(payload))
         array = np.flipud(fits.open(fitsbuf)[0].data)
         return array
 
@@ -144,3 +248,208 @@ def make_stamp(name, ra, dec, vmin, vmax, data, wcs, save=True,
                    cmap='gray')
         os.chmod(name, 0o774)
     return cutout
+
+
+def make_stamps(coord, data, wcs, size=CUTOUT_SIZE):
+    """Vectorized `make_stamp`: cut a `size` x `size` stamp centered on each
+    position in the SkyCoord array `coord` out of `data`.
+
+    Stamps are identical to those of astropy's Cutout2D: stamps that run
+    off the edge of the image are trimmed, and a stamp that does not
+    overlap the image at all raises NoOverlapError. Returns the list of
+    stamps and the list of their FITS headers, i.e., the WCS header with
+    the reference pixel moved to each stamp's origin."""
+
+    from astropy.wcs.utils import skycoord_to_pixel
+    from astropy.nddata.utils import NoOverlapError
+
+    ny, nx = data.shape
+    x, y = skycoord_to_pixel(coord, wcs, mode='all')
+    xmin = np.ceil(np.atleast_1d(x) - size / 2.).astype(int)
+    ymin = np.ceil(np.atleast_1d(y) - size / 2.).astype(int)
+
+    if np.any((xmin + size <= 0) | (ymin + size <= 0) |
+              (xmin >= nx) | (ymin >= ny)):
+        raise NoOverlapError('Arrays do not overlap.')
+
+    # stamps that are entirely on the image are cut out in one go
+    full = (xmin >= 0) & (ymin >= 0) & (xmin + size <= nx) & \
+           (ymin + size <= ny)
+    offset = np.arange(size)
+    stack = data[(ymin[full, None] + offset)[:, :, None],
+                 (xmin[full, None] + offset)[:, None, :]]
+
+    cutouts = []
+    stacked = iter(stack)
+    for x0, y0, isfull in zip(xmin, ymin, full):
+        if isfull:
+            cutouts.append(next(stacked))
+        else:
+            cutouts.append(data[max(y0, 0):y0 + size, max(x0, 0):x0 + size])
+
+    # shift the reference pixel in the header rather than deep-copying the
+    # WCS for every stamp
+    header = wcs.to_header()
+    headers = []
+    for x0, y0 in zip(xmin, ymin):
+        h = header.copy()
+        h['CRPIX1'] = header['CRPIX1'] - max(x0, 0)
+        h['CRPIX2'] = header['CRPIX2'] - max(y0, 0)
+        headers.append(h)
+
+    return cutouts, headers
+
+
+def _encode_stamp(payload):
+    from astropy.io import fits
+    cutout, header = payload
+    fitsbuf = io.BytesIO()
+    fits.writeto(fitsbuf, cutout, header=header)
+    return gzip.compress(fitsbuf.getvalue())
+
+
+def _zscale_rows(samples, contrast=0.25, max_reject=0.5, min_npixels=5,
+                 krej=2.5, max_iterations=5):
+    # astropy's ZScaleInterval, run simultaneously on each row of a 2D
+    # array of sorted samples
+    nrow, npix = samples.shape
+    vmin = samples[:, 0].copy()
+    vmax = samples[:, -1].copy()
+    minpix = max(min_npixels, int(npix * max_reject))
+    ngrow = max(1, int(npix * 0.01))
+    lo = ngrow - 1 - (ngrow - 1) // 2
+    hi = (ngrow - 1) // 2
+
+    x = np.arange(npix, dtype=float)
+    badpix = np.zeros((nrow, npix), dtype=bool)
+    ngoodpix = np.full(nrow, npix)
+    last_ngoodpix = np.full(nrow, npix + 1)
+    slope = np.zeros(nrow)
+    active = np.ones(nrow, dtype=bool)
+
+    for _ in range(max_iterations):
+        active &= (ngoodpix < last_ngoodpix) & (ngoodpix >= minpix)
+        if not active.any():
+            break
+
+        rows = np.flatnonzero(active)
+        w = (~badpix[rows]).astype(float)
+        s = samples[rows]
+
+        # weighted least squares line through the good samples
+        sw = w.sum(axis=1)
+        sx = (w * x).sum(axis=1)
+        sy = (w * s).sum(axis=1)
+        sxx = (w * x * x).sum(axis=1)
+        sxy = (w * x * s).sum(axis=1)
+        det = sw * sxx - sx * sx
+        b = (sw * sxy - sx * sy) / det
+        a = (sy - b * sx) / sw
+        slope[rows] = b
+
+        flat = s - (a[:, None] + b[:, None] * x)
+        good = w.astype(bool)
+        mean = (flat * good).sum(axis=1) / sw
+        std = np.sqrt((((flat - mean[:, None]) * good) ** 2).sum(axis=1) / sw)
+        threshold = krej * std
+        bad = badpix[rows] | (np.abs(flat) > threshold[:, None])
+
+        # grow the rejected samples by ngrow (np.convolve(..., 'same'))
+        cum = np.concatenate([np.zeros((len(rows), 1), dtype=int),
+                              np.cumsum(bad, axis=1)], axis=1)
+        left = np.clip(np.arange(npix) - lo, 0, npix)
+        right = np.clip(np.arange(npix) + hi + 1, 0, npix)
+        badpix[rows] = (cum[:, right] - cum[:, left]) > 0
+
+        last_ngoodpix[rows] = ngoodpix[rows]
+        ngoodpix[rows] = npix - badpix[rows].sum(axis=1)
+
+    ok = ngoodpix >= minpix
+    slope = slope / contrast
+    center = (npix - 1) // 2
+    median = np.median(samples, axis=1)
+    vmin[ok] = np.maximum(vmin, median - (center - 1) * slope)[ok]
+    vmax[ok] = np.minimum(vmax, median + (npix - center) * slope)[ok]
+    return vmin, vmax
+
+
+def zscale_limits(arrays, n_samples=1000):
+    """ZScale display limits (as astropy's ZScaleInterval) of each array in
+    `arrays`. Arrays with the same number of finite pixels are processed
+    together. Returns two arrays, vmin and vmax."""
+
+    samples = []
+    for arr in arrays:
+        values = np.asarray(arr).ravel()
+        values = values[np.isfinite(values)]
+        stride = int(max(1.0, values.size / n_samples))
+        samples.append(np.sort(values[::stride][:n_samples]))
+
+    vmin = np.zeros(len(samples))
+    vmax = np.zeros(len(samples))
+    sizes = np.asarray([len(s) for s in samples])
+    for size in np.unique(sizes):
+        idx = np.flatnonzero(sizes == size)
+        if size == 0:
+            vmin[idx] = vmax[idx] = np.nan
+            continue
+        rows = np.stack([samples[i] for i in idx]).astype(float)
+        vmin[idx], vmax[idx] = _zscale_rows(rows)
+    return vmin, vmax
+
+
+def render_stamps(arrays, vmin=None, vmax=None):
+    """Map each array in `arrays` to an 8-bit grayscale image, like
+    plt.imsave(cmap='gray') with the given limits (default: ZScale).
+    Non-finite pixels are rendered white."""
+
+    if vmin is None or vmax is None:
+        vmin, vmax = zscale_limits(arrays)
+
+    images = []
+    for arr, lo, hi in zip(arrays, vmin, vmax):
+        arr = np.asarray(arr, dtype=float)
+        scale = 256. / (hi - lo) if hi > lo else 0.
+        with np.errstate(invalid='ignore'):
+            index = np.floor((arr - lo) * scale)
+        bad = ~np.isfinite(index)
+        index = np.clip(np.where(bad, 0, index), 0, 255).astype(np.uint8)
+        image = GRAY_LUT[index]
+        image[bad] = 255
+        images.append(image)
+    return images
+
+
+def _png_chunk(tag, data):
+    import zlib
+    import struct
+    return struct.pack('>I', len(data)) + tag + data + \
+        struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def _png_bytes(image):
+    # minimal 8-bit grayscale PNG encoder (one IDAT, no filtering)
+    import zlib
+    import struct
+    ny, nx = image.shape
+    raw = np.zeros((ny, nx + 1), dtype=np.uint8)
+    raw[:, 1:] = image
+    header = struct.pack('>IIBBBBB', nx, ny, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) + \
+        _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + \
+        _png_chunk(b'IEND', b'')
+
+
+def write_stamp_image(path, image):
+    """Write an 8-bit grayscale image to `path` in the format given by the
+    extension. Uses Pillow; PNGs fall back to a bundled encoder if Pillow
+    is not installed."""
+    try:
+        from PIL import Image
+    except ImportError:
+        if not str(path).lower().endswith('.png'):
+            raise
+        with open(path, 'wb') as f:
+            f.write(_png_bytes(image))
+    else:
+        Image.fromarray(image, mode='L').save(path)
@@ -0,0 +1,145 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import relationship
+
+from .core import Base, DBSession
+
+__all__ = ['SubtractionRun', 'record_subtraction', 'tune_subtraction',
+           'choose_subtraction_parameters']
+
+
+# (nreg_side, kernel order) configurations the tuner chooses from, from
+# the cheapest to the most expensive
+SUBTRACTION_CANDIDATES = [(1, 2), (1, 4), (2, 2), (2, 4), (3, 4)]
+
+# what prepare_hotpants has always used, and what quadrants without
+# enough history get
+DEFAULT_SUBTRACTION = (3, 4)
+
+# runs of a configuration on a quadrant before the tuner trusts its
+# median runtime and residuals
+MIN_RUNS = 3
+
+# number of most recent runs of a quadrant the tuner looks at
+HISTORY_LENGTH = 50
+
+# a configuration protects the subtraction quality if its median residual
+# scatter is within this fraction of the best one (or of 1)...
+QUALITY_TOLERANCE = 0.05
+
+# ... and its median masked fraction is at most this much higher
+MASK_TOLERANCE = 0.01
+
+
+class SubtractionRun(Base):
+    """Wall time and residual quality of one image subtraction, with the
+    parameters it was run with. The history of a quadrant drives the
+    choice of parameters of its next subtractions (`tune_subtraction`)."""
+
+    field = sa.Column(sa.Integer)
+    ccdid = sa.Column(sa.Integer)
+    qid = sa.Column(sa.Integer)
+    fid = sa.Column(sa.Integer)
+
+    reference_image_id = sa.Column(sa.Integer, sa.ForeignKey(
+        'referenceimages.id', ondelete='CASCADE'
+    ), index=True)
+    reference_image = relationship('ReferenceImage',
+                                   foreign_keys=[reference_image_id])
+
+    engine = sa.Column(sa.Text)
+    nreg_side = sa.Column(sa.Integer)
+    kernel_order = sa.Column(sa.Integer)
+    bg_order = sa.Column(sa.Integer)
+    tiled = sa.Column(sa.Boolean, default=False)
+
+    walltime = sa.Column(sa.Float)
+    residual_scatter = sa.Column(sa.Float)
+    masked_fraction = sa.Column(sa.Float)
+
+    # properties of the science image, for later analysis
+    seeing = sa.Column(sa.Float)
+    input_masked_fraction = sa.Column(sa.Float)
+
+    quadind = sa.Index('subtractionrun_field_ccdid_qid_fid', field, ccdid,
+                       qid, fid)
+
+
+def record_subtraction(sci, ref, engine, nreg_side, kernel_order, bg_order,
+                       walltime, residual_scatter, masked_fraction,
+                       input_masked_fraction=None, tiled=False):
+    """Add a `SubtractionRun` of `sci` minus `ref` to the session. It is
+    committed with the subtraction."""
+    run = SubtractionRun(
+        field=sci.field, ccdid=sci.ccdid, qid=sci.qid, fid=sci.fid,
+        reference_image_id=ref.id, engine=engine, nreg_side=nreg_side,
+        kernel_order=kernel_order, bg_order=bg_order, tiled=tiled,
+        walltime=walltime, residual_scatter=residual_scatter,
+        masked_fraction=masked_fraction, seeing=sci.header.get('SEEING'),
+        input_masked_fraction=input_masked_fraction
+    )
+    DBSession().add(run)
+    return run
+
+
+def choose_subtraction_parameters(history):
+    """Choose (nreg_side, kernel order) from the `history` of a quadrant, a
+    list of (nreg_side, kernel order, wall time, residual scatter, masked
+    fraction).
+
+    Configurations with at least MIN_RUNS runs are trusted. Of those whose
+    median residual scatter and masked fraction are within the tolerances
+    of the best trusted configuration, the one with the lowest median wall
+    time is chosen. On sparse fields, where fewer regions and a lower
+    kernel order subtract as well, this steps down one configuration at a
+    time: the next cheaper untried configuration is run until it is
+    trusted (and kept only if it passes). On crowded fields the cheaper
+    configurations fail the quality check and are never chosen again."""
+
+    runs = {}
+    for nreg_side, ko, walltime, zstd, fmask in history:
+        runs.setdefault((nreg_side, ko), []).append((walltime, zstd, fmask))
+
+    trusted = {cfg: np.median(np.asarray(r, dtype=float), axis=0)
+               for cfg, r in runs.items() if len(r) >= MIN_RUNS
+               and cfg in SUBTRACTION_CANDIDATES}
+
+    # establish the baseline first
+    if DEFAULT_SUBTRACTION not in trusted:
+        return DEFAULT_SUBTRACTION
+
+    zbest = max(1., min(s[1] for s in trusted.values()))
+    fbest = min(s[2] for s in trusted.values())
+    passing = [cfg for cfg, s in trusted.items()
+               if s[1] <= zbest * (1 + QUALITY_TOLERANCE) and
+               s[2] <= fbest + MASK_TOLERANCE]
+    if len(passing) == 0:
+        return DEFAULT_SUBTRACTION
+
+    best = min(passing, key=lambda cfg: trusted[cfg][0])
+    i = SUBTRACTION_CANDIDATES.index(best)
+    if i > 0 and SUBTRACTION_CANDIDATES[i - 1] not in trusted:
+        return SUBTRACTION_CANDIDATES[i - 1]
+    return best
+
+
+def tune_subtraction(sci, engine='hotpants'):
+    """Choose the (nreg_side, kernel order) of the next `engine`
+    subtraction of the quadrant of `sci` from its recorded runs."""
+
+    history = DBSession().query(
+        SubtractionRun.nreg_side, SubtractionRun.kernel_order,
+        SubtractionRun.walltime, SubtractionRun.residual_scatter,
+        SubtractionRun.masked_fraction
+    ).filter(
+        SubtractionRun.field == sci.field,
+        SubtractionRun.ccdid == sci.ccdid,
+        SubtractionRun.qid == sci.qid,
+        SubtractionRun.fid == sci.fid,
+        SubtractionRun.engine == engine,
+        SubtractionRun.tiled == False
+    ).order_by(
+        SubtractionRun.id.desc()
+    ).limit(HISTORY_LENGTH).all()
+
+    return choose_subtraction_parameters(history)
@@ -1,6 +1,8 @@
 import numpy as np
 from pathlib import Path
 
+from .background import estimate_background, BACKGROUND_NSAMP
+
 __all__ = ['initialize_directory', 'quick_background_estimate',
            'fid_map', '_split', 'print_time',
            'ensure_images_have_the_same_properties']
@@ -11,27 +13,20 @@ def initialize_directory(directory):
     directory.mkdir(parents=True, exist_ok=True)
 
 
-def quick_background_estimate(image, nsamp=None, mask_image=None):
+def quick_background_estimate(image, nsamp=BACKGROUND_NSAMP, mask_image=None):
     # only requires that image.data and image.mask_image be defined
     # we only need a quick estimate of the bkg.
     # so we mask out any pixels where the MASK value is non zero.
 
+    # the median and MAD (less sensitive than np.std to bright pixels that
+    # are not masked) are taken over a deterministic grid of about `nsamp`
+    # pixels (see zuds.estimate_background), or all pixels if None
+
     if mask_image is None:
         mask_image = image.mask_image
 
-    bkgpix = image.data[mask_image.data == 0]
-
-    if nsamp is not None:
-        bkgpix = np.random.choice(bkgpix, size=nsamp)
-
-    bkg = np.median(bkgpix)
-
-    # use MAD as it is less sensitive to outliers (bright pixels)
-
-    # some bright pixels may not be masked and can totally throw off
-    # the bkgrms calculation if np.std is used
-    bkgstd = 1.4826 * np.median(np.abs(bkgpix - bkg))
-
+    bkg, bkgstd, _ = estimate_background(image.data, nsamp=nsamp,
+                                         mask=mask_image.data)
     return bkg, bkgstd
 
 
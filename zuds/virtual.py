@@ -0,0 +1,100 @@
+import os
+import atexit
+import shutil
+import weakref
+import tempfile
+from pathlib import Path
+
+from .secrets import get_secret
+from .scratch import scratch_root, scratch_name
+from .staging import stage_file
+
+__all__ = ['virtual_product_dir', 'materialize', 'stage_product']
+
+
+def virtual_product_dir():
+    """Directory this process writes virtual products to when an external
+    tool needs them as files: a per-process subdirectory of
+    `virtual_product_dir` from the configuration file, or of the tmpfs
+    scratch root (see `zuds.scratch_root`), or of the system temporary
+    directory. It is removed when the process exits, or by
+    `zuds.clean_scratch` if the process dies (the products in it are
+    removed with their images, see `materialize`)."""
+    try:
+        root = get_secret('virtual_product_dir')
+    except KeyError:
+        root = None
+
+    if root is None:
+        root = scratch_root()
+    if root is None:
+        root = Path(tempfile.gettempdir()) / 'zuds'
+
+    directory = Path(root) / scratch_name('virtual', unique=False)
+    if not directory.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    return directory
+
+
+def materialize(image, directory=None):
+    """Return the path of a file holding `image`, for an external tool
+    (SWarp, SExtractor, HOTPANTS) that needs one.
+
+    Derived products (weight and rms maps, boolean masks) are virtual:
+    they are computed from their parents on demand and only kept in
+    memory. A mapped image whose file exists is used as is. Otherwise the
+    image is written to `directory` (default: `virtual_product_dir()`)
+    under its basename, without mapping it, so that it stays in memory
+    and remains virtual, and the file is removed when the image is
+    garbage collected. If `directory` is given, the image is always
+    written there (see also `stage_product`)."""
+    from astropy.io import fits
+
+    virtual = directory is None
+    if virtual:
+        if image.ismapped and os.path.exists(image.local_path):
+            return image.local_path
+
+        # written already
+        path = getattr(image, '_virtual_path', None)
+        if path is not None and os.path.exists(path):
+            return path
+        directory = virtual_product_dir()
+
+    path = Path(directory) / image.basename
+    data = image.data
+    if data.dtype == bool:
+        data = data.astype('uint8')
+
+    # write to a temporary name first, so that a concurrent reader of the
+    # same product never sees a partial file
+    tmppath = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    fits.writeto(tmppath, data, header=image.astropy_header, overwrite=True)
+    os.replace(tmppath, path)
+
+    path = str(path)
+    if virtual:
+        image._virtual_path = path
+        # rather than at exit, so that a long-lived process does not
+        # accumulate the products of every image it has processed
+        weakref.finalize(image, _remove, path)
+    return path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stage_product(image, directory):
+    """Return the path of `image` in the working directory `directory` of
+    an external tool (see `zuds.scratch_directory`): its file, staged
+    there with `zuds.stage_file`, if it has one, otherwise `image` written
+    there by `materialize`. Either way it is removed with the directory
+    by `zuds.release_scratch`, and counted in the directory's usage."""
+    if image.ismapped and os.path.exists(image.local_path):
+        return str(stage_file(image.local_path, directory))
+    return materialize(image, directory)